@@ -1,17 +1,37 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, abort
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy import func
 from sqlalchemy import or_
-from sqlalchemy.exc import IntegrityError
+from sqlalchemy.exc import IntegrityError, SAWarning
 from sqlalchemy import text
+import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
 from werkzeug.security import generate_password_hash, check_password_hash
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
+import abc
+import gzip
 import hashlib
+import heapq
+import itertools
+import json
 import math
 import os
+import queue
+import random
 import re
+import sqlite3
+import threading
 import time
+import warnings
+from bisect import bisect_left
+
+try:
+    import brotli
+except ImportError:  # brotli là tùy chọn: thiếu thì chỉ nén gzip
+    brotli = None
 
 app = Flask(__name__)
 
@@ -32,13 +52,265 @@ OSRM_BASE_URL = os.getenv("OSRM_BASE_URL", "https://router.project-osrm.org").rs
 OSRM_PROFILE = os.getenv("OSRM_PROFILE", "driving")  # driving/foot/bike tùy server
 OSRM_TIMEOUT = float(os.getenv("OSRM_TIMEOUT", "8"))
 OSRM_MAX_COORDS = int(os.getenv("OSRM_MAX_COORDS", "70"))  # tránh gửi quá nhiều điểm
+OSRM_CHUNK_WORKERS = int(os.getenv("OSRM_CHUNK_WORKERS", "4"))  # số request OSRM song song khi tuyến dài
+OSRM_POOL_SIZE = int(os.getenv("OSRM_POOL_SIZE", "10"))  # số kết nối keep-alive tới OSRM mỗi worker
+OSRM_RETRIES = int(os.getenv("OSRM_RETRIES", "2"))  # retry GET khi lỗi kết nối/5xx/429
+OSRM_RETRY_BACKOFF_SEC = float(os.getenv("OSRM_RETRY_BACKOFF_SEC", "0.2"))
+OSRM_CB_FAILURE_THRESHOLD = int(os.getenv("OSRM_CB_FAILURE_THRESHOLD", "5"))  # lỗi liên tiếp -> mở mạch
+OSRM_CB_COOLDOWN_SEC = float(os.getenv("OSRM_CB_COOLDOWN_SEC", "30"))  # mở mạch bao lâu trước khi thử lại
+# shape đang là đường thẳng (OSRM lỗi/không có route): GET chỉ xin dựng lại tối đa 1 lần / N giây / tuyến
+ROUTE_SHAPE_RETRY_SEC = int(os.getenv("ROUTE_SHAPE_RETRY_SEC", "600"))
 BUS_TRIP_CAPACITY = int(os.getenv("BUS_TRIP_CAPACITY", "80"))  # bus đô thị: không theo ghế
 BUS_SCHEDULE_HORIZON_MIN = int(os.getenv("BUS_SCHEDULE_HORIZON_MIN", "360"))  # auto-generate N phút sắp tới
+# Lịch ảo: chuyến theo headway tính bằng số học, chuyen_xe chỉ lưu chuyến sửa tay/có vé
+BUS_VIRTUAL_TIMETABLE = os.getenv("BUS_VIRTUAL_TIMETABLE", "1").strip() == "1"
+BUS_SCHEDULER_ENABLED = os.getenv("BUS_SCHEDULER_ENABLED", "1").strip() == "1"  # job nền sinh chuyến
+BUS_SCHEDULER_INTERVAL_SEC = int(os.getenv("BUS_SCHEDULER_INTERVAL_SEC", "60"))
+BUS_SCHEDULER_BACKFILL_MIN = int(os.getenv("BUS_SCHEDULER_BACKFILL_MIN", "180"))  # giữ chuyến đã xuất bến chưa tới trạm cuối
+# Bảng giờ đến trạm (gio_den_tram) dựng sẵn cho trang trạm; dùng chung horizon/backfill/chu kỳ với job sinh chuyến
+STOP_TIMES_ENABLED = os.getenv("STOP_TIMES_ENABLED", "1").strip() == "1"
+# Lưu trữ chuyến cũ: chuyến quá N ngày, không có vé -> gộp vào tong_hop_chuyen_ngay (summary) hoặc xóa (delete)
+TRIP_RETENTION_DAYS = int(os.getenv("TRIP_RETENTION_DAYS", "7"))
+TRIP_ARCHIVE_MODE = os.getenv("TRIP_ARCHIVE_MODE", "summary").strip().lower()
+TRIP_ARCHIVE_INTERVAL_SEC = int(os.getenv("TRIP_ARCHIVE_INTERVAL_SEC", "3600"))  # 0 = tắt job nền, dùng cron
+# SSE giữ 1 kết nối dài / client: chỉ bật khi gunicorn chạy worker thread/async (gthread, gevent...);
+# tắt thì trang tuyến chỉ lấy /stop_etas 1 lần; bật mà bị từ chối (503) thì gọi lại mỗi ETA_STREAM_TICK_SEC giây
+ETA_STREAM_ENABLED = os.getenv("ETA_STREAM_ENABLED", "0").strip() == "1"
+ETA_STREAM_TICK_SEC = float(os.getenv("ETA_STREAM_TICK_SEC", "15"))  # SSE stop_etas: tính lại mỗi N giây / tuyến-hướng
+ETA_STREAM_MAX_SEC = int(os.getenv("ETA_STREAM_MAX_SEC", "600"))  # đóng kết nối sau N giây (client tự nối lại)
+ETA_STREAM_MAX_CLIENTS = int(os.getenv("ETA_STREAM_MAX_CLIENTS", "200"))  # số kết nối SSE tối đa mỗi worker
+COMPRESS_ENABLED = os.getenv("COMPRESS_ENABLED", "1").strip() == "1"  # gzip/brotli theo Accept-Encoding
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", "500"))  # body nhỏ hơn thì không nén
+COMPRESS_LEVEL = int(os.getenv("COMPRESS_LEVEL", "6"))
+STOP_INDEX_CELL_M = float(os.getenv("STOP_INDEX_CELL_M", "500"))  # cạnh ô lưới của spatial index trạm
+STOP_INDEX_TTL_SEC = int(os.getenv("STOP_INDEX_TTL_SEC", "300"))  # worker khác sửa trạm: dựng lại index sau tối đa N giây
+NEARBY_MAX_RADIUS_M = int(os.getenv("NEARBY_MAX_RADIUS_M", "3000"))  # /api/stops/nearby: bán kính tối đa
+STOP_GROUP_RADIUS_M = float(os.getenv("STOP_GROUP_RADIUS_M", "40"))  # trạm các tuyến cách nhau <= N mét = 1 trạm vật lý
+PLAN_MAX_TRANSFERS = int(os.getenv("PLAN_MAX_TRANSFERS", "2"))  # /api/plan: số lần chuyển tuyến tối đa
+PLAN_WALK_SPEED_KMH = float(os.getenv("PLAN_WALK_SPEED_KMH", "4.5"))
+PLAN_TRANSFER_RADIUS_M = int(os.getenv("PLAN_TRANSFER_RADIUS_M", "400"))  # đi bộ chuyển tuyến giữa 2 trạm
+PLAN_ACCESS_RADIUS_M = int(os.getenv("PLAN_ACCESS_RADIUS_M", "800"))  # đi bộ từ điểm đi/tới trạm
+PLAN_MIN_TRANSFER_SEC = int(os.getenv("PLAN_MIN_TRANSFER_SEC", "60"))  # thời gian tối thiểu để đổi xe
+PLAN_NETWORK_TTL_SEC = int(os.getenv("PLAN_NETWORK_TTL_SEC", "300"))
+ETA_BATCH_MAX_STOPS = int(os.getenv("ETA_BATCH_MAX_STOPS", "100"))  # /api/etas/batch: số trạm tối đa/request
 BUS_OSRM_DURATION_FACTOR = float(os.getenv("BUS_OSRM_DURATION_FACTOR", "1.25"))  # bus chậm hơn xe hơi (OSRM driving)
 BUS_STOP_DWELL_SEC = int(os.getenv("BUS_STOP_DWELL_SEC", "15"))  # dừng đón/trả khách mỗi trạm (ước tính)
 BUS_FALLBACK_SPEED_KMH = float(os.getenv("BUS_FALLBACK_SPEED_KMH", "22"))  # fallback nếu OSRM fail
+# Cache hình học tuyến (geometry) cho /api/osrm/route: L1 trong process + bảng cache_duong_di
+ROUTE_GEOMETRY_CACHE_TTL_SEC = int(os.getenv("ROUTE_GEOMETRY_CACHE_TTL_SEC", str(30 * 24 * 3600)))
+ROUTE_GEOMETRY_CACHE_MAX_ROWS = int(os.getenv("ROUTE_GEOMETRY_CACHE_MAX_ROWS", "5000"))
+ROUTE_GEOMETRY_L1_MAX_ENTRIES = int(os.getenv("ROUTE_GEOMETRY_L1_MAX_ENTRIES", "256"))
+GEOMETRY_SIMPLIFY_PX = float(os.getenv("GEOMETRY_SIMPLIFY_PX", "1.0"))  # ?zoom=: sai số Douglas-Peucker = N pixel
+GEOMETRY_VARIANT_CACHE_MAX_ENTRIES = int(os.getenv("GEOMETRY_VARIANT_CACHE_MAX_ENTRIES", "1024"))  # bản rút gọn/mã hóa
 STOP_OFFSET_CACHE_TTL_SEC = int(os.getenv("STOP_OFFSET_CACHE_TTL_SEC", "900"))
-_STOP_OFFSET_CACHE = {}
+STOP_OFFSET_CACHE_MAX_ENTRIES = int(os.getenv("STOP_OFFSET_CACHE_MAX_ENTRIES", "512"))  # L1 LRU mỗi worker
+STOP_OFFSET_FALLBACK_TTL_SEC = int(os.getenv("STOP_OFFSET_FALLBACK_TTL_SEC", "60"))  # kết quả Haversine: TTL ngắn
+# Cache từng leg OSRM (trạm -> trạm kế) để sửa 1 trạm chỉ phải tính lại các leg quanh nó
+OSRM_LEG_CACHE_TTL_SEC = int(os.getenv("OSRM_LEG_CACHE_TTL_SEC", str(30 * 24 * 3600)))
+OSRM_LEG_L1_MAX_ENTRIES = int(os.getenv("OSRM_LEG_L1_MAX_ENTRIES", "20000"))
+# Single-flight giữa các process qua lease row (tùy chọn; trong 1 process luôn bật)
+STOP_OFFSET_SINGLEFLIGHT_LEASE = os.getenv("STOP_OFFSET_SINGLEFLIGHT_LEASE", "0").strip() == "1"
+# Stale-while-revalidate: entry hết hạn vẫn trả ngay, thread nền tính lại
+STOP_OFFSET_REFRESH_WORKERS = int(os.getenv("STOP_OFFSET_REFRESH_WORKERS", "2"))
+STOP_OFFSET_REFRESH_QUEUE_MAX = int(os.getenv("STOP_OFFSET_REFRESH_QUEUE_MAX", "64"))
+# L2 cache offset trạm dùng chung giữa các worker/restart: db (mặc định) / sqlite / none
+STOP_OFFSET_CACHE_BACKEND = os.getenv("STOP_OFFSET_CACHE_BACKEND", "db").strip().lower()
+STOP_OFFSET_CACHE_SQLITE_PATH = os.getenv(
+    "STOP_OFFSET_CACHE_SQLITE_PATH", os.path.join(BASE_DIR, "stop_offset_cache.db")
+)
+
+# ==================== OSRM CLIENT ====================
+
+class OsrmError(RuntimeError):
+    """Lỗi gọi OSRM. `payload` là JSON OSRM trả về (nếu có) để debug."""
+
+    def __init__(self, message, payload=None):
+        super().__init__(message)
+        self.payload = payload
+
+
+class OsrmUnavailable(OsrmError):
+    """Circuit breaker đang mở: không gọi OSRM, caller fallback ngay."""
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker 3 trạng thái:
+    - closed: gọi bình thường, đếm lỗi liên tiếp; đủ `failure_threshold` -> open.
+    - open: từ chối ngay (không chờ timeout) trong `cooldown_sec`.
+    - half_open: cho đúng 1 request thử; thành công -> closed, lỗi -> open lại.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold, cooldown_sec):
+        self.failure_threshold = max(1, int(failure_threshold))
+        self.cooldown_sec = max(1.0, float(cooldown_sec))
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+        self.rejected = 0
+        self.opened_count = 0
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and (time.time() - self.opened_at) >= self.cooldown_sec:
+                self.state = self.HALF_OPEN
+                self._probe_in_flight = False
+            if self.state == self.HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.opened_count += 1
+                self.state = self.OPEN
+                self.opened_at = time.time()
+            self._probe_in_flight = False
+
+    def retry_after(self):
+        with self._lock:
+            if self.state != self.OPEN:
+                return 0
+            return max(1, int(math.ceil(self.cooldown_sec - (time.time() - self.opened_at))))
+
+    def stats(self):
+        with self._lock:
+            return {
+                "state": self.state,
+                "failures": self.failures,
+                "failure_threshold": self.failure_threshold,
+                "cooldown_sec": self.cooldown_sec,
+                "opened_count": self.opened_count,
+                "rejected": self.rejected,
+            }
+
+
+class OsrmClient:
+    """
+    Client OSRM dùng chung cho mọi chỗ gọi routing:
+    - requests.Session + HTTPAdapter pool -> giữ kết nối keep-alive, không bắt tay TCP/TLS mỗi lần.
+    - Timeout theo từng request.
+    - Retry GET (idempotent) khi lỗi kết nối hoặc 429/5xx, backoff lũy thừa có jitter.
+      Không retry read-timeout để không nhân đôi thời gian chặn worker.
+    - Circuit breaker: OSRM đang chết thì raise OsrmUnavailable ngay, không chờ timeout.
+    """
+
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, base_url, profile, timeout, pool_size, retries, backoff_sec, breaker=None):
+        self.base_url = base_url
+        self.profile = profile
+        self.timeout = timeout
+        self.pool_size = max(1, int(pool_size))
+        self.retries = max(0, int(retries))
+        self.backoff_sec = max(0.0, float(backoff_sec))
+        self.breaker = breaker
+        self._session = None
+        self._session_pid = None
+        self._lock = threading.Lock()
+
+    def _get_session(self):
+        with self._lock:
+            # tạo lại sau fork (gunicorn --preload) để không dùng chung socket giữa các process
+            if self._session is None or self._session_pid != os.getpid():
+                sess = requests.Session()
+                adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size, max_retries=0)
+                sess.mount("http://", adapter)
+                sess.mount("https://", adapter)
+                sess.headers.update({"User-Agent": "smartbus-demo"})
+                self._session = sess
+                self._session_pid = os.getpid()
+            return self._session
+
+    def _sleep_backoff(self, attempt):
+        delay = self.backoff_sec * (2 ** attempt)
+        time.sleep(delay * random.uniform(0.5, 1.5))
+
+    def get_json(self, url, params=None, timeout=None):
+        if self.breaker is not None and not self.breaker.allow():
+            raise OsrmUnavailable("OSRM tạm thời không khả dụng (circuit open)")
+
+        try:
+            status, j = self._get_json_with_retry(url, params=params, timeout=timeout)
+        except OsrmError:
+            if self.breaker is not None:
+                self.breaker.record_failure()
+            raise
+
+        if self.breaker is not None:
+            # 4xx (vd NoRoute) nghĩa là OSRM vẫn sống; chỉ 429/5xx tính là lỗi
+            if status in self.RETRY_STATUSES:
+                self.breaker.record_failure()
+            else:
+                self.breaker.record_success()
+        return status, j
+
+    def _get_json_with_retry(self, url, params=None, timeout=None):
+        sess = self._get_session()
+        timeout = self.timeout if timeout is None else timeout
+        last_error = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self._sleep_backoff(attempt - 1)
+            try:
+                r = sess.get(url, params=params, timeout=timeout)
+            except requests.exceptions.ReadTimeout as e:
+                raise OsrmError(f"OSRM timeout: {e}")
+            except requests.exceptions.RequestException as e:
+                last_error = OsrmError(f"Gọi OSRM thất bại: {e}")
+                continue
+
+            try:
+                j = r.json() if r.content else {}
+            except ValueError:
+                j = {}
+            if r.status_code in self.RETRY_STATUSES and attempt < self.retries:
+                last_error = OsrmError(f"OSRM HTTP {r.status_code}", payload=j)
+                continue
+            return r.status_code, j
+
+        raise last_error or OsrmError("Gọi OSRM thất bại")
+
+    def route(self, points_lnglat, timeout=None, **params):
+        """
+        Gọi /route cho list (lng, lat). Trả route đầu tiên (dict) hoặc raise OsrmError.
+        """
+        coord_str = ";".join(f"{float(lng)},{float(lat)}" for (lng, lat) in points_lnglat)
+        url = f"{self.base_url}/route/v1/{self.profile}/{coord_str}"
+        status, j = self.get_json(url, params=params, timeout=timeout)
+        if status != 200 or j.get("code") != "Ok" or not j.get("routes"):
+            raise OsrmError("OSRM không trả route", payload=j)
+        return j["routes"][0]
+
+
+OSRM = OsrmClient(
+    OSRM_BASE_URL,
+    OSRM_PROFILE,
+    OSRM_TIMEOUT,
+    OSRM_POOL_SIZE,
+    OSRM_RETRIES,
+    OSRM_RETRY_BACKOFF_SEC,
+    breaker=CircuitBreaker(OSRM_CB_FAILURE_THRESHOLD, OSRM_CB_COOLDOWN_SEC),
+)
+
 
 # ==================== CÁC MODEL DỮ LIỆU ====================
 
@@ -83,6 +355,8 @@ class TuyenXe(db.Model):
     ghiChu = db.Column(db.Text)                  # tùy chọn, thông tin thêm
     khoangCachKm = db.Column(db.Float)           # khoảng cách tuyến (km)
     tanSuatPhut = db.Column(db.Integer)          # tần suất (phút/chuyến)
+    # tăng mỗi khi tuyến/trạm/chuyến của tuyến đổi (event after_flush) -> ETag các API của tuyến
+    data_version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
 
     chuyen_xes = db.relationship("ChuyenXe", backref="tuyen", lazy=True)
     tram_dungs = db.relationship(
@@ -100,9 +374,34 @@ class ChuyenXe(db.Model):
     ngayKhoiHanh = db.Column(db.String(20))
     gioKhoiHanh = db.Column(db.String(20))
     huong = db.Column(db.String(10), default="DI")  # DI/VE (bus đô thị)
+    # Thời điểm xuất bến (typed) = ngayKhoiHanh + gioKhoiHanh, tự đồng bộ khi insert/update
+    khoiHanhLuc = db.Column(db.DateTime)
 
     ve_xe = db.relationship("VeXe", backref="chuyen", lazy=True)
 
+    __table_args__ = (
+        # "N chuyến tới" = WHERE tuyen_id/huong AND khoiHanhLuc >= now ORDER BY khoiHanhLuc LIMIT n
+        db.Index("idx_trip_route_dir_departure", "tuyen_id", "huong", "khoiHanhLuc"),
+    )
+
+
+def parse_trip_departure(ngay, gio):
+    """"YYYY-MM-DD" + "HH:MM" (chấp nhận cả "HH:MM:SS") -> datetime, None nếu không parse được."""
+    if not ngay or not gio:
+        return None
+    for fmt in ("%Y-%m-%d %H:%M", "%Y-%m-%d %H:%M:%S"):
+        try:
+            return datetime.strptime(f"{str(ngay).strip()} {str(gio).strip()}", fmt)
+        except ValueError:
+            continue
+    return None
+
+
+@db.event.listens_for(ChuyenXe, "before_insert")
+@db.event.listens_for(ChuyenXe, "before_update")
+def _sync_trip_departure(mapper, connection, trip):
+    trip.khoiHanhLuc = parse_trip_departure(trip.ngayKhoiHanh, trip.gioKhoiHanh)
+
 
 class HoaDon(db.Model):
     __tablename__ = "hoa_don"
@@ -159,6 +458,140 @@ class TramDung(db.Model):
     huong = db.Column(db.String(10))
     tuyen_id = db.Column(db.Integer, db.ForeignKey("tuyen_xe.maTuyen"), nullable=False)
     tuyen = db.relationship("TuyenXe", back_populates="tram_dungs")
+    # nhóm trạm vật lý (cùng vị trí, khác tuyến/hướng); dựng bởi build_stop_groups()
+    nhom_id = db.Column(db.Integer, db.ForeignKey("nhom_tram.maNhom"), index=True)
+
+
+class NhomTram(db.Model):
+    """Trạm vật lý: gom các TramDung (mỗi tuyến/hướng 1 dòng) đứng gần nhau thành 1 nhóm."""
+    __tablename__ = "nhom_tram"
+
+    maNhom = db.Column(db.Integer, primary_key=True)
+    tenNhom = db.Column(db.String(100), nullable=False)
+    lat = db.Column(db.Float, nullable=False)
+    lng = db.Column(db.Float, nullable=False)
+    so_tram = db.Column(db.Integer, nullable=False, default=1)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+
+class ChuyenTiepNhomTram(db.Model):
+    """Đi bộ chuyển tuyến giữa 2 nhóm trạm gần nhau (lưu cả 2 chiều)."""
+    __tablename__ = "chuyen_tiep_nhom_tram"
+
+    tu_nhom = db.Column(db.Integer, db.ForeignKey("nhom_tram.maNhom"), primary_key=True)
+    den_nhom = db.Column(db.Integer, db.ForeignKey("nhom_tram.maNhom"), primary_key=True)
+    khoang_cach_m = db.Column(db.Float, nullable=False)
+    di_bo_giay = db.Column(db.Integer, nullable=False)
+
+
+class CacheOffsetTram(db.Model):
+    """L2 cache offset trạm (OSRM) dùng chung giữa các worker, sống qua restart."""
+    __tablename__ = "cache_offset_tram"
+    id = db.Column(db.Integer, primary_key=True)
+    tuyen_id = db.Column(db.Integer, nullable=False)
+    huong = db.Column(db.String(10), nullable=False)
+    signature = db.Column(db.String(40), nullable=False)
+    payload = db.Column(db.Text, nullable=False)  # JSON: source + [[maTram, offset_s, dist_m], ...]
+    created_ts = db.Column(db.Float, nullable=False)
+
+    __table_args__ = (
+        db.UniqueConstraint("tuyen_id", "huong", "signature", name="uq_cache_offset_tram_key"),
+    )
+
+
+class CacheDuongDi(db.Model):
+    """Cache kết quả OSRM overview=full theo hash(danh sách tọa độ chuẩn hóa + profile)."""
+    __tablename__ = "cache_duong_di"
+    key = db.Column(db.String(40), primary_key=True)
+    profile = db.Column(db.String(20), nullable=False)
+    n_points = db.Column(db.Integer, nullable=False)
+    distance_m = db.Column(db.Float)
+    duration_s = db.Column(db.Float)
+    geometry = db.Column(db.Text, nullable=False)  # GeoJSON LineString
+    created_ts = db.Column(db.Float, nullable=False)
+    last_hit_ts = db.Column(db.Float, nullable=False, index=True)
+
+
+class HinhDangTuyen(db.Model):
+    """Hình dạng tuyến (polyline) đã tính sẵn theo tuyến + hướng, dựng lại khi trạm đổi."""
+    __tablename__ = "hinh_dang_tuyen"
+    id = db.Column(db.Integer, primary_key=True)
+    tuyen_id = db.Column(db.Integer, db.ForeignKey("tuyen_xe.maTuyen"), nullable=False)
+    huong = db.Column(db.String(10), nullable=False)
+    signature = db.Column(db.String(40), nullable=False)  # _stops_signature của các trạm lúc dựng
+    version = db.Column(db.Integer, nullable=False, default=1)
+    geometry = db.Column(db.Text, nullable=False)  # GeoJSON LineString
+    distance_m = db.Column(db.Float)
+    duration_s = db.Column(db.Float)
+    source = db.Column(db.String(20))  # osrm / osrm_chunked / straight
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.UniqueConstraint("tuyen_id", "huong", name="uq_hinh_dang_tuyen_dir"),
+    )
+
+
+class CacheLegOsrm(db.Model):
+    """Cache 1 leg OSRM giữa 2 tọa độ liên tiếp (duration/distance gốc của OSRM, chưa nhân hệ số bus)."""
+    __tablename__ = "cache_leg_osrm"
+    key = db.Column(db.String(80), primary_key=True)  # profile|from_lat,from_lng;to_lat,to_lng (6 chữ số)
+    duration_s = db.Column(db.Float, nullable=False)
+    distance_m = db.Column(db.Float, nullable=False)
+    created_ts = db.Column(db.Float, nullable=False)
+
+
+class AppLease(db.Model):
+    """Lease theo tên (khóa mềm có hạn) để chỉ 1 worker/node làm một việc tại một thời điểm."""
+    __tablename__ = "app_lease"
+    ten = db.Column(db.String(120), primary_key=True)
+    owner = db.Column(db.String(120), nullable=False)
+    expires_ts = db.Column(db.Float, nullable=False)
+
+
+class TongHopChuyenNgay(db.Model):
+    """Tóm tắt chuyến đã lưu trữ (1 dòng/tuyến/ngày/hướng) thay cho các dòng chuyen_xe cũ đã xóa."""
+    __tablename__ = "tong_hop_chuyen_ngay"
+    id = db.Column(db.Integer, primary_key=True)
+    tuyen_id = db.Column(db.Integer, db.ForeignKey("tuyen_xe.maTuyen"), nullable=False)
+    ngay = db.Column(db.String(20), nullable=False)
+    huong = db.Column(db.String(10), nullable=False)
+    so_chuyen = db.Column(db.Integer, nullable=False, default=0)
+    gio_dau = db.Column(db.String(20))
+    gio_cuoi = db.Column(db.String(20))
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.UniqueConstraint("tuyen_id", "ngay", "huong", name="uq_tong_hop_chuyen_ngay"),
+    )
+
+
+class GioDenTram(db.Model):
+    """Giờ đến dự kiến của từng chuyến tại từng trạm (dựng sẵn, xem `build_stop_times`)."""
+    __tablename__ = "gio_den_tram"
+    id = db.Column(db.Integer, primary_key=True)
+    tram_id = db.Column(db.Integer, db.ForeignKey("tram_dung.maTram"), nullable=False)
+    tuyen_id = db.Column(db.Integer, db.ForeignKey("tuyen_xe.maTuyen"), nullable=False)
+    huong = db.Column(db.String(10), nullable=False)
+    trip_key = db.Column(db.String(40), nullable=False)  # maChuyen hoặc token chuyến ảo "v..."
+    khoi_hanh_luc = db.Column(db.DateTime, nullable=False)
+    den_luc = db.Column(db.DateTime, nullable=False)
+    offsets_hash = db.Column(db.String(16), nullable=False)  # offset trạm lúc dựng -> biết khi nào cần dựng lại
+
+    __table_args__ = (
+        # "N chuyến tới trạm": WHERE tram_id = ? AND den_luc >= now ORDER BY den_luc LIMIT n
+        db.Index("idx_stop_times_stop_arrival", "tram_id", "den_luc"),
+        db.Index("idx_stop_times_route_dir_depart", "tuyen_id", "huong", "khoi_hanh_luc"),
+        # 1 dòng / (chuyến, trạm): job nối tiếp và job dựng lại có thể ghi cùng lúc
+        db.Index("idx_stop_times_unique_trip_stop", "trip_key", "tram_id", unique=True),
+    )
+
+
+class SchemaMigration(db.Model):
+    """Các migration (index/cột) đã chạy, xem `run_migrations`."""
+    __tablename__ = "schema_migrations"
+    version = db.Column(db.String(80), primary_key=True)
+    description = db.Column(db.String(200))
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
 
 
 # ==================== KHỞI TẠO DB & ADMIN ====================
@@ -272,47 +705,214 @@ def ensure_schema():
                 conn.execute(text("ALTER TABLE ve_xe ADD COLUMN maSoVe VARCHAR(50)"))
             if "thoiGianSuDung" not in ticket_cols:
                 conn.execute(text("ALTER TABLE ve_xe ADD COLUMN thoiGianSuDung VARCHAR(30)"))
+    except Exception as e:
+        print("ensure_schema warning:", e)
 
-            try:
-                conn.execute(text("""
-                  CREATE UNIQUE INDEX IF NOT EXISTS idx_card_code_unique
-                  ON the_tu (maSoThe)
-                """))
-            except Exception:
-                pass
+with app.app_context():
+    ensure_schema()
 
-            try:
-                conn.execute(text("""
-                  CREATE UNIQUE INDEX IF NOT EXISTS idx_ticket_code_unique
-                  ON ve_xe (maSoVe)
-                """))
-            except Exception:
-                pass
 
-            # Tránh tạo trùng chuyến theo tuyến/ngày/giờ/hướng khi auto-generate lịch
-            try:
-                conn.execute(text("""
-                  CREATE UNIQUE INDEX IF NOT EXISTS idx_trip_unique_departure
-                  ON chuyen_xe (tuyen_id, ngayKhoiHanh, gioKhoiHanh, huong)
-                """))
-            except Exception:
-                # nếu DB đã có dữ liệu trùng, tránh làm app chết; code sẽ tự tránh trùng ở mức logic
-                pass
+# ==================== MIGRATION (CỘT & INDEX) ====================
+# Chạy trên mọi dialect (SQLite/Postgres/...): mỗi migration 1 transaction, ghi version vào
+# bảng schema_migrations. Index khai báo bằng db.Index nên SQLAlchemy tự quote tên cột camelCase.
+# Thêm migration mới: append vào MIGRATIONS, KHÔNG sửa/xóa migration đã phát hành.
+
+def _table_index(table, name):
+    for idx in table.indexes:
+        if idx.name == name:
+            return idx
+    raise KeyError(name)
+
+
+def _column_names(conn, table_name):
+    return {c["name"] for c in db.inspect(conn).get_columns(table_name)}
+
+
+def _backfill_trip_departures(conn):
+    trip_tbl = ChuyenXe.__table__
+    pending = conn.execute(
+        db.select(trip_tbl.c.maChuyen, trip_tbl.c.ngayKhoiHanh, trip_tbl.c.gioKhoiHanh)
+        .where(trip_tbl.c.khoiHanhLuc.is_(None))
+    ).fetchall()
+    for ma, ngay, gio in pending:
+        depart_dt = parse_trip_departure(ngay, gio)
+        if depart_dt is not None:
+            conn.execute(trip_tbl.update().where(trip_tbl.c.maChuyen == ma).values(khoiHanhLuc=depart_dt))
+
+
+def _migrate_trip_departure_column(conn):
+    # cột typed khoiHanhLuc (ChuyenXe) + backfill từ chuỗi ngày/giờ
+    if "khoiHanhLuc" not in _column_names(conn, "chuyen_xe"):
+        preparer = conn.dialect.identifier_preparer
+        col_type = db.DateTime().compile(dialect=conn.dialect)
+        conn.execute(text(
+            f"ALTER TABLE {preparer.quote('chuyen_xe')} ADD COLUMN {preparer.quote('khoiHanhLuc')} {col_type}"
+        ))
+    _backfill_trip_departures(conn)
+
+
+def _migrate_stop_group_column(conn):
+    # tram_dung.nhom_id (DB cũ tạo trước khi có nhóm trạm)
+    if "nhom_id" not in _column_names(conn, "tram_dung"):
+        preparer = conn.dialect.identifier_preparer
+        col_type = db.Integer().compile(dialect=conn.dialect)
+        conn.execute(text(
+            f"ALTER TABLE {preparer.quote('tram_dung')} ADD COLUMN {preparer.quote('nhom_id')} {col_type}"
+        ))
+    _create_index(conn, _table_index(TramDung.__table__, "ix_tram_dung_nhom_id"))
+
+
+def _migrate_route_data_version(conn):
+    # tuyen_xe.data_version (ETag theo tuyến)
+    if "data_version" not in _column_names(conn, "tuyen_xe"):
+        preparer = conn.dialect.identifier_preparer
+        col_type = db.Integer().compile(dialect=conn.dialect)
+        conn.execute(text(
+            f"ALTER TABLE {preparer.quote('tuyen_xe')} ADD COLUMN {preparer.quote('data_version')} "
+            f"{col_type} NOT NULL DEFAULT 1"
+        ))
+
+
+def _migrate_stop_times_unique(conn):
+    # gio_den_tram là bảng dựng lại được: bỏ dòng trùng (giữ id nhỏ nhất) rồi tạo unique index
+    tbl = GioDenTram.__table__
+    keep = db.select(func.min(tbl.c.id).label("id")).group_by(tbl.c.trip_key, tbl.c.tram_id).subquery()
+    conn.execute(tbl.delete().where(tbl.c.id.not_in(db.select(keep.c.id))))
+    _create_index(conn, _table_index(tbl, "idx_stop_times_unique_trip_stop"))
+
+
+# Index cho các query nóng (đọc trạm theo hướng, liệt kê chuyến, soát thẻ)
+IDX_TRIP_ROUTE_DAY_DIR_TIME = db.Index(
+    "idx_trip_route_day_dir_time",
+    ChuyenXe.tuyen_id, ChuyenXe.ngayKhoiHanh, ChuyenXe.huong, ChuyenXe.gioKhoiHanh,
+)
+IDX_STOP_ROUTE_DIR_ORDER = db.Index(
+    "idx_stop_route_dir_order", TramDung.tuyen_id, TramDung.huong, TramDung.thuTuTrenTuyen,
+)
+IDX_CARD_CODE_UPPER = db.Index("idx_card_code_upper", func.upper(TheTu.maSoThe))
+
+# Unique (dữ liệu cũ có thể đang trùng -> bỏ qua index đó, không làm app chết)
+IDX_CARD_CODE_UNIQUE = db.Index("idx_card_code_unique", TheTu.maSoThe, unique=True)
+IDX_TICKET_CODE_UNIQUE = db.Index("idx_ticket_code_unique", VeXe.maSoVe, unique=True)
+# Tránh tạo trùng chuyến theo tuyến/ngày/giờ/hướng
+IDX_TRIP_UNIQUE_DEPARTURE = db.Index(
+    "idx_trip_unique_departure",
+    ChuyenXe.tuyen_id, ChuyenXe.ngayKhoiHanh, ChuyenXe.gioKhoiHanh, ChuyenXe.huong,
+    unique=True,
+)
+# Ngăn double-book ghế (trừ vé đã hủy): partial index, chỉ SQLite/Postgres hỗ trợ
+IDX_TICKET_SEAT_ACTIVE = db.Index(
+    "idx_ve_unique_seat_active", VeXe.chuyen_id, VeXe.soGhe, unique=True,
+    sqlite_where=VeXe.trangThai != "DA_HUY",
+    postgresql_where=VeXe.trangThai != "DA_HUY",
+)
+
+
+def _create_index(conn, idx):
+    with warnings.catch_warnings():
+        # checkfirst phản chiếu index hiện có; SQLAlchemy không đọc được index biểu thức (upper(...))
+        warnings.simplefilter("ignore", SAWarning)
+        idx.create(conn, checkfirst=True)
+
+
+def _create_indexes(conn, *indexes):
+    for idx in indexes:
+        _create_index(conn, idx)
+
+
+def _create_unique_indexes(conn, *indexes):
+    """Tạo từng unique index (savepoint riêng). Trả danh sách lỗi "tên index: lỗi" (rỗng = đủ cả)."""
+    failed = []
+    for idx in indexes:
+        try:
+            with conn.begin_nested():
+                _create_index(conn, idx)
+        except Exception as e:
+            print("migration warning: không tạo được %s (dữ liệu trùng?): %s" % (idx.name, e))
+            failed.append("%s: %s" % (idx.name, str(e).splitlines()[0]))
+    return failed
+
+
+def _migrate_hot_path_indexes(conn):
+    _create_indexes(
+        conn,
+        _table_index(ChuyenXe.__table__, "idx_trip_route_dir_departure"),
+        IDX_TRIP_ROUTE_DAY_DIR_TIME,
+        IDX_STOP_ROUTE_DIR_ORDER,
+        IDX_CARD_CODE_UPPER,
+    )
+
+
+def _migrate_unique_indexes(conn):
+    failed = _create_unique_indexes(conn, IDX_CARD_CODE_UNIQUE, IDX_TICKET_CODE_UNIQUE, IDX_TRIP_UNIQUE_DEPARTURE)
+    if conn.dialect.name in ("sqlite", "postgresql"):
+        failed += _create_unique_indexes(conn, IDX_TICKET_SEAT_ACTIVE)
+    if failed:
+        # index nào tạo được thì giữ; version để pending -> lần start sau (đã dọn dữ liệu trùng) thử lại
+        raise MigrationIncomplete("; ".join(failed))
+
+
+class MigrationIncomplete(Exception):
+    """Migration chạy được 1 phần (vd unique index vướng dữ liệu trùng): giữ phần đã làm, không ghi version."""
+
+
+# version -> lý do còn pending ở lần chạy gần nhất (scripts/migrate_db.py in ra)
+MIGRATION_PENDING_REASONS = {}
+
+# (version, mô tả, hàm(conn)) theo thứ tự chạy; hàm raise MigrationIncomplete = chạy lại lần sau
+MIGRATIONS = [
+    ("0001_trip_departure_column", "chuyen_xe.khoiHanhLuc + backfill", _migrate_trip_departure_column),
+    ("0002_hot_path_indexes", "index chuyến/trạm/mã thẻ cho query nóng", _migrate_hot_path_indexes),
+    ("0003_unique_indexes", "unique mã thẻ/mã vé/chuyến/ghế", _migrate_unique_indexes),
+    ("0004_stop_group_column", "tram_dung.nhom_id + index", _migrate_stop_group_column),
+    ("0005_route_data_version", "tuyen_xe.data_version", _migrate_route_data_version),
+    ("0006_stop_times_unique", "gio_den_tram unique (trip_key, tram_id)", _migrate_stop_times_unique),
+]
+
+
+def applied_migrations():
+    return {
+        version: applied_at
+        for (version, applied_at) in db.session.query(SchemaMigration.version, SchemaMigration.applied_at).all()
+    }
+
+
+def run_migrations():
+    """Chạy các migration chưa có trong schema_migrations. Trả danh sách version vừa chạy."""
+    done = set(applied_migrations())
+    db.session.rollback()  # nhả transaction đọc trước khi DDL (SQLite khóa cả file)
+
+    ran = []
+    mig_tbl = SchemaMigration.__table__
+    for version, description, fn in MIGRATIONS:
+        if version in done:
+            continue
+        MIGRATION_PENDING_REASONS.pop(version, None)
+        try:
+            with db.engine.begin() as conn:
+                try:
+                    fn(conn)
+                except MigrationIncomplete as e:
+                    # commit phần đã làm, không ghi version; các migration sau vẫn chạy
+                    MIGRATION_PENDING_REASONS[version] = str(e)
+                    print("migration %s incomplete: %s" % (version, e))
+                    continue
+                conn.execute(mig_tbl.insert().values(
+                    version=version, description=description, applied_at=datetime.utcnow(),
+                ))
+        except IntegrityError:
+            # worker khác vừa chạy xong migration này
+            continue
+        except Exception as e:
+            # dừng ở đây để các migration sau không chạy trên schema thiếu; lần start sau thử lại
+            print("migration %s warning: %s" % (version, e))
+            break
+        ran.append(version)
+    return ran
 
-            # Ngăn double-book ghế (trừ ghế đã hủy)
-            try:
-                conn.execute(text("""
-                  CREATE UNIQUE INDEX IF NOT EXISTS idx_ve_unique_seat_active
-                  ON ve_xe (chuyen_id, soGhe)
-                  WHERE trangThai != 'DA_HUY'
-                """))
-            except Exception:
-                pass
-    except Exception as e:
-        print("ensure_schema warning:", e)
 
 with app.app_context():
-    ensure_schema()
+    run_migrations()
 
 
 # ==================== HÀM TIỆN ÍCH ====================
@@ -341,6 +941,47 @@ def ensure_customer(user):
     return kh
 
 
+_LEASE_OWNER = f"{os.uname().nodename if hasattr(os, 'uname') else 'local'}:{os.getpid()}"
+
+
+def try_acquire_lease(name, ttl_sec):
+    """Lấy (hoặc gia hạn) lease `name` trong ttl_sec giây. True nếu process này đang giữ lease."""
+    tbl = AppLease.__table__
+    now_ts = time.time()
+    try:
+        with db.engine.begin() as conn:
+            res = conn.execute(
+                tbl.update()
+                .where(tbl.c.ten == name, or_(tbl.c.expires_ts < now_ts, tbl.c.owner == _LEASE_OWNER))
+                .values(owner=_LEASE_OWNER, expires_ts=now_ts + ttl_sec)
+            )
+            if res.rowcount == 1:
+                return True
+        with db.engine.begin() as conn:
+            conn.execute(tbl.insert().values(ten=name, owner=_LEASE_OWNER, expires_ts=now_ts + ttl_sec))
+        return True
+    except IntegrityError:
+        # worker khác đang giữ lease
+        return False
+    except Exception as e:
+        print("lease warning:", e)
+        return False
+
+
+def release_lease(name):
+    tbl = AppLease.__table__
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(tbl.delete().where(tbl.c.ten == name, tbl.c.owner == _LEASE_OWNER))
+    except Exception as e:
+        print("lease release warning:", e)
+
+
+def card_by_code_query(code):
+    # so khớp không phân biệt hoa/thường, dùng index idx_card_code_upper
+    return TheTu.query.filter(func.upper(TheTu.maSoThe) == (code or "").strip().upper())
+
+
 def generate_card_code():
     # sinh mã ngẫu nhiên 10 ký tự (không lộ timestamp)
     import random
@@ -349,6 +990,17 @@ def generate_card_code():
     return f"SB-{core}"
 
 
+def haversine_m(lat1, lon1, lat2, lon2):
+    """Khoảng cách mặt cầu (mét) giữa 2 điểm lat/lng."""
+    r = 6371000.0
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    dphi = math.radians(lat2 - lat1)
+    dl = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dl / 2) ** 2
+    return 2 * r * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+
+
 def normalize_direction(value):
     v = (value or "DI").strip().upper()
     return v if v in ("DI", "VE") else "DI"
@@ -417,94 +1069,430 @@ def _compute_headway_minutes(tuyen, window_minutes, dirs_count=2):
     return None
 
 
-def ensure_upcoming_trips(tuyen, now=None, horizon_min=None):
-    """
-    Bus đô thị: tự sinh chuyến sắp tới theo khung giờ + tần suất.
-    - Chỉ sinh trong khoảng [now, now + horizon] để tránh DB phình to.
-    - Sinh theo hướng DI/VE nếu tuyến có dữ liệu trạm cho hướng đó.
-    """
-    if not tuyen:
-        return 0
+def _departure_minutes(start_min, end_min, headway, from_min, to_min):
+    """Các mốc xuất bến (phút trong ngày) trong [from_min, to_min], căn theo headway tính từ start_min."""
+    from_min = max(start_min, from_min)
+    to_min = min(end_min, to_min)
+    if to_min < from_min or headway <= 0:
+        return []
+
+    offset = (from_min - start_min) % headway
+    first = from_min if offset == 0 else (from_min + (headway - offset))
+    return list(range(first, to_min + 1, headway))
 
-    now = now or datetime.now()
-    horizon_min = BUS_SCHEDULE_HORIZON_MIN if horizon_min is None else int(horizon_min)
-    horizon_min = max(30, min(horizon_min, 24 * 60))
 
+def route_timetable(tuyen, dirs):
+    """
+    (start_min, end_min, headway) của tuyến: mọi chuyến trong ngày là start_min + k*headway <= end_min.
+    `dirs`: các hướng có dữ liệu trạm. Trả None nếu tuyến thiếu khung giờ/tần suất.
+    """
     window = _parse_operating_window_minutes(tuyen.thoiGianHoatDong)
-    if not window:
-        return 0
+    if not window or not dirs:
+        return None
     start_min, end_min = window
-    window_minutes = end_min - start_min
-
-    # xác định hướng có dữ liệu trạm
-    dirs = []
-    for d in ("DI", "VE"):
-        st = stop_stats_for_direction(tuyen, d)
-        if st.get("stops", 0) > 0:
-            dirs.append(d)
-
-    if not dirs:
-        return 0
 
     # nếu chỉ có 1 hướng dữ liệu, vẫn hiểu là tuyến 2 chiều (DI+VE) để tính headway từ "số chuyến/ngày"
     dirs_count_for_schedule = 2 if len(dirs) == 1 else len(dirs)
-
-    headway = _compute_headway_minutes(tuyen, window_minutes, dirs_count=dirs_count_for_schedule)
+    headway = _compute_headway_minutes(tuyen, end_min - start_min, dirs_count=dirs_count_for_schedule)
     if not headway:
-        return 0
+        return None
+    return (start_min, end_min, headway)
+
+
+def _plan_route_departures(tuyen, dirs, now, horizon_min):
+    """
+    Tính (date_str, [(huong, "HH:MM"), ...]) cần có trong [now, now + horizon] cho 1 tuyến.
+    `dirs`: các hướng có dữ liệu trạm. Trả None nếu tuyến thiếu khung giờ/tần suất.
+    """
+    timetable = route_timetable(tuyen, dirs)
+    if not timetable:
+        return None
+    start_min, end_min, headway = timetable
 
     # chỉ sinh cho hôm nay (demo). Nếu muốn: mở rộng sang ngày kế tiếp.
-    date_str = now.strftime("%Y-%m-%d")
     now_min = now.hour * 60 + now.minute
+    minutes = _departure_minutes(start_min, end_min, headway, now_min, now_min + horizon_min)
+    times = [f"{t // 60:02d}:{t % 60:02d}" for t in minutes]
+    return now.strftime("%Y-%m-%d"), [(d, gio) for d in dirs for gio in times]
 
-    from_min = max(start_min, now_min)
-    to_min = min(end_min, from_min + horizon_min)
-    if to_min < from_min:
-        return 0
 
-    # căn về mốc headway tính từ start_min
-    offset = (from_min - start_min) % headway
-    first = from_min if offset == 0 else (from_min + (headway - offset))
+def materialize_upcoming_trips(now=None, horizon_min=None, backfill_min=None):
+    """
+    Sinh chuyến cho MỌI tuyến trong 1 lượt (job nền, không chạy trong request GET):
+    - 1 query đếm trạm theo tuyến/hướng, 1 query chuyến đã có trong ngày, 1 lần INSERT + COMMIT.
+    - Lùi `backfill_min` phút để trang trạm vẫn thấy chuyến đã xuất bến nhưng chưa tới trạm.
+    Trả số chuyến mới.
+    """
+    return len(_materialize_upcoming_trips(now=now, horizon_min=horizon_min, backfill_min=backfill_min))
 
-    times = []
-    t = first
-    while t <= to_min:
-        times.append(f"{t // 60:02d}:{t % 60:02d}")
-        t += headway
 
-    if not times:
-        return 0
+def _materialize_upcoming_trips(now=None, horizon_min=None, backfill_min=None):
+    """Như `materialize_upcoming_trips` nhưng trả [(tuyen_id, huong, giờ xuất bến)] của các chuyến mới."""
+    now = now or datetime.now()
+    backfill_min = BUS_SCHEDULER_BACKFILL_MIN if backfill_min is None else int(backfill_min)
+    horizon_min = BUS_SCHEDULE_HORIZON_MIN if horizon_min is None else int(horizon_min)
+    start = now - timedelta(minutes=backfill_min)
+    if start.date() != now.date():
+        start = datetime.combine(now.date(), datetime.min.time())
+    span_min = max(30, min(int((now - start).total_seconds() // 60) + horizon_min, 24 * 60))
+
+    dirs_by_route = {
+        tuyen_id: [d for d in ("DI", "VE") if stats[d]["stops"] > 0]
+        for tuyen_id, stats in stop_stats_by_route().items()
+    }
 
-    existing = (
-        ChuyenXe.query
-        .filter(ChuyenXe.tuyen_id == tuyen.maTuyen, ChuyenXe.ngayKhoiHanh == date_str)
-        .with_entities(ChuyenXe.gioKhoiHanh, ChuyenXe.huong)
-        .all()
-    )
-    existing_set = {(normalize_direction(h), g) for (g, h) in existing if g}
+    date_str = start.strftime("%Y-%m-%d")
+    existing_set = {
+        (tuyen_id, normalize_direction(h), g)
+        for (tuyen_id, g, h) in (
+            ChuyenXe.query
+            .filter(ChuyenXe.ngayKhoiHanh == date_str)
+            .with_entities(ChuyenXe.tuyen_id, ChuyenXe.gioKhoiHanh, ChuyenXe.huong)
+            .all()
+        )
+        if g
+    }
 
     new_rows = []
-    for d in dirs:
-        for gio in times:
-            key = (d, gio)
-            if key in existing_set:
-                continue
-            new_rows.append(
-                ChuyenXe(tuyen_id=tuyen.maTuyen, ngayKhoiHanh=date_str, gioKhoiHanh=gio, huong=d)
-            )
+    for tuyen in TuyenXe.query.order_by(TuyenXe.maTuyen).all():
+        dirs = sorted(dirs_by_route.get(tuyen.maTuyen) or [])
+        plan = _plan_route_departures(tuyen, dirs, start, span_min)
+        if not plan:
+            continue
+        for (d, gio) in plan[1]:
+            if (tuyen.maTuyen, d, gio) not in existing_set:
+                new_rows.append(ChuyenXe(tuyen_id=tuyen.maTuyen, ngayKhoiHanh=plan[0], gioKhoiHanh=gio, huong=d))
 
     if not new_rows:
-        return 0
+        return []
 
+    created = [(t.tuyen_id, t.huong, parse_trip_departure(t.ngayKhoiHanh, t.gioKhoiHanh)) for t in new_rows]
     db.session.add_all(new_rows)
     try:
         db.session.commit()
-    except Exception:
+    except IntegrityError:
+        # node khác vừa sinh trùng (hiếm vì có lease): lượt sau sẽ bù phần còn thiếu
         db.session.rollback()
-        # Nếu đụng unique index do race condition, bỏ qua.
-        return 0
+        return []
+
+    return created
+
+
+def _pick_time(fn, a, b):
+    # min/max giữa 2 giờ "HH:MM", bỏ qua None
+    vals = [x for x in (a, b) if x]
+    return fn(vals) if vals else None
+
+
+def _merge_trip_summaries(conn, rows):
+    """Cộng dồn các chuyến (maChuyen, tuyen_id, ngay, gio, huong, khoiHanhLuc) vào tong_hop_chuyen_ngay."""
+    agg = {}
+    for (_, tuyen_id, ngay, gio, huong, depart_dt) in rows:
+        gio = depart_dt.strftime("%H:%M") if depart_dt else gio
+        key = (tuyen_id, ngay, normalize_direction(huong))
+        cur = agg.setdefault(key, [0, None, None])
+        cur[0] += 1
+        cur[1] = _pick_time(min, cur[1], gio)
+        cur[2] = _pick_time(max, cur[2], gio)
+
+    sum_tbl = TongHopChuyenNgay.__table__
+    now = datetime.utcnow()
+    for (tuyen_id, ngay, huong), (n, first, last) in agg.items():
+        where = db.and_(sum_tbl.c.tuyen_id == tuyen_id, sum_tbl.c.ngay == ngay, sum_tbl.c.huong == huong)
+        existing = conn.execute(
+            db.select(sum_tbl.c.id, sum_tbl.c.so_chuyen, sum_tbl.c.gio_dau, sum_tbl.c.gio_cuoi).where(where)
+        ).first()
+        if existing is None:
+            conn.execute(sum_tbl.insert().values(
+                tuyen_id=tuyen_id, ngay=ngay, huong=huong, so_chuyen=n, gio_dau=first, gio_cuoi=last, updated_at=now,
+            ))
+        else:
+            conn.execute(sum_tbl.update().where(sum_tbl.c.id == existing.id).values(
+                so_chuyen=(existing.so_chuyen or 0) + n,
+                gio_dau=_pick_time(min, existing.gio_dau, first),
+                gio_cuoi=_pick_time(max, existing.gio_cuoi, last),
+                updated_at=now,
+            ))
+
+
+def archive_past_trips(retention_days=None, mode=None, batch_size=500, now=None):
+    """
+    Dọn chuyen_xe: chuyến xuất bến trước (hôm nay - retention_days) và KHÔNG có vé (VeXe) tham chiếu.
+    - mode "summary": gộp số chuyến/giờ đầu/giờ cuối vào tong_hop_chuyen_ngay rồi xóa.
+    - mode "delete": chỉ xóa.
+    Xóa theo lô `batch_size` (mỗi lô 1 transaction) để không giữ khóa ghi lâu. Trả số chuyến đã dọn.
+    """
+    now = now or datetime.now()
+    retention_days = TRIP_RETENTION_DAYS if retention_days is None else int(retention_days)
+    mode = (mode or TRIP_ARCHIVE_MODE).strip().lower()
+    if mode not in ("summary", "delete"):
+        raise ValueError("TRIP_ARCHIVE_MODE phải là summary hoặc delete")
+    cutoff = datetime.combine((now - timedelta(days=max(0, retention_days))).date(), datetime.min.time())
+
+    trip_tbl = ChuyenXe.__table__
+    ticket_tbl = VeXe.__table__
+    no_ticket = ~db.exists().where(ticket_tbl.c.chuyen_id == trip_tbl.c.maChuyen)
+    is_old = or_(
+        trip_tbl.c.khoiHanhLuc < cutoff,
+        # chuyến cũ chưa parse được khoiHanhLuc: so chuỗi YYYY-MM-DD
+        db.and_(trip_tbl.c.khoiHanhLuc.is_(None), trip_tbl.c.ngayKhoiHanh < cutoff.strftime("%Y-%m-%d")),
+    )
+    cols = (
+        trip_tbl.c.maChuyen, trip_tbl.c.tuyen_id, trip_tbl.c.ngayKhoiHanh,
+        trip_tbl.c.gioKhoiHanh, trip_tbl.c.huong, trip_tbl.c.khoiHanhLuc,
+    )
+
+    archived = 0
+    while True:
+        with db.engine.begin() as conn:
+            rows = conn.execute(
+                db.select(*cols).where(is_old, no_ticket).order_by(trip_tbl.c.maChuyen).limit(batch_size)
+            ).fetchall()
+            if not rows:
+                break
+
+            ids = [r[0] for r in rows]
+            # kiểm tra lại "không có vé" ngay lúc xóa: vé vừa gắn vào chuyến thì chuyến đó được giữ
+            deleted = conn.execute(trip_tbl.delete().where(trip_tbl.c.maChuyen.in_(ids), no_ticket)).rowcount
+            if deleted != len(ids):
+                kept = {
+                    r[0] for r in conn.execute(db.select(trip_tbl.c.maChuyen).where(trip_tbl.c.maChuyen.in_(ids)))
+                }
+                rows = [r for r in rows if r[0] not in kept]
+            if mode == "summary":
+                _merge_trip_summaries(conn, rows)
+            bump_route_data_versions(conn, {r[1] for r in rows})
+
+        archived += len(rows)
+        if len(ids) < batch_size:
+            break
+    return archived
+
+
+class _LeasedJob(abc.ABC):
+    """
+    Thread nền chạy `work()` định kỳ (lớp con bắt buộc cài `work`). Mỗi worker đều chạy thread này nhưng chỉ worker giữ lease
+    `LEASE_NAME` mới làm việc, nên request GET không bao giờ phải INSERT/COMMIT (SQLite khóa ghi cả DB).
+    """
+
+    LEASE_NAME = None
+
+    def __init__(self, interval_sec):
+        self.interval_sec = max(10, int(interval_sec))
+        self._thread = None
+        self._lock = threading.Lock()
+        self.runs = 0
+        self.last_run_at = None
+        self.last_result = None
+
+    @abc.abstractmethod
+    def work(self):
+        """Một lượt việc (đã giữ lease); giá trị trả về lưu vào `last_result`."""
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._loop, name=self.LEASE_NAME, daemon=True)
+            self._thread.start()
+
+    def run_once(self):
+        # lease dài hơn vài chu kỳ: worker đang giữ chết thì worker khác tiếp quản
+        if not try_acquire_lease(self.LEASE_NAME, self.interval_sec * 3):
+            return None
+        result = self.work()
+        self.runs += 1
+        self.last_run_at = datetime.now().isoformat(timespec="seconds")
+        self.last_result = result
+        return result
+
+    def _loop(self):
+        while True:
+            try:
+                with app.app_context():
+                    self.run_once()
+            except Exception as e:
+                print("%s warning: %s" % (self.LEASE_NAME, e))
+            time.sleep(self.interval_sec)
+
+
+class _TripScheduler(_LeasedJob):
+    """Sinh chuyến trước horizon cho mọi tuyến (chỉ khi tắt lịch ảo)."""
+
+    LEASE_NAME = "trip_scheduler"
+
+    def work(self):
+        created = _materialize_upcoming_trips()
+        if created and STOP_TIMES_ENABLED:
+            # chuyến mới có thể rơi vào vùng gio_den_tram đã dựng -> chỉ ghi thêm dòng cho tuyến/hướng đó
+            add_trip_stop_times(created)
+        return len(created)
+
+
+class _StopTimesBuilder(_LeasedJob):
+    """Nối tiếp bảng gio_den_tram theo horizon (xem `extend_stop_times`)."""
+
+    LEASE_NAME = "stop_times"
+
+    def work(self):
+        return extend_stop_times()
+
+
+class _TripArchiver(_LeasedJob):
+    """Dọn chuyến cũ không có vé khỏi chuyen_xe (xem `archive_past_trips`)."""
+
+    LEASE_NAME = "trip_archiver"
+
+    def work(self):
+        return archive_past_trips()
+
+
+_TRIP_SCHEDULER = _TripScheduler(BUS_SCHEDULER_INTERVAL_SEC)
+_TRIP_ARCHIVER = _TripArchiver(TRIP_ARCHIVE_INTERVAL_SEC or 3600)
+_STOP_TIMES_BUILDER = _StopTimesBuilder(BUS_SCHEDULER_INTERVAL_SEC)
+
+
+@app.before_request
+def _start_background_jobs():
+    # start lazy trong worker đang phục vụ (không start khi script chỉ import app)
+    # Lịch ảo bật thì không cần sinh sẵn chuyến vào chuyen_xe.
+    if BUS_SCHEDULER_ENABLED and not BUS_VIRTUAL_TIMETABLE:
+        _TRIP_SCHEDULER.start()
+    if TRIP_ARCHIVE_INTERVAL_SEC > 0:
+        _TRIP_ARCHIVER.start()
+    if STOP_TIMES_ENABLED:
+        _STOP_TIMES_BUILDER.start()
+
+
+# Chuyến trong lịch (ảo hoặc có thật trong chuyen_xe). `trip_id`: maChuyen (int) hoặc token "v..." (chuyến ảo).
+Departure = namedtuple("Departure", "trip_id tuyen_id huong date time depart_dt virtual")
+
+_VIRTUAL_TRIP_RE = re.compile(r"^v(\d+)-(DI|VE)-(\d{8})-(\d{4})$")
+
+
+def virtual_trip_token(tuyen_id, huong, depart_dt):
+    """ID ổn định của chuyến ảo: v{tuyen}-{DI|VE}-{YYYYMMDD}-{HHMM} (không cần dòng trong DB)."""
+    return "v%d-%s-%s" % (int(tuyen_id), normalize_direction(huong), depart_dt.strftime("%Y%m%d-%H%M"))
+
+
+def parse_virtual_trip_token(token):
+    """Token chuyến ảo -> (tuyen_id, huong, depart_dt) hoặc None nếu sai định dạng."""
+    m = _VIRTUAL_TRIP_RE.match(str(token or "").strip())
+    if not m:
+        return None
+    try:
+        depart_dt = datetime.strptime(m.group(3) + m.group(4), "%Y%m%d%H%M")
+    except ValueError:
+        return None
+    return int(m.group(1)), m.group(2), depart_dt
 
-    return len(new_rows)
+
+def route_active_dirs(tuyen):
+    stats = route_stop_stats(tuyen)
+    return [d for d in ("DI", "VE") if stats[d]["stops"] > 0]
+
+
+def _override_trips_query(tuyen_id, dir_, end_dt):
+    q = ChuyenXe.query.filter(ChuyenXe.tuyen_id == tuyen_id, ChuyenXe.khoiHanhLuc <= end_dt)
+    if dir_ == "DI":
+        q = q.filter(or_(ChuyenXe.huong == "DI", ChuyenXe.huong.is_(None)))
+    else:
+        q = q.filter(ChuyenXe.huong == "VE")
+    return q.order_by(ChuyenXe.khoiHanhLuc.asc(), ChuyenXe.maChuyen.asc())
+
+
+def _iter_override_trips(tuyen_id, dir_, start_dt, end_dt, page_size=32):
+    """
+    Chuyến thật (sửa tay/có vé) của 1 hướng trong [start_dt, end_dt], theo khoiHanhLuc, sinh lazy:
+    đọc từng trang bằng index (tuyen_id, huong, khoiHanhLuc) + keyset, dừng sớm khi caller đủ N chuyến.
+    """
+    q = _override_trips_query(tuyen_id, dir_, end_dt)
+
+    last = None
+    while True:
+        if last is None:
+            page = q.filter(ChuyenXe.khoiHanhLuc >= start_dt).limit(page_size).all()
+        else:
+            page = q.filter(or_(
+                ChuyenXe.khoiHanhLuc > last[0],
+                db.and_(ChuyenXe.khoiHanhLuc == last[0], ChuyenXe.maChuyen > last[1]),
+            )).limit(page_size).all()
+        for t in page:
+            yield t
+        if len(page) < page_size:
+            return
+        last = (page[-1].khoiHanhLuc, page[-1].maChuyen)
+
+
+def _virtual_departure_times(timetable, start_dt, end_dt):
+    """Sinh lazy các giờ xuất bến theo headway trong [start_dt, end_dt] (có thể qua nhiều ngày)."""
+    start_min, end_min, headway = timetable
+    day = start_dt.date()
+    while day <= end_dt.date():
+        day_start = datetime.combine(day, datetime.min.time())
+        from_min = max(0, _ceil_div_int(int((start_dt - day_start).total_seconds()), 60))
+        to_min = min(24 * 60 - 1, int((end_dt - day_start).total_seconds() // 60))
+        for m in _departure_minutes(start_min, end_min, headway, from_min, to_min):
+            yield day_start + timedelta(minutes=m)
+        day += timedelta(days=1)
+
+
+def iter_departures(tuyen, dir_, start_dt, end_dt, timetable=None):
+    """
+    Chuyến của 1 hướng trong [start_dt, end_dt], theo thứ tự giờ xuất bến, sinh lazy.
+    - Chuyến ảo tính từ `timetable` (route_timetable); None = chỉ đọc chuyen_xe (chế độ cũ).
+    - Chuyến thật cùng giờ thay thế chuyến ảo (sửa tay/đã có vé).
+    """
+    dir_ = normalize_direction(dir_)
+    # (depart_dt, 0, ChuyenXe) xếp trước (depart_dt, 1, None) cùng giờ -> chuyến thật che chuyến ảo
+    real = ((t.khoiHanhLuc, 0, t) for t in _iter_override_trips(tuyen.maTuyen, dir_, start_dt, end_dt))
+    virtual = ((dt, 1, None) for dt in _virtual_departure_times(timetable, start_dt, end_dt)) if timetable else ()
+
+    last_real = None
+    for depart_dt, _, t in heapq.merge(real, virtual, key=lambda x: (x[0], x[1])):
+        date_str = depart_dt.strftime("%Y-%m-%d")
+        gio = depart_dt.strftime("%H:%M")
+        if t is not None:
+            last_real = depart_dt
+            yield Departure(t.maChuyen, tuyen.maTuyen, dir_, date_str, gio, depart_dt, False)
+        elif depart_dt != last_real:
+            token = virtual_trip_token(tuyen.maTuyen, dir_, depart_dt)
+            yield Departure(token, tuyen.maTuyen, dir_, date_str, gio, depart_dt, True)
+
+
+def upcoming_departures(tuyen, start_dt, end_dt, dirs=("DI", "VE")):
+    """Gộp (heap merge) chuyến của các hướng theo (giờ xuất bến, hướng); dùng islice để lấy N chuyến đầu."""
+    active = route_active_dirs(tuyen)
+    timetable = route_timetable(tuyen, active) if BUS_VIRTUAL_TIMETABLE else None
+    streams = [
+        iter_departures(tuyen, d, start_dt, end_dt, timetable=timetable if d in active else None)
+        for d in dirs
+    ]
+    return heapq.merge(*streams, key=lambda dep: (dep.depart_dt, dep.huong))
+
+
+def departure_detail_url(dep):
+    if dep.virtual:
+        return url_for("virtual_trip_detail", token=dep.trip_id)
+    return url_for("trip_detail", trip_id=dep.trip_id)
+
+
+def resolve_virtual_trip(token):
+    """
+    Token -> (tuyen, Departure) nếu đúng là 1 chuyến trong lịch, ngược lại None.
+    Nếu giờ đó đã có chuyến thật thì Departure trả về là chuyến thật (virtual=False).
+    """
+    parsed = parse_virtual_trip_token(token)
+    if not parsed:
+        return None
+    tuyen_id, huong, depart_dt = parsed
+    tuyen = TuyenXe.query.get(tuyen_id)
+    if not tuyen:
+        return None
+    dep = next(iter(upcoming_departures(tuyen, depart_dt, depart_dt, dirs=(huong,))), None)
+    if not dep:
+        return None
+    return tuyen, dep
 
 
 def parse_route_price(tuyen, fallback=50000):
@@ -553,12 +1541,17 @@ def _query_stops_by_direction(tuyen, dir_):
     return q.order_by(TramDung.thuTuTrenTuyen.asc(), TramDung.maTram.asc())
 
 
-def stop_stats_for_direction(tuyen, dir_):
-    stops = _query_stops_by_direction(tuyen, dir_).all()
-    total = len(stops)
-    with_geo = sum(1 for s in stops if s.lat is not None and s.lng is not None)
-    percent = round((with_geo * 100.0) / total, 1) if total else 0.0
+def _stop_direction_expr():
+    # DI gồm cả huong NULL (dữ liệu cũ), giống _query_stops_by_direction
+    return db.case(
+        (TramDung.huong == "VE", "VE"),
+        (or_(TramDung.huong == "DI", TramDung.huong.is_(None)), "DI"),
+        else_=None,
+    )
 
+
+def _stop_stats_dict(dir_, total, with_geo):
+    percent = round((with_geo * 100.0) / total, 1) if total else 0.0
     return {
         "direction": dir_,
         "stops": total,
@@ -568,8 +1561,41 @@ def stop_stats_for_direction(tuyen, dir_):
     }
 
 
-def build_route_summary(tuyen):
-    dir_stats = {d: stop_stats_for_direction(tuyen, d) for d in ("DI", "VE")}
+def stop_stats_by_route(route_ids=None):
+    """
+    Thống kê trạm DI/VE của nhiều tuyến bằng 1 query GROUP BY (tuyen_id, hướng), không load TramDung.
+    Trả {tuyen_id: {"DI": {...}, "VE": {...}}}; `route_ids=None` = mọi tuyến có trạm.
+    """
+    dir_expr = _stop_direction_expr()
+    has_geo = db.case((db.and_(TramDung.lat.isnot(None), TramDung.lng.isnot(None)), 1), else_=None)
+    q = db.session.query(TramDung.tuyen_id, dir_expr, func.count(TramDung.maTram), func.count(has_geo))
+    if route_ids is not None:
+        q = q.filter(TramDung.tuyen_id.in_(list(route_ids)))
+
+    counts = {}
+    for tuyen_id, d, total, with_geo in q.group_by(TramDung.tuyen_id, dir_expr).all():
+        if d:
+            counts[(tuyen_id, d)] = (int(total or 0), int(with_geo or 0))
+
+    ids = set(route_ids) if route_ids is not None else {tuyen_id for (tuyen_id, _) in counts}
+    return {
+        tuyen_id: {d: _stop_stats_dict(d, *counts.get((tuyen_id, d), (0, 0))) for d in ("DI", "VE")}
+        for tuyen_id in ids
+    }
+
+
+def route_stop_stats(tuyen):
+    return stop_stats_by_route([tuyen.maTuyen])[tuyen.maTuyen]
+
+
+def stop_stats_for_direction(tuyen, dir_):
+    return route_stop_stats(tuyen)[normalize_direction(dir_)]
+
+
+def build_route_summary(tuyen, dir_stats=None):
+    """`dir_stats`: kết quả stop_stats_by_route đã tính sẵn (trang tổng hợp nhiều tuyến)."""
+    if dir_stats is None:
+        dir_stats = route_stop_stats(tuyen)
     total_stops = sum(s["stops"] for s in dir_stats.values())
     total_geo = sum(s["with_geo"] for s in dir_stats.values())
     percent = round((total_geo * 100.0) / total_stops, 1) if total_stops else 0.0
@@ -604,6 +1630,223 @@ def _ceil_div_int(n, d):
     return -(-n // d)
 
 
+# Bản ghi trạm gọn, bất biến để cache (không giữ ORM instance/session qua các request)
+StopRow = namedtuple("StopRow", "maTram tenTram diaChi thuTuTrenTuyen lat lng huong")
+
+
+def _load_stop_rows(tuyen, dir_):
+    q = _query_stops_by_direction(tuyen, dir_).with_entities(
+        TramDung.maTram,
+        TramDung.tenTram,
+        TramDung.diaChi,
+        TramDung.thuTuTrenTuyen,
+        TramDung.lat,
+        TramDung.lng,
+        TramDung.huong,
+    )
+    return [StopRow(*r) for r in q.all()]
+
+
+class _LruTtlCache:
+    """
+    Cache LRU có giới hạn số entry + TTL, an toàn khi dùng nhiều thread.
+    - `group`: các key cùng group chỉ giữ bản mới nhất (vd: signature cũ của cùng tuyến/hướng).
+    - Đếm hit/miss/evict để theo dõi.
+    """
+
+    def __init__(self, max_entries, ttl_sec):
+        self.max_entries = max(1, int(max_entries))
+        self.ttl_sec = ttl_sec
+        self._data = OrderedDict()
+        self._groups = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self.superseded = 0
+
+    def _drop(self, key):
+        entry = self._data.pop(key, None)
+        if entry is not None and entry["group"] is not None and self._groups.get(entry["group"]) == key:
+            del self._groups[entry["group"]]
+        return entry
+
+    def get(self, key, now_ts=None):
+        now_ts = time.time() if now_ts is None else now_ts
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if (now_ts - entry["ts"]) >= entry["ttl"]:
+                self.expired += 1
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry["value"]
+
+    def peek(self, key):
+        """Lấy entry kể cả khi đã hết hạn (dùng làm giá trị stale), không tính vào counter."""
+        with self._lock:
+            entry = self._data.get(key)
+            return entry["value"] if entry is not None else None
+
+    def set(self, key, value, ts=None, ttl=None, group=None):
+        with self._lock:
+            if group is not None:
+                old_key = self._groups.get(group)
+                if old_key is not None and old_key != key and old_key in self._data:
+                    self._drop(old_key)
+                    self.superseded += 1
+                self._groups[group] = key
+            self._data[key] = {
+                "value": value,
+                "ts": time.time() if ts is None else ts,
+                "ttl": self.ttl_sec if ttl is None else ttl,
+                "group": group,
+            }
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                oldest = next(iter(self._data))
+                self._drop(oldest)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._groups.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "size": len(self._data),
+                "max_entries": self.max_entries,
+                "ttl_sec": self.ttl_sec,
+                "hits": self.hits,
+                "misses": self.misses,
+                "expired": self.expired,
+                "evictions": self.evictions,
+                "superseded": self.superseded,
+            }
+
+
+_STOP_OFFSET_CACHE = _LruTtlCache(STOP_OFFSET_CACHE_MAX_ENTRIES, max(30, int(STOP_OFFSET_CACHE_TTL_SEC)))
+
+
+class _SingleFlight:
+    """
+    Gộp các lời gọi trùng key trong cùng process: 1 thread tính, các thread khác
+    nhận luôn giá trị stale (nếu có) hoặc chờ kết quả của thread đang tính.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.coalesced = 0
+
+    def do(self, key, fn, stale=None, wait_timeout=None):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = {"event": threading.Event(), "value": None, "error": None}
+                self._calls[key] = call
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            if stale is not None:
+                return stale
+            if call["event"].wait(wait_timeout) and call["error"] is None:
+                return call["value"]
+            # leader lỗi/quá lâu: tự tính để không treo request
+            return fn()
+
+        try:
+            call["value"] = fn()
+            return call["value"]
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call["event"].set()
+
+
+_STOP_OFFSET_FLIGHT = _SingleFlight()
+
+
+class _BackgroundRefresher:
+    """
+    Thread pool nhỏ chạy job làm mới cache ở nền (có app context).
+    - Dedup theo key: key đang chờ/chạy thì không submit lại.
+    - Hàng đợi có giới hạn: quá `queue_max` job thì bỏ (request sau sẽ submit lại).
+    """
+
+    def __init__(self, workers, queue_max, name):
+        self.workers = max(1, int(workers))
+        self.queue_max = max(1, int(queue_max))
+        self.name = name
+        self._executor = None
+        self._pending = set()
+        self._lock = threading.Lock()
+        self.submitted = 0
+        self.deduped = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def submit(self, key, fn):
+        with self._lock:
+            if key in self._pending:
+                self.deduped += 1
+                return False
+            if len(self._pending) >= self.queue_max:
+                self.dropped += 1
+                return False
+            if self._executor is None:
+                # tạo lazy để mỗi worker gunicorn (sau fork) có pool riêng
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=self.name)
+            self._pending.add(key)
+            self.submitted += 1
+
+        def run():
+            try:
+                with app.app_context():
+                    fn()
+            except Exception as e:
+                self.failed += 1
+                print(f"{self.name} warning:", e)
+            finally:
+                with self._lock:
+                    self._pending.discard(key)
+
+        self._executor.submit(run)
+        return True
+
+    def stats(self):
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "queue_max": self.queue_max,
+                "pending": len(self._pending),
+                "submitted": self.submitted,
+                "deduped": self.deduped,
+                "dropped": self.dropped,
+                "failed": self.failed,
+            }
+
+
+_STOP_OFFSET_REFRESHER = _BackgroundRefresher(
+    STOP_OFFSET_REFRESH_WORKERS, STOP_OFFSET_REFRESH_QUEUE_MAX, "offset-refresh"
+)
+# Ghi cache L2 (offset, leg OSRM, geometry) ở 1 thread nền: request GET chỉ đọc DB, không giữ khóa ghi
+# (SQLite khóa ghi cả file). Hàng đợi đầy thì bỏ lượt ghi, lần miss sau ghi lại.
+_CACHE_WRITER = _BackgroundRefresher(1, 1024, "cache-write")
+
+
 def _stops_signature(stops):
     payload = [
         (
@@ -621,17 +1864,8 @@ def _stops_signature(stops):
 def _compute_stop_offsets_fallback(coord_stops):
     """
     Fallback tính offset theo khoảng cách Haversine + tốc độ trung bình.
-    coord_stops: list TramDung có lat/lng theo thứ tự.
+    coord_stops: list trạm (StopRow/TramDung) có lat/lng theo thứ tự.
     """
-    def haversine_m(lat1, lon1, lat2, lon2):
-        r = 6371000.0
-        phi1 = math.radians(lat1)
-        phi2 = math.radians(lat2)
-        dphi = math.radians(lat2 - lat1)
-        dl = math.radians(lon2 - lon1)
-        a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dl / 2) ** 2
-        return 2 * r * math.atan2(math.sqrt(a), math.sqrt(1 - a))
-
     speed_mps = max(3.0, float(BUS_FALLBACK_SPEED_KMH) * 1000.0 / 3600.0)
     offsets = {coord_stops[0].maTram: 0}
     dist_acc = {coord_stops[0].maTram: 0.0}
@@ -651,15 +1885,328 @@ def _compute_stop_offsets_fallback(coord_stops):
     return offsets, dist_acc
 
 
+def _offset_payload_dump(value, coord_stops):
+    rows = []
+    for s in coord_stops:
+        rows.append([
+            int(s.maTram),
+            value["offsets"].get(s.maTram),
+            value["dist_m"].get(s.maTram),
+        ])
+    return json.dumps({"source": value.get("source"), "rows": rows}, separators=(",", ":"))
+
+
+def _offset_payload_load(raw):
+    data = json.loads(raw)
+    offsets = {}
+    dist_acc = {}
+    for ma_tram, off_s, dist_m in data.get("rows") or []:
+        if off_s is not None:
+            offsets[int(ma_tram)] = float(off_s)
+        if dist_m is not None:
+            dist_acc[int(ma_tram)] = float(dist_m)
+    return {"ok": True, "source": data.get("source") or "osrm", "offsets": offsets, "dist_m": dist_acc}
+
+
+class _DbOffsetStore:
+    """L2 trên DB chính (bảng cache_offset_tram): mọi worker/node dùng chung."""
+
+    def get(self, key):
+        tbl = CacheOffsetTram.__table__
+        with db.engine.connect() as conn:
+            row = conn.execute(
+                db.select(tbl.c.payload, tbl.c.created_ts)
+                .where(tbl.c.tuyen_id == key[0], tbl.c.huong == key[1], tbl.c.signature == key[2])
+            ).first()
+        if not row:
+            return None
+        return row[0], float(row[1])
+
+    def set(self, key, payload, ts):
+        tbl = CacheOffsetTram.__table__
+        try:
+            with db.engine.begin() as conn:
+                # xóa luôn entry của signature cũ (trạm đã bị sửa) để bảng không phình
+                conn.execute(tbl.delete().where(tbl.c.tuyen_id == key[0], tbl.c.huong == key[1]))
+                conn.execute(tbl.insert().values(
+                    tuyen_id=key[0], huong=key[1], signature=key[2], payload=payload, created_ts=ts
+                ))
+        except IntegrityError:
+            # worker khác vừa ghi cùng key -> giữ bản của họ
+            pass
+
+
+class _SqliteFileOffsetStore:
+    """L2 trên file SQLite cục bộ: dùng chung giữa các worker cùng máy (khi DB chính ở xa)."""
+
+    def __init__(self, path):
+        self.path = path
+        self._ready = False
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=2.0)
+        if not self._ready:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""
+              CREATE TABLE IF NOT EXISTS cache_offset_tram (
+                tuyen_id INTEGER NOT NULL,
+                huong VARCHAR(10) NOT NULL,
+                signature VARCHAR(40) NOT NULL,
+                payload TEXT NOT NULL,
+                created_ts REAL NOT NULL,
+                PRIMARY KEY (tuyen_id, huong, signature)
+              )
+            """)
+            self._ready = True
+        return conn
+
+    def get(self, key):
+        conn = self._connect()
+        try:
+            row = conn.execute(
+                "SELECT payload, created_ts FROM cache_offset_tram WHERE tuyen_id = ? AND huong = ? AND signature = ?",
+                key,
+            ).fetchone()
+        finally:
+            conn.close()
+        if not row:
+            return None
+        return row[0], float(row[1])
+
+    def set(self, key, payload, ts):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute("DELETE FROM cache_offset_tram WHERE tuyen_id = ? AND huong = ?", key[:2])
+                conn.execute(
+                    "INSERT OR REPLACE INTO cache_offset_tram (tuyen_id, huong, signature, payload, created_ts) VALUES (?, ?, ?, ?, ?)",
+                    (key[0], key[1], key[2], payload, ts),
+                )
+        finally:
+            conn.close()
+
+
+def _make_offset_store(backend):
+    if backend == "db":
+        return _DbOffsetStore()
+    if backend == "sqlite":
+        return _SqliteFileOffsetStore(STOP_OFFSET_CACHE_SQLITE_PATH)
+    return None
+
+
+_STOP_OFFSET_STORE = _make_offset_store(STOP_OFFSET_CACHE_BACKEND)
+
+
+def _offset_store_get(cache_key):
+    if _STOP_OFFSET_STORE is None:
+        return None
+    try:
+        hit = _STOP_OFFSET_STORE.get(cache_key)
+        if not hit:
+            return None
+        raw, ts = hit
+        return _offset_payload_load(raw), ts
+    except Exception as e:
+        # L2 lỗi không được làm hỏng request: coi như miss
+        print("stop offset store get warning:", e)
+        return None
+
+
+def _offset_store_set(cache_key, value, coord_stops, ts):
+    if _STOP_OFFSET_STORE is None:
+        return
+    raw = _offset_payload_dump(value, coord_stops)
+
+    def _write():
+        try:
+            _STOP_OFFSET_STORE.set(cache_key, raw, ts)
+        except Exception as e:
+            print("stop offset store set warning:", e)
+
+    _CACHE_WRITER.submit(("offsets",) + tuple(cache_key), _write)
+
+
+def _fetch_osrm_legs(coord_stops):
+    """Gọi OSRM (không overview) cho dãy điểm, trả list (duration_s, distance_m) theo từng leg. Raise nếu lỗi."""
+    route = OSRM.route(
+        [(s.lng, s.lat) for s in coord_stops],
+        overview="false",
+        steps="false",
+    )
+    legs = route.get("legs") or []
+    if len(legs) != len(coord_stops) - 1:
+        raise RuntimeError("OSRM legs không khớp số điểm")
+
+    return [(float(leg.get("duration") or 0.0), float(leg.get("distance") or 0.0)) for leg in legs]
+
+
+def _accumulate_legs(coord_stops, legs):
+    """Cộng dồn legs OSRM thành offset (giây, đã nhân hệ số bus + dwell) và khoảng cách tích lũy."""
+    offsets = {coord_stops[0].maTram: 0.0}
+    dist_acc = {coord_stops[0].maTram: 0.0}
+    cum_s = 0.0
+    cum_m = 0.0
+    for i, (duration_s, distance_m) in enumerate(legs):
+        dur = duration_s * float(BUS_OSRM_DURATION_FACTOR)
+        cum_s += dur + float(BUS_STOP_DWELL_SEC)
+        cum_m += distance_m
+        offsets[coord_stops[i + 1].maTram] = cum_s
+        dist_acc[coord_stops[i + 1].maTram] = cum_m
+
+    return offsets, dist_acc
+
+
+_OSRM_CHUNK_POOL = None
+_OSRM_CHUNK_POOL_LOCK = threading.Lock()
+
+
+def _osrm_chunk_pool():
+    global _OSRM_CHUNK_POOL
+    with _OSRM_CHUNK_POOL_LOCK:
+        if _OSRM_CHUNK_POOL is None:
+            _OSRM_CHUNK_POOL = ThreadPoolExecutor(
+                max_workers=max(1, int(OSRM_CHUNK_WORKERS)), thread_name_prefix="osrm-chunk"
+            )
+        return _OSRM_CHUNK_POOL
+
+
+def _chunk_windows(n_points, window):
+    """
+    Chia n điểm thành các cửa sổ tối đa `window` điểm, chồng nhau đúng 1 điểm
+    để leg cuối của cửa sổ trước nối liền leg đầu của cửa sổ sau.
+    """
+    window = max(2, int(window))
+    out = []
+    start = 0
+    while start < n_points - 1:
+        end = min(n_points, start + window)
+        out.append((start, end))
+        start = end - 1
+    return out
+
+
+_OSRM_LEG_CACHE = _LruTtlCache(OSRM_LEG_L1_MAX_ENTRIES, max(60, int(OSRM_LEG_CACHE_TTL_SEC)))
+_osrm_leg_counters = {"cached": 0, "fetched": 0, "requests": 0}
+
+
+def _leg_key(a, b):
+    return f"{OSRM_PROFILE}|{float(a.lat):.6f},{float(a.lng):.6f};{float(b.lat):.6f},{float(b.lng):.6f}"
+
+
+def _leg_store_get_many(keys):
+    if not keys:
+        return {}
+    tbl = CacheLegOsrm.__table__
+    min_ts = time.time() - OSRM_LEG_CACHE_TTL_SEC
+    out = {}
+    try:
+        with db.engine.connect() as conn:
+            for i in range(0, len(keys), 500):
+                rows = conn.execute(
+                    db.select(tbl.c.key, tbl.c.duration_s, tbl.c.distance_m, tbl.c.created_ts)
+                    .where(tbl.c.key.in_(keys[i:i + 500]), tbl.c.created_ts >= min_ts)
+                ).all()
+                for key, duration_s, distance_m, created_ts in rows:
+                    out[key] = ((float(duration_s), float(distance_m)), float(created_ts))
+    except Exception as e:
+        print("osrm leg store get warning:", e)
+    return out
+
+
+def _leg_store_set_many(items, ts):
+    if not items:
+        return
+    tbl = CacheLegOsrm.__table__
+    keys = sorted(items)
+
+    def _write():
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(tbl.delete().where(tbl.c.key.in_(keys)))
+                conn.execute(tbl.insert(), [
+                    {"key": k, "duration_s": items[k][0], "distance_m": items[k][1], "created_ts": ts}
+                    for k in keys
+                ])
+        except IntegrityError:
+            pass
+        except Exception as e:
+            print("osrm leg store set warning:", e)
+
+    _CACHE_WRITER.submit(("legs",) + tuple(keys), _write)
+
+
+def _missing_leg_windows(missing):
+    """
+    Gom các leg thiếu liên tiếp thành 1 request (run i..j cần điểm i..j+1),
+    rồi chia run dài theo OSRM_MAX_COORDS.
+    """
+    runs = []
+    for i in missing:
+        if runs and runs[-1][1] == i:
+            runs[-1][1] = i + 1
+        else:
+            runs.append([i, i + 1])
+    windows = []
+    for first_leg, end_leg in runs:
+        for (a, b) in _chunk_windows(end_leg - first_leg + 1, OSRM_MAX_COORDS):
+            windows.append((first_leg + a, first_leg + b))
+    return windows
+
+
+def _compute_stop_offsets_legs(coord_stops):
+    """
+    Offset theo OSRM ghép từ cache từng leg (L1 -> bảng cache_leg_osrm),
+    chỉ gọi OSRM cho các leg còn thiếu (song song, gom leg liền nhau vào 1 request).
+    """
+    n_legs = len(coord_stops) - 1
+    keys = [_leg_key(coord_stops[i], coord_stops[i + 1]) for i in range(n_legs)]
+    legs = [None] * n_legs
+
+    for i, k in enumerate(keys):
+        legs[i] = _OSRM_LEG_CACHE.get(k)
+
+    missing_keys = [k for i, k in enumerate(keys) if legs[i] is None]
+    if missing_keys:
+        stored = _leg_store_get_many(sorted(set(missing_keys)))
+        for i, k in enumerate(keys):
+            if legs[i] is None and k in stored:
+                legs[i], ts = stored[k]
+                _OSRM_LEG_CACHE.set(k, legs[i], ts=ts)
+
+    missing = [i for i in range(n_legs) if legs[i] is None]
+    _osrm_leg_counters["cached"] += n_legs - len(missing)
+    if missing:
+        windows = _missing_leg_windows(missing)
+        pool = _osrm_chunk_pool()
+        futures = [(a, pool.submit(_fetch_osrm_legs, coord_stops[a:b])) for (a, b) in windows]
+        _osrm_leg_counters["requests"] += len(windows)
+        now_ts = time.time()
+        fetched = {}
+        for a, fut in futures:
+            for j, leg in enumerate(fut.result()):
+                legs[a + j] = leg
+                fetched[keys[a + j]] = leg
+                _OSRM_LEG_CACHE.set(keys[a + j], leg, ts=now_ts)
+        _osrm_leg_counters["fetched"] += len(missing)
+        _leg_store_set_many(fetched, now_ts)
+
+    return _accumulate_legs(coord_stops, legs)
+
+
 def get_stop_offsets(tuyen, dir_):
     """
     Tính offset thời gian (giây) từ điểm xuất bến (trạm #1 theo hướng) đến từng trạm.
     - Ưu tiên OSRM legs (duration) + hiệu chỉnh BUS_OSRM_DURATION_FACTOR.
-    - Fallback theo Haversine nếu OSRM lỗi/quá nhiều điểm.
+    - Duration/distance cache theo từng leg (tọa độ trạm -> trạm kế): sửa 1 trạm chỉ gọi OSRM cho các leg đổi.
+    - Tuyến dài hơn OSRM_MAX_COORDS: chia cửa sổ chồng nhau, gọi song song (source=osrm_chunked).
+    - Fallback theo Haversine nếu OSRM lỗi.
+    - Cache 2 tầng: L1 dict trong process, L2 (DB/SQLite) dùng chung giữa các worker.
+    - Entry hết hạn được trả ngay (`stale=True`) và làm mới ở thread nền.
     """
     dir_clean = normalize_direction(dir_)
-    stops = _query_stops_by_direction(tuyen, dir_clean).all()
+    stops = _load_stop_rows(tuyen, dir_clean)
     stops.sort(key=lambda s: (s.thuTuTrenTuyen or 0, s.maTram or 0))
+    stops = tuple(stops)
 
     coord_stops = [s for s in stops if s.lat is not None and s.lng is not None]
     if len(coord_stops) < 2:
@@ -667,53 +2214,84 @@ def get_stop_offsets(tuyen, dir_):
 
     sig = _stops_signature(coord_stops)
     cache_key = (int(tuyen.maTuyen), dir_clean, sig)
+    cache_group = cache_key[:2]
+    ttl = _STOP_OFFSET_CACHE.ttl_sec
     now_ts = time.time()
-    hit = _STOP_OFFSET_CACHE.get(cache_key)
-    if hit and (now_ts - hit["ts"]) < max(30, int(STOP_OFFSET_CACHE_TTL_SEC)):
-        return hit["value"]
-
-    # Nếu quá nhiều điểm, fallback để tránh 413/timeout
-    if len(coord_stops) > int(OSRM_MAX_COORDS):
-        offsets, dist_acc = _compute_stop_offsets_fallback(coord_stops)
-        value = {"ok": True, "source": "fallback", "offsets": offsets, "dist_m": dist_acc, "items": stops}
-        _STOP_OFFSET_CACHE[cache_key] = {"ts": now_ts, "value": value}
+    hit = _STOP_OFFSET_CACHE.get(cache_key, now_ts)
+    if hit is not None:
+        return hit
+
+    # L2: worker khác (hoặc lần chạy trước) đã tính rồi thì không gọi OSRM nữa
+    stored = _offset_store_get(cache_key)
+    if stored and (now_ts - stored[1]) < ttl:
+        value = dict(stored[0], items=stops)
+        _STOP_OFFSET_CACHE.set(cache_key, value, ts=stored[1], group=cache_group)
         return value
 
-    coords = ";".join(f"{float(s.lng)},{float(s.lat)}" for s in coord_stops)
-    url = f"{OSRM_BASE_URL}/route/v1/{OSRM_PROFILE}/{coords}"
-    params = {"overview": "false", "steps": "false"}
+    stale = _STOP_OFFSET_CACHE.peek(cache_key)
+    if stale is None and stored:
+        stale = dict(stored[0], items=stops)
+
+    def _refresh():
+        # Hết hạn cùng lúc -> chỉ 1 thread gọi OSRM, các thread khác dùng stale/chờ kết quả
+        return _STOP_OFFSET_FLIGHT.do(
+            cache_key,
+            lambda: _refresh_stop_offsets(cache_key, coord_stops, stops, stale=stale),
+            stale=stale,
+            wait_timeout=float(OSRM_TIMEOUT) + 2.0,
+        )
+
+    if stale is not None:
+        # Stale-while-revalidate: trả ngay giá trị cũ, làm mới ở nền -> request không chờ OSRM
+        _STOP_OFFSET_REFRESHER.submit(cache_key, _refresh)
+        return dict(stale, stale=True)
+
+    return _refresh()
+
+
+def _refresh_stop_offsets(cache_key, coord_stops, stops, stale=None):
+    cache_group = cache_key[:2]
+    now_ts = time.time()
+
+    lease_name = None
+    if STOP_OFFSET_SINGLEFLIGHT_LEASE and _STOP_OFFSET_STORE is not None:
+        lease_name = "stop_offsets:%d:%s:%s" % cache_key
+        if not try_acquire_lease(lease_name, float(OSRM_TIMEOUT) + 5.0):
+            # process khác đang tính: trả stale, hoặc chờ nó ghi L2
+            if stale is not None:
+                return stale
+            deadline = time.time() + float(OSRM_TIMEOUT) + 2.0
+            while time.time() < deadline:
+                time.sleep(0.2)
+                stored = _offset_store_get(cache_key)
+                if stored and stored[1] >= now_ts - 1.0:
+                    value = dict(stored[0], items=stops)
+                    _STOP_OFFSET_CACHE.set(cache_key, value, ts=stored[1], group=cache_group)
+                    return value
+            lease_name = None
 
     try:
-        r = requests.get(url, params=params, timeout=OSRM_TIMEOUT)
-        j = r.json() if r.content else {}
-        if r.status_code != 200 or j.get("code") != "Ok" or not j.get("routes"):
-            raise RuntimeError("OSRM không trả route")
-
-        route = j["routes"][0]
-        legs = route.get("legs") or []
-        if len(legs) != len(coord_stops) - 1:
-            raise RuntimeError("OSRM legs không khớp số điểm")
-
-        offsets = {coord_stops[0].maTram: 0.0}
-        dist_acc = {coord_stops[0].maTram: 0.0}
-        cum_s = 0.0
-        cum_m = 0.0
-        for i, leg in enumerate(legs):
-            dur = float(leg.get("duration") or 0.0) * float(BUS_OSRM_DURATION_FACTOR)
-            dist = float(leg.get("distance") or 0.0)
-            cum_s += dur + float(BUS_STOP_DWELL_SEC)
-            cum_m += dist
-            offsets[coord_stops[i + 1].maTram] = cum_s
-            dist_acc[coord_stops[i + 1].maTram] = cum_m
-
-        value = {"ok": True, "source": "osrm", "offsets": offsets, "dist_m": dist_acc, "items": stops}
-        _STOP_OFFSET_CACHE[cache_key] = {"ts": now_ts, "value": value}
+        # Ghép từ cache từng leg; leg thiếu gọi OSRM (tuyến dài: chia cửa sổ, gọi song song)
+        offsets, dist_acc = _compute_stop_offsets_legs(coord_stops)
+        source = "osrm_chunked" if len(coord_stops) > int(OSRM_MAX_COORDS) else "osrm"
+        value = {"ok": True, "source": source, "offsets": offsets, "dist_m": dist_acc, "items": stops}
+        _STOP_OFFSET_CACHE.set(cache_key, value, ts=now_ts, group=cache_group)
+        # chỉ chia sẻ kết quả OSRM; fallback chỉ giữ ở L1 để worker khác còn thử lại OSRM
+        _offset_store_set(cache_key, value, coord_stops, now_ts)
+        _notify_offsets_changed(cache_key, stale, value)
         return value
     except Exception as e:
+        # OSRM lỗi hoặc circuit đang mở -> Haversine ngay; TTL ngắn để sớm thử lại OSRM
         offsets, dist_acc = _compute_stop_offsets_fallback(coord_stops)
         value = {"ok": True, "source": "fallback", "offsets": offsets, "dist_m": dist_acc, "items": stops, "warn": str(e)}
-        _STOP_OFFSET_CACHE[cache_key] = {"ts": now_ts, "value": value}
+        _STOP_OFFSET_CACHE.set(
+            cache_key, value, ts=now_ts, ttl=max(10, int(STOP_OFFSET_FALLBACK_TTL_SEC)), group=cache_group
+        )
+        _notify_offsets_changed(cache_key, stale, value)
         return value
+    finally:
+        if lease_name:
+            release_lease(lease_name)
 
 
 def compute_next_stop_etas(tuyen, dir_, at=None):
@@ -726,11 +2304,7 @@ def compute_next_stop_etas(tuyen, dir_, at=None):
     window_minutes = end_min - start_min
 
     # nếu chỉ có 1 hướng dữ liệu, vẫn hiểu tuyến 2 chiều để suy ra headway từ "số chuyến/ngày"
-    dirs = []
-    for d in ("DI", "VE"):
-        st = stop_stats_for_direction(tuyen, d)
-        if st.get("stops", 0) > 0:
-            dirs.append(d)
+    dirs = route_active_dirs(tuyen)
     dirs_count_for_schedule = 2 if len(dirs) == 1 else max(1, len(dirs))
 
     headway_min = _compute_headway_minutes(tuyen, window_minutes, dirs_count=dirs_count_for_schedule)
@@ -744,54 +2318,1638 @@ def compute_next_stop_etas(tuyen, dir_, at=None):
     base = datetime.combine(at.date(), datetime.min.time())
     at_s = int((at - base).total_seconds())
 
-    start_s = int(start_min * 60)
-    end_s = int(end_min * 60)
-    headway_s = int(headway_min * 60)
+    start_s = int(start_min * 60)
+    end_s = int(end_min * 60)
+    headway_s = int(headway_min * 60)
+
+    out_items = []
+    for s in offsets_data.get("items") or []:
+        offset_s = offsets_data["offsets"].get(s.maTram)
+        dist_m = offsets_data.get("dist_m", {}).get(s.maTram)
+
+        eta_iso = None
+        eta_hhmm = None
+        eta_in_min = None
+
+        if offset_s is not None:
+            target_depart_s = max(start_s, at_s - int(round(float(offset_s))))
+            k = _ceil_div_int(max(0, target_depart_s - start_s), headway_s)
+            depart_s = start_s + k * headway_s
+            if depart_s <= end_s:
+                eta_dt = base + timedelta(seconds=(depart_s + float(offset_s)))
+                eta_iso = eta_dt.isoformat(timespec="seconds")
+                eta_hhmm = eta_dt.strftime("%H:%M")
+                eta_in_min = int(round((eta_dt - at).total_seconds() / 60.0))
+
+        out_items.append({
+            "stop_id": s.maTram,
+            "order": s.thuTuTrenTuyen,
+            "name": s.tenTram,
+            "address": s.diaChi,
+            "lat": float(s.lat) if s.lat is not None else None,
+            "lng": float(s.lng) if s.lng is not None else None,
+            "offset_s": float(offset_s) if offset_s is not None else None,
+            "distance_m": float(dist_m) if dist_m is not None else None,
+            "eta_iso": eta_iso,
+            "eta_time": eta_hhmm,
+            "eta_in_min": eta_in_min,
+        })
+
+    return {
+        "ok": True,
+        "route_id": tuyen.maTuyen,
+        "route_code": tuyen.maHienThi,
+        "direction": normalize_direction(dir_),
+        "as_of": at.isoformat(timespec="seconds"),
+        "operating_hours": tuyen.thoiGianHoatDong,
+        "headway_min": headway_min,
+        "offset_source": offsets_data.get("source"),
+        "items": out_items,
+    }
+
+
+def batch_stop_etas(stop_ids, at=None, k=3):
+    """
+    K chuyến tới gần nhất cho nhiều trạm (bảng giờ tại bến/ga).
+    Gom trạm theo (tuyến, hướng): mỗi nhóm gọi get_stop_offsets 1 lần và duyệt lịch chuyến 1 lần.
+    Trả (items theo thứ tự stop_ids, danh sách id không tìm thấy).
+    """
+    at = at or datetime.now()
+    end_of_day = datetime.combine(at.date(), datetime.max.time())
+
+    stops = {
+        s.maTram: s
+        for s in TramDung.query.filter(TramDung.maTram.in_(list(stop_ids)))
+        .with_entities(TramDung.maTram, TramDung.tenTram, TramDung.tuyen_id, TramDung.huong)
+        .all()
+    }
+    routes = {
+        r.maTuyen: r
+        for r in TuyenXe.query.filter(TuyenXe.maTuyen.in_({s.tuyen_id for s in stops.values()})).all()
+    }
+
+    groups = {}
+    for s in stops.values():
+        if s.tuyen_id in routes:
+            groups.setdefault((s.tuyen_id, normalize_direction(s.huong)), []).append(s.maTram)
+
+    results = {}
+    for (tuyen_id, dir_), ids in groups.items():
+        tuyen = routes[tuyen_id]
+        offsets_data = get_stop_offsets(tuyen, dir_)
+        offsets = (offsets_data.get("offsets") or {}) if offsets_data.get("ok") else {}
+        stop_offsets = {sid: float(offsets[sid]) for sid in ids if offsets.get(sid) is not None}
+
+        departures = []
+        if stop_offsets:
+            # chuyến xuất bến từ (at - offset lớn nhất); đủ khi trạm có offset nhỏ nhất đã có K chuyến
+            max_off = max(stop_offsets.values())
+            min_off = min(stop_offsets.values())
+            latest_threshold = at - timedelta(seconds=min_off)
+            enough = 0
+            for dep in upcoming_departures(tuyen, at - timedelta(seconds=max_off), end_of_day, dirs=(dir_,)):
+                departures.append(dep)
+                if dep.depart_dt >= latest_threshold:
+                    enough += 1
+                    if enough >= k:
+                        break
+
+        for sid in ids:
+            arrivals = []
+            off_s = stop_offsets.get(sid)
+            if off_s is not None:
+                for dep in departures:
+                    eta_dt = dep.depart_dt + timedelta(seconds=off_s)
+                    if eta_dt < at:
+                        continue
+                    arrivals.append({
+                        "trip_id": dep.trip_id,
+                        "virtual": dep.virtual,
+                        "depart_time": dep.time,
+                        "eta_time": eta_dt.strftime("%H:%M"),
+                        "eta_iso": eta_dt.isoformat(timespec="seconds"),
+                        "eta_in_min": int(round((eta_dt - at).total_seconds() / 60.0)),
+                        "detail_url": departure_detail_url(dep),
+                    })
+                    if len(arrivals) >= k:
+                        break
+            results[sid] = {
+                "stop_id": sid,
+                "name": stops[sid].tenTram,
+                "route_id": tuyen.maTuyen,
+                "route_code": tuyen.maHienThi,
+                "direction": dir_,
+                "offset_s": off_s,
+                "offset_source": offsets_data.get("source"),
+                "arrivals": arrivals,
+            }
+
+    items = [results[sid] for sid in stop_ids if sid in results]
+    missing = [sid for sid in stop_ids if sid not in results]
+    return items, missing
+
+
+# ==================== ETA REALTIME (SSE) ====================
+# Mỗi (tuyến, hướng) có 1 channel: job nền tính compute_next_stop_etas 1 lần mỗi tick rồi phát cùng
+# 1 chuỗi SSE (đã serialize sẵn) cho mọi client đang nghe, chỉ gồm các trạm có ETA đổi.
+# Client mới nhận "snapshot" đầy đủ từ kết quả gần nhất (tính lại nếu đã quá 1 tick).
+
+def _sse_message(event, seq, payload):
+    data = json.dumps(payload, ensure_ascii=False, separators=(",", ":"))
+    return f"id: {seq}\nevent: {event}\ndata: {data}\n\n"
+
+
+class _EtaChannel:
+    def __init__(self, key):
+        self.key = key
+        self.lock = threading.Lock()
+        self.subscribers = set()
+        self.pending = 0  # client đang subscribe dở (tick không được xóa channel)
+        self.items = None  # {stop_id: item} lần tính gần nhất
+        self.meta = {}
+        self.seq = 0
+        self.computed_at = 0.0
+
+
+class _EtaStreamHub:
+    def __init__(self, tick_sec, max_clients, queue_max=32):
+        self.tick_sec = max(1.0, float(tick_sec))
+        self.max_clients = max_clients
+        self.queue_max = queue_max
+        self._lock = threading.Lock()
+        self._channels = {}
+        self._thread = None
+        self.computations = 0
+        self.messages = 0
+        self.dropped = 0
+
+    def clients(self):
+        return sum(len(ch.subscribers) for ch in list(self._channels.values()))
+
+    def _compute(self, ch):
+        tuyen_id, dir_ = ch.key
+        with app.app_context():
+            tuyen = db.session.get(TuyenXe, tuyen_id)
+            data = compute_next_stop_etas(tuyen, dir_) if tuyen is not None else {
+                "ok": False, "error": "Không tìm thấy tuyến.", "items": [],
+            }
+        self.computations += 1
+        return data
+
+    def _refresh(self, ch):
+        """Tính lại channel (đang giữ ch.lock); trả message delta cần phát hoặc None."""
+        data = self._compute(ch)
+        new_items = {it["stop_id"]: it for it in data.get("items") or []}
+        first = ch.items is None
+        old_items = ch.items or {}
+        changed = [
+            it for sid, it in new_items.items()
+            if sid not in old_items
+            or (old_items[sid]["eta_in_min"], old_items[sid]["eta_time"]) != (it["eta_in_min"], it["eta_time"])
+        ]
+        removed = [sid for sid in old_items if sid not in new_items]
+        meta = {k: v for k, v in data.items() if k != "items"}
+        meta_changed = {k: v for k, v in meta.items() if k != "as_of" and ch.meta.get(k) != v}
+
+        ch.items = new_items
+        ch.meta = meta
+        ch.computed_at = time.time()
+        if first or not (changed or removed or meta_changed):
+            return None
+        ch.seq += 1
+        return _sse_message("delta", ch.seq, dict(meta, items=changed, removed=removed))
+
+    def _publish(self, ch, msg):
+        for q in list(ch.subscribers):
+            try:
+                q.put_nowait(msg)
+            except queue.Full:
+                # client quá chậm: đóng kết nối, EventSource sẽ nối lại và nhận snapshot mới
+                ch.subscribers.discard(q)
+                self.dropped += 1
+                try:
+                    q.get_nowait()
+                    q.put_nowait(None)
+                except (queue.Empty, queue.Full):
+                    pass
+        self.messages += 1
+
+    def subscribe(self, tuyen_id, dir_):
+        """Trả (channel, queue, snapshot SSE) hoặc None nếu đã đủ ETA_STREAM_MAX_CLIENTS."""
+        key = (tuyen_id, dir_)
+        with self._lock:
+            if self.clients() >= self.max_clients:
+                return None
+            ch = self._channels.get(key)
+            if ch is None:
+                ch = self._channels[key] = _EtaChannel(key)
+            ch.pending += 1
+            self._ensure_thread()
+
+        q = queue.Queue(maxsize=self.queue_max)
+        try:
+            with ch.lock:
+                if ch.items is None or (time.time() - ch.computed_at) >= self.tick_sec:
+                    msg = self._refresh(ch)
+                    if msg:
+                        self._publish(ch, msg)
+                snapshot = _sse_message("snapshot", ch.seq, dict(ch.meta, items=list(ch.items.values())))
+                ch.subscribers.add(q)
+        finally:
+            with self._lock:
+                ch.pending -= 1
+        return ch, q, snapshot
+
+    def unsubscribe(self, ch, q):
+        with ch.lock:
+            ch.subscribers.discard(q)
+
+    def tick(self):
+        with self._lock:
+            for key, ch in list(self._channels.items()):
+                if not ch.subscribers and not ch.pending:
+                    del self._channels[key]
+            channels = list(self._channels.values())
+        for ch in channels:
+            try:
+                with ch.lock:
+                    if not ch.subscribers:
+                        continue
+                    msg = self._refresh(ch)
+                    if msg:
+                        self._publish(ch, msg)
+            except Exception as e:
+                print("eta stream warning:", ch.key, e)
+
+    def _ensure_thread(self):
+        if self._thread is not None and self._thread.is_alive():
+            return
+
+        def loop():
+            while True:
+                time.sleep(self.tick_sec)
+                self.tick()
+
+        self._thread = threading.Thread(target=loop, name="eta-stream", daemon=True)
+        self._thread.start()
+
+    def stats(self):
+        return {
+            "channels": len(self._channels),
+            "clients": self.clients(),
+            "max_clients": self.max_clients,
+            "tick_sec": self.tick_sec,
+            "computations": self.computations,
+            "messages": self.messages,
+            "dropped": self.dropped,
+        }
+
+
+ETA_STREAM = _EtaStreamHub(ETA_STREAM_TICK_SEC, ETA_STREAM_MAX_CLIENTS)
+
+
+# ==================== BẢNG GIỜ (TIMETABLE) ====================
+# Ma trận giờ đến (trạm × chuyến) = offset trạm (cột) + giờ xuất bến (hàng), tính 1 lần bằng
+# broadcasting; "K chuyến tới" mỗi trạm = searchsorted trên vector giờ xuất bến (đã sắp xếp).
+
+_TIMETABLE_CACHE = _LruTtlCache(128, 60)
+
+# stops: [StopRow], offsets_s: [giây], departures: [Departure], depart_s: [giây từ 00:00 của `date`]
+Timetable = namedtuple("Timetable", "date stops offsets_s departures depart_s")
+
+
+def build_timetable(tuyen, dir_, date):
+    """Bảng giờ cả ngày `date` của 1 tuyến/hướng (trạm có offset × mọi chuyến xuất bến trong ngày)."""
+    dir_ = normalize_direction(dir_)
+    offsets_data = get_stop_offsets(tuyen, dir_)
+    offsets = (offsets_data.get("offsets") or {}) if offsets_data.get("ok") else {}
+    cache_key = (tuyen.maTuyen, dir_, date.isoformat(), _offsets_hash(offsets))
+    cached = _TIMETABLE_CACHE.get(cache_key)
+    if cached is not None:
+        return cached, offsets_data
+
+    stops = [s for s in (offsets_data.get("items") or []) if offsets.get(s.maTram) is not None]
+    base = datetime.combine(date, datetime.min.time())
+    departures = list(upcoming_departures(tuyen, base, base + timedelta(days=1, seconds=-1), dirs=(dir_,)))
+    table = Timetable(
+        date=date,
+        stops=stops,
+        offsets_s=[float(offsets[s.maTram]) for s in stops],
+        departures=departures,
+        depart_s=[(d.depart_dt - base).total_seconds() for d in departures],
+    )
+    _TIMETABLE_CACHE.set(cache_key, table, group=cache_key[:3])
+    return table, offsets_data
+
+
+def timetable_arrivals(table, at_s=None, k=None):
+    """
+    Giờ đến (giây từ 00:00) theo từng trạm: [[(chỉ số chuyến, giây đến), ...], ...].
+    `at_s`/`k`: chỉ lấy K chuyến đến từ at_s trở đi; None = cả ngày.
+    """
+    n = len(table.depart_s)
+    if not table.stops or not n:
+        return [[] for _ in table.stops]
+
+    depart = np.asarray(table.depart_s, dtype=np.float64)
+    offs = np.asarray(table.offsets_s, dtype=np.float64)
+    arrivals = offs[:, None] + depart[None, :]  # (trạm × chuyến)
+    if at_s is None:
+        start = np.zeros(len(offs), dtype=np.int64)
+    else:
+        # chuyến đầu tiên tới trạm i kể từ at_s: depart >= at_s - offset_i
+        start = np.searchsorted(depart, at_s - offs, side="left")
+    width = n if k is None else int(k)
+    cols = start[:, None] + np.arange(width)[None, :]
+    valid = cols < n
+    cols = np.minimum(cols, n - 1)
+    picked = np.take_along_axis(arrivals, cols, axis=1)
+    return [
+        list(zip(cols[i][valid[i]].tolist(), picked[i][valid[i]].tolist()))
+        for i in range(len(offs))
+    ]
+
+
+# ==================== TÌM TRẠM GẦN (SPATIAL INDEX) ====================
+# Lưới đều trong bộ nhớ: ô (lat, lng) cạnh ~STOP_INDEX_CELL_M mét -> danh sách trạm.
+# Truy vấn bán kính r chỉ duyệt các ô phủ bbox của r rồi lọc bằng Haversine.
+# Sửa trạm/tuyến trong worker này -> đánh dấu dựng lại ngay; worker khác dựng lại theo STOP_INDEX_TTL_SEC.
+
+_M_PER_DEG_LAT = 111320.0
+
+NearbyStop = namedtuple("NearbyStop", "stop_id name lat lng tuyen_id huong order group_id")
+_StopIndexSnapshot = namedtuple("_StopIndexSnapshot", "built_ts cell_lat cell_lng cells routes groups")
+
+
+class _StopGridIndex:
+    def __init__(self, cell_m, ttl_sec):
+        self.cell_m = max(50.0, float(cell_m))
+        self.ttl_sec = ttl_sec
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._dirty = True
+        self.builds = 0
+        self.queries = 0
+
+    def invalidate(self):
+        self._dirty = True
+
+    def _build(self):
+        rows = (
+            db.session.query(
+                TramDung.maTram, TramDung.tenTram, TramDung.lat, TramDung.lng,
+                TramDung.tuyen_id, TramDung.huong, TramDung.thuTuTrenTuyen, TramDung.nhom_id,
+            )
+            .filter(TramDung.lat.isnot(None), TramDung.lng.isnot(None))
+            .all()
+        )
+        routes = {
+            r.maTuyen: (r.maHienThi, r.tenTuyen)
+            for r in db.session.query(TuyenXe.maTuyen, TuyenXe.maHienThi, TuyenXe.tenTuyen).all()
+        }
+
+        # bước kinh độ tính theo vĩ độ trung bình của mạng lưới (đủ chính xác trong 1 thành phố)
+        mean_lat = (sum(float(r.lat) for r in rows) / len(rows)) if rows else 0.0
+        cell_lat = self.cell_m / _M_PER_DEG_LAT
+        cell_lng = self.cell_m / (_M_PER_DEG_LAT * max(0.01, math.cos(math.radians(mean_lat))))
+
+        cells, groups = {}, {}
+        for r in rows:
+            lat, lng = float(r.lat), float(r.lng)
+            key = (math.floor(lat / cell_lat), math.floor(lng / cell_lng))
+            st = NearbyStop(
+                r.maTram, r.tenTram, lat, lng, r.tuyen_id, normalize_direction(r.huong), r.thuTuTrenTuyen, r.nhom_id,
+            )
+            cells.setdefault(key, []).append(st)
+            if r.nhom_id is not None:
+                groups.setdefault(r.nhom_id, []).append(st)
+        self.builds += 1
+        return _StopIndexSnapshot(time.time(), cell_lat, cell_lng, cells, routes, groups)
+
+    def snapshot(self):
+        snap = self._snapshot
+        if snap is not None and not self._dirty and (time.time() - snap.built_ts) < self.ttl_sec:
+            return snap
+        with self._lock:
+            snap = self._snapshot
+            if snap is None or self._dirty or (time.time() - snap.built_ts) >= self.ttl_sec:
+                self._dirty = False
+                snap = self._snapshot = self._build()
+        return snap
+
+    def nearby(self, lat, lng, radius_m, limit=None):
+        """[(khoảng cách m, NearbyStop)] trong bán kính radius_m, gần nhất trước."""
+        snap = self.snapshot()
+        cell_lat, cell_lng, cells = snap.cell_lat, snap.cell_lng, snap.cells
+        self.queries += 1
+        dlat = radius_m / _M_PER_DEG_LAT
+        dlng = radius_m / (_M_PER_DEG_LAT * max(0.01, math.cos(math.radians(lat))))
+        i0, i1 = math.floor((lat - dlat) / cell_lat), math.floor((lat + dlat) / cell_lat)
+        j0, j1 = math.floor((lng - dlng) / cell_lng), math.floor((lng + dlng) / cell_lng)
+
+        found = []
+        for i in range(i0, i1 + 1):
+            for j in range(j0, j1 + 1):
+                for st in cells.get((i, j), ()):
+                    d = haversine_m(lat, lng, st.lat, st.lng)
+                    if d <= radius_m:
+                        found.append((d, st))
+        if limit is not None:
+            return heapq.nsmallest(limit, found, key=lambda x: (x[0], x[1].stop_id))
+        return sorted(found, key=lambda x: (x[0], x[1].stop_id))
+
+    def route_info(self, tuyen_id):
+        return self.snapshot().routes.get(tuyen_id, (None, None))
+
+    def group_members(self, group_id):
+        return self.snapshot().groups.get(group_id, [])
+
+    def stats(self):
+        snap = self._snapshot
+        return {
+            "built": snap is not None,
+            "age_sec": round(time.time() - snap.built_ts, 1) if snap else None,
+            "cells": len(snap.cells) if snap else 0,
+            "stops": sum(len(v) for v in snap.cells.values()) if snap else 0,
+            "groups": len(snap.groups) if snap else 0,
+            "cell_m": self.cell_m,
+            "ttl_sec": self.ttl_sec,
+            "builds": self.builds,
+            "queries": self.queries,
+        }
+
+
+STOP_INDEX = _StopGridIndex(STOP_INDEX_CELL_M, STOP_INDEX_TTL_SEC)
+
+
+@db.event.listens_for(db.session, "after_flush")
+def _mark_stop_index_changes(session, flush_context):
+    for obj in itertools.chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, (TramDung, TuyenXe)):
+            session.info["stop_index_dirty"] = True
+            return
+
+
+@db.event.listens_for(db.session, "after_commit")
+def _invalidate_stop_index(session):
+    if session.info.pop("stop_index_dirty", False):
+        STOP_INDEX.invalidate()
+        PLAN_NETWORK.invalidate()
+
+
+@db.event.listens_for(db.session, "after_rollback")
+def _discard_stop_index_changes(session):
+    session.info.pop("stop_index_dirty", None)
+
+
+# ==================== NHÓM TRẠM VẬT LÝ & CHUYỂN TIẾP ====================
+# Job batch (scripts/build_stop_groups.py): gom TramDung của mọi tuyến/hướng thành nhóm trạm vật lý
+# (single-linkage trong STOP_GROUP_RADIUS_M) và dựng bảng đi bộ giữa các nhóm trong PLAN_TRANSFER_RADIUS_M.
+# Cả 2 bước dùng lưới băm (ô cạnh = bán kính, chỉ so 3x3 ô lân cận) thay vì so từng cặp O(n²).
+
+
+def _grid_pairs(points, radius_m):
+    """points: [(lat, lng)]. Sinh (i, j, khoảng cách m) với i < j và khoảng cách <= radius_m."""
+    if not points:
+        return
+    mean_lat = sum(p[0] for p in points) / len(points)
+    cell_lat = radius_m / _M_PER_DEG_LAT
+    cell_lng = radius_m / (_M_PER_DEG_LAT * max(0.01, math.cos(math.radians(mean_lat))))
+    cells = {}
+    for i, (lat, lng) in enumerate(points):
+        cells.setdefault((math.floor(lat / cell_lat), math.floor(lng / cell_lng)), []).append(i)
+    for (ci, cj), members in cells.items():
+        for di in (-1, 0, 1):
+            for dj in (-1, 0, 1):
+                for j in cells.get((ci + di, cj + dj), ()):
+                    for i in members:
+                        if i < j:
+                            d = haversine_m(points[i][0], points[i][1], points[j][0], points[j][1])
+                            if d <= radius_m:
+                                yield i, j, d
+
+
+def cluster_stops(stops, radius_m):
+    """stops: [(maTram, tenTram, lat, lng)] -> [[chỉ số trạm]] mỗi phần tử là 1 nhóm (union-find)."""
+    parent = list(range(len(stops)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, j, _ in _grid_pairs([(s[2], s[3]) for s in stops], radius_m):
+        ri, rj = find(i), find(j)
+        if ri != rj:
+            parent[max(ri, rj)] = min(ri, rj)
+
+    clusters = {}
+    for i in range(len(stops)):
+        clusters.setdefault(find(i), []).append(i)
+    return list(clusters.values())
+
+
+def build_stop_groups(radius_m=None, transfer_radius_m=None, dry_run=False):
+    """
+    Dựng lại nhom_tram, tram_dung.nhom_id và chuyen_tiep_nhom_tram trong 1 transaction.
+    Trả về dict thống kê.
+    """
+    radius_m = STOP_GROUP_RADIUS_M if radius_m is None else float(radius_m)
+    transfer_radius_m = PLAN_TRANSFER_RADIUS_M if transfer_radius_m is None else float(transfer_radius_m)
+
+    stop_tbl = TramDung.__table__
+    group_tbl = NhomTram.__table__
+    transfer_tbl = ChuyenTiepNhomTram.__table__
+
+    with db.engine.begin() as conn:
+        stops = [
+            (r.maTram, r.tenTram, float(r.lat), float(r.lng))
+            for r in conn.execute(
+                db.select(stop_tbl.c.maTram, stop_tbl.c.tenTram, stop_tbl.c.lat, stop_tbl.c.lng)
+                .where(stop_tbl.c.lat.isnot(None), stop_tbl.c.lng.isnot(None))
+                .order_by(stop_tbl.c.maTram)
+            )
+        ]
+        clusters = cluster_stops(stops, radius_m)
+
+        groups = []
+        for members in clusters:
+            names = [stops[i][1] for i in members]
+            groups.append({
+                # tên hay gặp nhất trong nhóm (hòa thì lấy tên của trạm có mã nhỏ nhất)
+                "tenNhom": max(names, key=lambda n: (names.count(n), -names.index(n))),
+                "lat": sum(stops[i][2] for i in members) / len(members),
+                "lng": sum(stops[i][3] for i in members) / len(members),
+                "so_tram": len(members),
+                "members": [stops[i][0] for i in members],
+            })
+
+        pairs = list(_grid_pairs([(g["lat"], g["lng"]) for g in groups], transfer_radius_m))
+        stats = {
+            "stops": len(stops),
+            "groups": len(groups),
+            "multi_route_groups": sum(1 for g in groups if g["so_tram"] > 1),
+            "transfers": 2 * len(pairs),
+            "radius_m": radius_m,
+            "transfer_radius_m": transfer_radius_m,
+        }
+        if dry_run:
+            return stats
+
+        conn.execute(transfer_tbl.delete())
+        conn.execute(stop_tbl.update().values(nhom_id=None))
+        conn.execute(group_tbl.delete())
+        # nhom_id là dữ liệu trạm: đổi cho mọi tuyến có trạm
+        bump_route_data_versions(conn, conn.execute(db.select(stop_tbl.c.tuyen_id).distinct()).scalars())
+
+        now = datetime.utcnow()
+        group_ids = []
+        for g in groups:
+            res = conn.execute(group_tbl.insert().values(
+                tenNhom=g["tenNhom"], lat=g["lat"], lng=g["lng"], so_tram=g["so_tram"], updated_at=now,
+            ))
+            group_ids.append(res.inserted_primary_key[0])
+
+        assign = [
+            {"b_tram": sid, "b_nhom": gid}
+            for g, gid in zip(groups, group_ids)
+            for sid in g["members"]
+        ]
+        if assign:
+            conn.execute(
+                stop_tbl.update()
+                .where(stop_tbl.c.maTram == db.bindparam("b_tram"))
+                .values(nhom_id=db.bindparam("b_nhom")),
+                assign,
+            )
+
+        rows = []
+        for i, j, d in pairs:
+            walk_s = int(round(_walk_seconds(d)))
+            rows.append({"tu_nhom": group_ids[i], "den_nhom": group_ids[j], "khoang_cach_m": d, "di_bo_giay": walk_s})
+            rows.append({"tu_nhom": group_ids[j], "den_nhom": group_ids[i], "khoang_cach_m": d, "di_bo_giay": walk_s})
+        if rows:
+            conn.execute(transfer_tbl.insert(), rows)
+
+    # ghi bằng Core nên không qua event của session: tự báo index/mạng lưới của worker này
+    STOP_INDEX.invalidate()
+    PLAN_NETWORK.invalidate()
+    return stats
+
+
+def load_group_transfers():
+    """{nhóm: [nhóm đi bộ tới được]} từ chuyen_tiep_nhom_tram."""
+    out = {}
+    for tu, den in db.session.query(ChuyenTiepNhomTram.tu_nhom, ChuyenTiepNhomTram.den_nhom).all():
+        out.setdefault(tu, []).append(den)
+    return out
+
+
+# ==================== LẬP KẾ HOẠCH HÀNH TRÌNH (RAPTOR) ====================
+# Mạng lưới 1 ngày dựng sẵn trong bộ nhớ (chỉ số nguyên + list, không qua ORM khi truy vấn):
+# - pattern = 1 tuyến/hướng: dãy trạm, offset (giây) và giờ xuất bến (giây từ 00:00, đã sắp xếp)
+#   -> mọi chuyến cùng offset nên không vượt nhau: chuyến sớm nhất đón được ở vị trí i = bisect(dep, t - off[i])
+# - footpath = đi bộ giữa các trạm gần nhau (kể cả trạm cùng chỗ của tuyến khác)
+# RAPTOR: mỗi vòng k = thêm 1 chuyến xe; trả về các hành trình Pareto (giờ đến, số chuyến).
+
+PlanPattern = namedtuple("PlanPattern", "tuyen_id route_code huong stops offsets depart_s departures")
+
+
+class PlanNetwork:
+    def __init__(self, date, patterns, stop_ids, stop_names, stop_coords, stop_patterns, footpaths):
+        self.date = date
+        self.base = datetime.combine(date, datetime.min.time())
+        self.patterns = patterns
+        self.stop_ids = stop_ids  # chỉ số -> maTram
+        self.stop_index = {sid: i for i, sid in enumerate(stop_ids)}
+        self.stop_names = stop_names
+        self.stop_coords = stop_coords
+        self.stop_patterns = stop_patterns  # chỉ số trạm -> [(pattern, vị trí trong pattern)]
+        self.footpaths = footpaths  # chỉ số trạm -> [(chỉ số trạm, giây đi bộ)]
+        self.built_ts = time.time()
+
+
+def _walk_seconds(dist_m):
+    return dist_m / max(0.5, PLAN_WALK_SPEED_KMH * 1000.0 / 3600.0)
+
+
+def _plan_footpaths(stop_ids, stop_coords, stop_index):
+    """
+    Đi bộ chuyển tuyến (kèm PLAN_MIN_TRANSFER_SEC): nếu đã dựng nhóm trạm thì lấy trạm cùng nhóm
+    + nhóm kề trong chuyen_tiep_nhom_tram; trạm chưa có nhóm thì tìm trong PLAN_TRANSFER_RADIUS_M.
+    """
+    snap = STOP_INDEX.snapshot()
+    group_of = {st.stop_id: st.group_id for members in snap.groups.values() for st in members}
+    transfers = load_group_transfers() if snap.groups else {}
+
+    footpaths = [[] for _ in stop_coords]
+    for i, (lat, lng) in enumerate(stop_coords):
+        gid = group_of.get(stop_ids[i])
+        if gid is not None:
+            candidates = [
+                (haversine_m(lat, lng, st.lat, st.lng), st)
+                for g in itertools.chain((gid,), transfers.get(gid, ()))
+                for st in snap.groups.get(g, ())
+            ]
+        else:
+            candidates = STOP_INDEX.nearby(lat, lng, PLAN_TRANSFER_RADIUS_M)
+        for dist, st in candidates:
+            j = stop_index.get(st.stop_id)
+            if j is None or j == i:
+                continue
+            footpaths[i].append((j, int(round(_walk_seconds(dist))) + PLAN_MIN_TRANSFER_SEC))
+    return footpaths
+
+
+def build_plan_network(date):
+    patterns = []
+    stop_ids, stop_index, stop_names, stop_coords = [], {}, [], []
+
+    for tuyen in TuyenXe.query.order_by(TuyenXe.maTuyen).all():
+        for dir_ in route_active_dirs(tuyen):
+            table, _ = build_timetable(tuyen, dir_, date)
+            if len(table.stops) < 2 or not table.depart_s:
+                continue
+            idxs = []
+            for s in table.stops:
+                if s.maTram not in stop_index:
+                    stop_index[s.maTram] = len(stop_ids)
+                    stop_ids.append(s.maTram)
+                    stop_names.append(s.tenTram)
+                    stop_coords.append((float(s.lat), float(s.lng)))
+                idxs.append(stop_index[s.maTram])
+            patterns.append(PlanPattern(
+                tuyen_id=tuyen.maTuyen,
+                route_code=tuyen.maHienThi,
+                huong=dir_,
+                stops=idxs,
+                offsets=[int(round(o)) for o in table.offsets_s],
+                depart_s=[int(round(d)) for d in table.depart_s],
+                departures=table.departures,
+            ))
+
+    stop_patterns = [[] for _ in stop_ids]
+    for pi, pat in enumerate(patterns):
+        for pos, si in enumerate(pat.stops):
+            stop_patterns[si].append((pi, pos))
+
+    footpaths = _plan_footpaths(stop_ids, stop_coords, stop_index)
+    return PlanNetwork(date, patterns, stop_ids, stop_names, stop_coords, stop_patterns, footpaths)
+
+
+class _PlanNetworkCache:
+    """
+    1 mạng lưới / ngày. Hết PLAN_NETWORK_TTL_SEC hoặc trạm/tuyến đổi: vẫn trả mạng lưới cũ và dựng lại
+    ở nền (`_PLAN_NETWORK_REBUILDER`) -> /api/plan không phải chờ dựng (có thể gọi OSRM khi cache offset nguội).
+    Chỉ ngày chưa có mạng lưới nào mới dựng ngay trong request (các request cùng lúc chờ chung 1 lần dựng).
+    """
+
+    def __init__(self, ttl_sec):
+        self.ttl_sec = ttl_sec
+        self._lock = threading.Lock()
+        self._nets = OrderedDict()  # date -> (PlanNetwork, generation lúc bắt đầu dựng)
+        self._first_build_lock = threading.Lock()  # ngày chưa có mạng lưới: chỉ 1 request dựng
+        self._gen = 0
+        self.builds = 0
+
+    def invalidate(self):
+        with self._lock:
+            self._gen += 1
+
+    def _fresh(self, entry):
+        net, gen = entry
+        return gen == self._gen and (time.time() - net.built_ts) < self.ttl_sec
+
+    def _build(self, date):
+        gen = self._gen  # đổi dữ liệu trong lúc dựng -> bản này coi như cũ, lần get sau dựng lại
+        net = build_plan_network(date)
+        with self._lock:
+            self.builds += 1
+            self._nets[date] = (net, gen)
+            self._nets.move_to_end(date)
+            while len(self._nets) > 3:
+                self._nets.popitem(last=False)
+        return net
+
+    def get(self, date):
+        entry = self._nets.get(date)
+        if entry is not None:
+            if not self._fresh(entry):
+                _PLAN_NETWORK_REBUILDER.submit(("plan_network", date), lambda: self._build(date))
+            return entry[0]
+        with self._first_build_lock:
+            entry = self._nets.get(date)
+            if entry is not None:
+                return entry[0]
+            return self._build(date)
+
+    def stats(self):
+        return {
+            "dates": [d.isoformat() for d in self._nets],
+            "builds": self.builds,
+            "ttl_sec": self.ttl_sec,
+            "rebuild": _PLAN_NETWORK_REBUILDER.stats(),
+        }
+
+
+_PLAN_NETWORK_REBUILDER = _BackgroundRefresher(1, 8, "plan-network")
+PLAN_NETWORK = _PlanNetworkCache(PLAN_NETWORK_TTL_SEC)
+
+
+def raptor(net, sources, targets, depart_s, max_rounds):
+    """
+    sources: {chỉ số trạm: giây đi bộ từ điểm đi}; targets: {chỉ số trạm: giây đi bộ tới điểm đến}.
+    Trả về [(giờ đến, số chuyến xe, legs)] Pareto theo (giờ đến, số chuyến); 0 chuyến = đi bộ thẳng.
+    Hai mốc tốt nhất riêng: best_ride (tới bằng xe/điểm đi, còn được đi bộ tiếp) và best_any (kể cả
+    đi bộ tới, chỉ để lên xe/tới đích) -> trạm đã tới sớm bằng đi bộ vẫn giữ nhãn xe để đi bộ tiếp.
+    """
+    inf = float("inf")
+    best_ride = {}
+    best_any = {}
+    rounds = []  # mỗi vòng: (ride, walk) = {trạm: (giờ đến, nhãn)}
+    results = []
+    best_target = inf
+
+    def check_targets(k):
+        nonlocal best_target
+        ride, walk = rounds[k]
+        arrival, end_si = inf, None
+        for si, egress in targets.items():
+            for table in (ride, walk):
+                lab = table.get(si)
+                if lab and lab[0] + egress < arrival:
+                    arrival, end_si = lab[0] + egress, si
+        if end_si is not None and arrival < best_target:
+            best_target = arrival
+            results.append((arrival, k, _raptor_legs(net, rounds, k, end_si, targets[end_si])))
+
+    ride0 = {}
+    for si, walk_s in sources.items():
+        t = depart_s + walk_s
+        if t < best_ride.get(si, inf):
+            best_ride[si] = t
+            best_any[si] = min(best_any.get(si, inf), t)
+            ride0[si] = (t, ("access", walk_s))
+    walk0 = _relax_footpaths(net, ride0, best_any)
+    rounds.append((ride0, walk0))
+    check_targets(0)
+    marked = set(ride0) | set(walk0)
+
+    for k in range(1, max_rounds + 1):
+        if not marked:
+            break
+        prev_ride, prev_walk = rounds[k - 1]
+
+        def prev_arrival(si):
+            a = prev_ride.get(si)
+            b = prev_walk.get(si)
+            return min(a[0] if a else inf, b[0] if b else inf)
+
+        # pattern -> vị trí sớm nhất có trạm được đánh dấu
+        queue = {}
+        for si in marked:
+            for pi, pos in net.stop_patterns[si]:
+                if pos < queue.get(pi, len(net.patterns[pi].stops)):
+                    queue[pi] = pos
+
+        ride = {}
+        for pi, start in queue.items():
+            pat = net.patterns[pi]
+            trip = None
+            board_pos = None
+            n = len(pat.depart_s)
+            for pos in range(start, len(pat.stops)):
+                si = pat.stops[pos]
+                off = pat.offsets[pos]
+                if trip is not None:
+                    arr = pat.depart_s[trip] + off
+                    if arr < min(best_ride.get(si, inf), best_target):
+                        best_ride[si] = arr
+                        best_any[si] = min(best_any.get(si, inf), arr)
+                        ride[si] = (arr, ("ride", pi, trip, board_pos, pos))
+                t_prev = prev_arrival(si)
+                if t_prev < inf and (trip is None or t_prev <= pat.depart_s[trip] + off):
+                    cand = bisect_left(pat.depart_s, t_prev - off)
+                    if cand < n and (trip is None or cand < trip):
+                        trip, board_pos = cand, pos
+
+        walk = _relax_footpaths(net, ride, best_any)
+        rounds.append((ride, walk))
+        marked = set(ride) | set(walk)
+        check_targets(k)
+    return results
+
+
+def _relax_footpaths(net, improved, best_any):
+    walk = {}
+    for si, (t, _) in improved.items():
+        for sj, walk_s in net.footpaths[si]:
+            arr = t + walk_s
+            if arr < best_any.get(sj, float("inf")):
+                best_any[sj] = arr
+                walk[sj] = (arr, ("walk", si, walk_s))
+    return walk
+
+
+def _raptor_legs(net, rounds, k, si, egress_s):
+    legs = []
+    if egress_s:
+        legs.append(("egress", si, egress_s))
+    while True:
+        ride, walk = rounds[k]
+        r, w = ride.get(si), walk.get(si)
+        if w and (not r or w[0] < r[0]):
+            _, from_si, walk_s = w[1]
+            legs.append(("walk", from_si, si, walk_s))
+            si = from_si
+            r = ride[si]
+        label = r[1]
+        if label[0] == "access":
+            if label[1]:
+                legs.append(("access", si, label[1]))
+            break
+        _, pi, trip, board_pos, alight_pos = label
+        legs.append(("ride", pi, trip, board_pos, alight_pos))
+        si = net.patterns[pi].stops[board_pos]
+        k -= 1
+    legs.reverse()
+    return legs
+
+
+def plan_journeys(net, sources, targets, depart_dt, max_transfers=None):
+    """Chạy RAPTOR và đổi kết quả ra dict JSON-friendly."""
+    max_transfers = PLAN_MAX_TRANSFERS if max_transfers is None else max_transfers
+    depart_s = int((depart_dt - net.base).total_seconds())
+    found = raptor(net, sources, targets, depart_s, max_rounds=max_transfers + 1)
+
+    def stop_json(si):
+        return {"stop_id": net.stop_ids[si], "name": net.stop_names[si],
+                "lat": net.stop_coords[si][0], "lng": net.stop_coords[si][1]}
+
+    def at(sec):
+        return (net.base + timedelta(seconds=sec)).isoformat(timespec="seconds")
+
+    journeys = []
+    for arrival, n_rides, legs in found:
+        out = []
+        for leg in legs:
+            if leg[0] == "ride":
+                _, pi, trip, board_pos, alight_pos = leg
+                pat = net.patterns[pi]
+                dep = pat.departures[trip]
+                out.append({
+                    "type": "bus",
+                    "route_id": pat.tuyen_id,
+                    "route_code": pat.route_code,
+                    "direction": pat.huong,
+                    "trip_id": dep.trip_id,
+                    "detail_url": departure_detail_url(dep),
+                    "from": stop_json(pat.stops[board_pos]),
+                    "to": stop_json(pat.stops[alight_pos]),
+                    "depart": at(pat.depart_s[trip] + pat.offsets[board_pos]),
+                    "arrive": at(pat.depart_s[trip] + pat.offsets[alight_pos]),
+                    "stops": alight_pos - board_pos,
+                })
+            elif leg[0] == "walk":
+                _, from_si, to_si, walk_s = leg
+                out.append({"type": "walk", "from": stop_json(from_si), "to": stop_json(to_si), "duration_s": walk_s})
+            elif leg[0] == "access":
+                out.append({"type": "walk", "from": None, "to": stop_json(leg[1]), "duration_s": leg[2]})
+            else:
+                out.append({"type": "walk", "from": stop_json(leg[1]), "to": None, "duration_s": leg[2]})
+        journeys.append({
+            "depart": at(depart_s),
+            "arrive": at(arrival),
+            "duration_min": round((arrival - depart_s) / 60.0, 1),
+            "rides": n_rides,
+            "transfers": max(0, n_rides - 1),
+            "legs": out,
+        })
+    return journeys
+
+
+# ==================== CACHE HÌNH HỌC TUYẾN ====================
+
+_ROUTE_GEOMETRY_CACHE = _LruTtlCache(ROUTE_GEOMETRY_L1_MAX_ENTRIES, max(60, int(ROUTE_GEOMETRY_CACHE_TTL_SEC)))
+_ROUTE_GEOMETRY_PRUNE_EVERY = 50
+_route_geometry_writes = 0
+
+
+def _geometry_cache_key(points_lnglat, profile=None):
+    """Hash danh sách (lng, lat) đã làm tròn 6 chữ số (~0.1m) + profile OSRM."""
+    norm = ";".join(f"{float(lng):.6f},{float(lat):.6f}" for (lng, lat) in points_lnglat)
+    raw = f"{profile or OSRM_PROFILE}|{norm}".encode("utf-8")
+    return hashlib.sha1(raw).hexdigest()
+
+
+def _geometry_etag(entry):
+    return f"{entry['key']}-{int(entry['created_ts'])}"
+
+
+def _geometry_cache_get(key):
+    hit = _ROUTE_GEOMETRY_CACHE.get(key)
+    if hit is not None:
+        return hit
+
+    tbl = CacheDuongDi.__table__
+    now_ts = time.time()
+    try:
+        with db.engine.connect() as conn:
+            row = conn.execute(
+                db.select(tbl.c.distance_m, tbl.c.duration_s, tbl.c.geometry, tbl.c.created_ts, tbl.c.last_hit_ts)
+                .where(tbl.c.key == key)
+            ).first()
+        if not row or (now_ts - float(row[3])) >= ROUTE_GEOMETRY_CACHE_TTL_SEC:
+            return None
+        if (now_ts - float(row[4])) > 3600:
+            # last_hit (cho prune) ghi thưa thớt và ở nền để đường đọc không thành đường ghi
+            _CACHE_WRITER.submit(("geometry_hit", key), lambda: _geometry_cache_touch(key, now_ts))
+    except Exception as e:
+        print("route geometry cache get warning:", e)
+        return None
+
+    entry = {
+        "key": key,
+        "distance_m": row[0],
+        "duration_s": row[1],
+        "geometry": json.loads(row[2]),
+        "created_ts": float(row[3]),
+    }
+    _ROUTE_GEOMETRY_CACHE.set(key, entry, ts=float(row[3]))
+    return entry
+
+
+def _geometry_cache_touch(key, now_ts):
+    tbl = CacheDuongDi.__table__
+    try:
+        with db.engine.begin() as conn:
+            conn.execute(tbl.update().where(tbl.c.key == key).values(last_hit_ts=now_ts))
+    except Exception as e:
+        print("route geometry cache touch warning:", e)
+
+
+def _geometry_cache_prune(conn, now_ts):
+    tbl = CacheDuongDi.__table__
+    conn.execute(tbl.delete().where(tbl.c.created_ts < now_ts - ROUTE_GEOMETRY_CACHE_TTL_SEC))
+    total = conn.execute(db.select(func.count()).select_from(tbl)).scalar() or 0
+    overflow = int(total) - int(ROUTE_GEOMETRY_CACHE_MAX_ROWS)
+    if overflow > 0:
+        old_keys = db.select(tbl.c.key).order_by(tbl.c.last_hit_ts.asc()).limit(overflow).scalar_subquery()
+        conn.execute(tbl.delete().where(tbl.c.key.in_(old_keys)))
+
+
+def _geometry_cache_set(key, n_points, route):
+    now_ts = time.time()
+    entry = {
+        "key": key,
+        "distance_m": route.get("distance"),
+        "duration_s": route.get("duration"),
+        "geometry": route.get("geometry"),
+        "created_ts": now_ts,
+    }
+    _ROUTE_GEOMETRY_CACHE.set(key, entry, ts=now_ts)
+    geometry = json.dumps(entry["geometry"], separators=(",", ":"))
+
+    def _write():
+        global _route_geometry_writes
+        tbl = CacheDuongDi.__table__
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(tbl.delete().where(tbl.c.key == key))
+                conn.execute(tbl.insert().values(
+                    key=key,
+                    profile=OSRM_PROFILE,
+                    n_points=n_points,
+                    distance_m=entry["distance_m"],
+                    duration_s=entry["duration_s"],
+                    geometry=geometry,
+                    created_ts=now_ts,
+                    last_hit_ts=now_ts,
+                ))
+                _route_geometry_writes += 1
+                if _route_geometry_writes % _ROUTE_GEOMETRY_PRUNE_EVERY == 1:
+                    _geometry_cache_prune(conn, now_ts)
+        except IntegrityError:
+            pass
+        except Exception as e:
+            print("route geometry cache set warning:", e)
+
+    _CACHE_WRITER.submit(("geometry", key), _write)
+    return entry
+
+
+def _route_geometry(points_lnglat):
+    """Geometry OSRM overview=full cho list (lng, lat), qua cache. Trả (entry, cached) hoặc raise OsrmError."""
+    key = _geometry_cache_key(points_lnglat)
+    entry = _geometry_cache_get(key)
+    if entry is not None:
+        return entry, True
+    route = OSRM.route(points_lnglat, overview="full", geometries="geojson", steps="false")
+    return _geometry_cache_set(key, len(points_lnglat), route), False
+
+
+# ---- Biến thể geometry: rút gọn Douglas-Peucker + mã hóa polyline6, cache theo (geometry, format, sai số) ----
+
+_GEOMETRY_VARIANT_CACHE = _LruTtlCache(GEOMETRY_VARIANT_CACHE_MAX_ENTRIES, 24 * 3600)
+GEOMETRY_FORMATS = ("geojson", "polyline6")
+
+
+def encode_polyline(coords_lnglat, precision=6):
+    """Google encoded polyline (thứ tự lat,lng) từ list [lng, lat]; precision=6 như OSRM polyline6."""
+    factor = 10 ** precision
+    out = []
+    prev_lat = prev_lng = 0
+    for lng, lat in coords_lnglat:
+        ilat = int(round(lat * factor))
+        ilng = int(round(lng * factor))
+        for v in (ilat - prev_lat, ilng - prev_lng):
+            v = ~(v << 1) if v < 0 else (v << 1)
+            while v >= 0x20:
+                out.append(chr((0x20 | (v & 0x1F)) + 63))
+                v >>= 5
+            out.append(chr(v + 63))
+        prev_lat, prev_lng = ilat, ilng
+    return "".join(out)
+
+
+def simplify_line(coords_lnglat, tolerance_m):
+    """Douglas-Peucker (không đệ quy) trên mặt phẳng chiếu equirectangular quanh vĩ độ trung bình."""
+    n = len(coords_lnglat)
+    if n <= 2 or tolerance_m <= 0:
+        return list(coords_lnglat)
+
+    lat0 = math.radians(sum(c[1] for c in coords_lnglat) / n)
+    kx = _M_PER_DEG_LAT * math.cos(lat0)
+    xs = [c[0] * kx for c in coords_lnglat]
+    ys = [c[1] * _M_PER_DEG_LAT for c in coords_lnglat]
+    tol2 = tolerance_m * tolerance_m
+
+    keep = [False] * n
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    while stack:
+        a, b = stack.pop()
+        ax, ay = xs[a], ys[a]
+        dx, dy = xs[b] - ax, ys[b] - ay
+        seg2 = dx * dx + dy * dy
+        far_d2, far_i = -1.0, None
+        for i in range(a + 1, b):
+            px, py = xs[i] - ax, ys[i] - ay
+            if seg2 > 0:
+                t = max(0.0, min(1.0, (px * dx + py * dy) / seg2))
+                px -= t * dx
+                py -= t * dy
+            d2 = px * px + py * py
+            if d2 > far_d2:
+                far_d2, far_i = d2, i
+        if far_i is not None and far_d2 > tol2:
+            keep[far_i] = True
+            stack.append((a, far_i))
+            stack.append((far_i, b))
+    return [c for c, k in zip(coords_lnglat, keep) if k]
+
+
+def zoom_tolerance_m(zoom, lat):
+    """Sai số (mét) ~ GEOMETRY_SIMPLIFY_PX pixel ở mức zoom web-mercator (tile 256px)."""
+    m_per_px = 156543.03392 * math.cos(math.radians(lat)) / (2 ** zoom)
+    return m_per_px * GEOMETRY_SIMPLIFY_PX
+
+
+def parse_geometry_variant(args, coords_lnglat):
+    """
+    ?format=geojson|polyline6, ?simplify=<mét> hoặc ?zoom=<0-20> -> (format, sai số mét) hoặc raise ValueError.
+    Sai số làm tròn 2 chữ số có nghĩa để các client gần giống nhau dùng chung 1 bản cache.
+    """
+    fmt = (args.get("format") or "geojson").strip().lower()
+    if fmt not in GEOMETRY_FORMATS:
+        raise ValueError("format phải là geojson hoặc polyline6.")
+
+    tolerance = 0.0
+    simplify_raw = (args.get("simplify") or "").strip()
+    zoom_raw = (args.get("zoom") or "").strip()
+    if simplify_raw:
+        try:
+            tolerance = float(simplify_raw)
+        except ValueError:
+            tolerance = -1.0
+        if not (0 <= tolerance <= 5000):
+            raise ValueError("simplify phải trong khoảng 0-5000 (mét).")
+    elif zoom_raw:
+        try:
+            zoom = int(zoom_raw)
+        except ValueError:
+            zoom = -1
+        if not (0 <= zoom <= 20):
+            raise ValueError("zoom phải trong khoảng 0-20.")
+        lat = coords_lnglat[0][1] if coords_lnglat else 0.0
+        tolerance = zoom_tolerance_m(zoom, lat)
+    if tolerance > 0:
+        tolerance = float(f"{tolerance:.2g}")
+    return fmt, tolerance
+
+
+def geometry_variant(base_key, coords_lnglat, fmt, tolerance_m):
+    """Dict {geometry, format, points, points_full, tolerance_m} cho 1 biến thể; cache theo base_key (ETag nguồn)."""
+    if fmt == "geojson" and not tolerance_m:
+        return {
+            "geometry": {"type": "LineString", "coordinates": coords_lnglat},
+            "format": fmt,
+            "points": len(coords_lnglat),
+            "points_full": len(coords_lnglat),
+            "tolerance_m": 0.0,
+        }
+    key = (base_key, fmt, tolerance_m)
+    hit = _GEOMETRY_VARIANT_CACHE.get(key)
+    if hit is not None:
+        return hit
+
+    pts = simplify_line(coords_lnglat, tolerance_m) if tolerance_m else list(coords_lnglat)
+    geometry = encode_polyline(pts) if fmt == "polyline6" else {"type": "LineString", "coordinates": pts}
+    value = {
+        "geometry": geometry,
+        "format": fmt,
+        "points": len(pts),
+        "points_full": len(coords_lnglat),
+        "tolerance_m": tolerance_m,
+    }
+    _GEOMETRY_VARIANT_CACHE.set(key, value)
+    return value
+
+
+def _variant_etag(etag, fmt, tolerance_m):
+    if fmt == "geojson" and not tolerance_m:
+        return etag
+    return f"{etag}-{fmt}-{tolerance_m:g}"
+
+
+# ==================== HÌNH DẠNG TUYẾN (SHAPE) ====================
+
+_ROUTE_SHAPE_REBUILDER = _BackgroundRefresher(1, 256, "shape-rebuild")
+_SHAPE_RETRY_AFTER = {}  # tuyen_id -> time.time() sớm nhất được thử dựng lại shape đường thẳng (mỗi worker)
+
+
+def _straight_shape_retry_due(tuyen_id, updated_at=None):
+    """True (và giữ chỗ ROUTE_SHAPE_RETRY_SEC) nếu đã tới lúc thử dựng lại shape đường thẳng của tuyến."""
+    if updated_at is not None and (datetime.utcnow() - updated_at).total_seconds() < ROUTE_SHAPE_RETRY_SEC:
+        return False
+    now = time.time()
+    if _SHAPE_RETRY_AFTER.get(tuyen_id, 0.0) > now:
+        return False
+    _SHAPE_RETRY_AFTER[tuyen_id] = now + ROUTE_SHAPE_RETRY_SEC
+    return True
+
+
+def build_route_shape(tuyen, dir_):
+    """
+    Dựng polyline cho tuyến/hướng từ danh sách trạm có tọa độ (theo thứ tự) và lưu vào hinh_dang_tuyen.
+    - Tuyến dài: chia cửa sổ OSRM_MAX_COORDS (chồng 1 điểm) rồi nối lại.
+    - OSRM lỗi: lưu đường thẳng nối các trạm (source=straight), lần sau sẽ dựng lại.
+    Trả HinhDangTuyen hoặc None nếu hướng chưa đủ 2 trạm có tọa độ.
+    """
+    dir_clean = normalize_direction(dir_)
+    stops = _load_stop_rows(tuyen, dir_clean)
+    stops.sort(key=lambda s: (s.thuTuTrenTuyen or 0, s.maTram or 0))
+    coord_stops = [s for s in stops if s.lat is not None and s.lng is not None]
+
+    shape = HinhDangTuyen.query.filter_by(tuyen_id=tuyen.maTuyen, huong=dir_clean).first()
+    if len(coord_stops) < 2:
+        if shape:
+            db.session.delete(shape)
+            db.session.commit()
+        return None
+
+    points = [(float(s.lng), float(s.lat)) for s in coord_stops]
+    windows = _chunk_windows(len(points), OSRM_MAX_COORDS)
+    line = []
+    distance_m = 0.0
+    duration_s = 0.0
+    try:
+        for (a, b) in windows:
+            entry, _ = _route_geometry(points[a:b])
+            coords = list((entry.get("geometry") or {}).get("coordinates") or [])
+            if not coords:
+                raise OsrmError("OSRM không trả geometry")
+            line.extend(coords[1:] if line else coords)
+            distance_m += float(entry.get("distance_m") or 0.0)
+            duration_s += float(entry.get("duration_s") or 0.0)
+        source = "osrm_chunked" if len(windows) > 1 else "osrm"
+    except OsrmError:
+        line = [[lng, lat] for (lng, lat) in points]
+        distance_m = None
+        duration_s = None
+        source = "straight"
+
+    geometry = json.dumps({"type": "LineString", "coordinates": line}, separators=(",", ":"))
+    sig = _stops_signature(coord_stops)
+    if shape is not None and (shape.geometry, shape.signature, shape.source) == (geometry, sig, source):
+        return shape  # không đổi (vd OSRM vẫn lỗi -> vẫn đường thẳng): không ghi DB
+    if shape is None:
+        shape = HinhDangTuyen(tuyen_id=tuyen.maTuyen, huong=dir_clean, version=0)
+        db.session.add(shape)
+    if shape.geometry != geometry or shape.signature != sig:
+        shape.version = int(shape.version or 0) + 1
+    shape.signature = sig
+    shape.geometry = geometry
+    shape.distance_m = distance_m
+    shape.duration_s = duration_s
+    shape.source = source
+    shape.updated_at = datetime.utcnow()
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # worker khác vừa dựng cùng tuyến/hướng
+        db.session.rollback()
+        shape = HinhDangTuyen.query.filter_by(tuyen_id=tuyen.maTuyen, huong=dir_clean).first()
+    return shape
+
+
+def schedule_route_shape_rebuild(tuyen_id):
+    """Dựng lại shape cả 2 hướng ở thread nền (gọi sau khi admin sửa trạm)."""
+    def _job():
+        tuyen = db.session.get(TuyenXe, tuyen_id)
+        if tuyen:
+            for d in ("DI", "VE"):
+                build_route_shape(tuyen, d)
+
+    _ROUTE_SHAPE_REBUILDER.submit(("shape", int(tuyen_id)), _job)
+
+
+# ==================== GIỜ ĐẾN TRẠM (STOP TIMES) ====================
+# gio_den_tram = (chuyến, trạm, den_luc) dựng sẵn: trang trạm chỉ cần 1 range scan theo
+# (tram_id, den_luc) + LIMIT thay vì tính offset và duyệt mọi chuyến trong ngày mỗi lần xem.
+
+_STOP_TIMES_REBUILDER = _BackgroundRefresher(1, 256, "stop-times")
+
+
+def _offsets_hash(offsets):
+    raw = json.dumps(sorted((int(k), round(float(v), 1)) for k, v in (offsets or {}).items()))
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()[:16]
+
+
+def _stop_times_window(now=None):
+    now = now or datetime.now()
+    return now - timedelta(minutes=BUS_SCHEDULER_BACKFILL_MIN), now + timedelta(minutes=BUS_SCHEDULE_HORIZON_MIN)
+
+
+def _insert_stop_times(conn, rows, update=False):
+    """
+    Ghi dòng gio_den_tram bỏ qua (hoặc `update`: ghi đè) dòng trùng (trip_key, tram_id)
+    mà job khác vừa ghi, thay vì lỗi cả lô.
+    """
+    tbl = GioDenTram.__table__
+    keys = ["trip_key", "tram_id"]
+    if conn.dialect.name in ("sqlite", "postgresql"):
+        if conn.dialect.name == "sqlite":
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        stmt = dialect_insert(tbl)
+        if update:
+            stmt = stmt.on_conflict_do_update(
+                index_elements=keys,
+                set_={c: stmt.excluded[c] for c in ("tuyen_id", "huong", "khoi_hanh_luc", "den_luc", "offsets_hash")},
+            )
+        else:
+            stmt = stmt.on_conflict_do_nothing(index_elements=keys)
+        for i in range(0, len(rows), 1000):
+            conn.execute(stmt, rows[i:i + 1000])
+        return
+
+    for row in rows:
+        try:
+            with conn.begin_nested():
+                conn.execute(tbl.insert().values(**row))
+        except IntegrityError:
+            if update:
+                conn.execute(
+                    tbl.update()
+                    .where(tbl.c.trip_key == row["trip_key"], tbl.c.tram_id == row["tram_id"])
+                    .values(**row)
+                )
+
+
+def build_stop_times(tuyen, dir_, start_dt, end_dt, replace=False):
+    """
+    Ghi gio_den_tram cho các chuyến xuất bến trong [start_dt, end_dt] của 1 tuyến/hướng (bulk insert).
+    `replace=True`: xóa dòng cũ từ start_dt trở đi trước (offset/lịch/chuyến đã đổi). Trả số dòng ghi.
+    """
+    dir_ = normalize_direction(dir_)
+    offsets_data = get_stop_offsets(tuyen, dir_)
+    offsets = (offsets_data.get("offsets") or {}) if offsets_data.get("ok") else {}
+    offsets_hash = _offsets_hash(offsets)
+    stop_offsets = sorted(
+        ((int(tram_id), float(off_s)) for tram_id, off_s in offsets.items() if off_s is not None),
+        key=lambda x: x[1],
+    )
+
+    tbl = GioDenTram.__table__
+    rows = []
+    if stop_offsets:
+        for dep in upcoming_departures(tuyen, start_dt, end_dt, dirs=(dir_,)):
+            trip_key = str(dep.trip_id)
+            for tram_id, off_s in stop_offsets:
+                rows.append({
+                    "tram_id": tram_id,
+                    "tuyen_id": tuyen.maTuyen,
+                    "huong": dir_,
+                    "trip_key": trip_key,
+                    "khoi_hanh_luc": dep.depart_dt,
+                    "den_luc": dep.depart_dt + timedelta(seconds=off_s),
+                    "offsets_hash": offsets_hash,
+                })
+
+    # ghi bằng connection riêng: không đụng transaction/ORM object của session gọi hàm
+    with db.engine.begin() as conn:
+        if replace:
+            conn.execute(tbl.delete().where(
+                tbl.c.tuyen_id == tuyen.maTuyen, tbl.c.huong == dir_, tbl.c.khoi_hanh_luc >= start_dt,
+            ))
+        _insert_stop_times(conn, rows, update=replace)
+    return len(rows)
+
+
+def _stop_times_covered_until(tuyen_id, dir_):
+    tbl = GioDenTram.__table__
+    with db.engine.connect() as conn:
+        return conn.execute(
+            db.select(func.max(tbl.c.khoi_hanh_luc)).where(tbl.c.tuyen_id == tuyen_id, tbl.c.huong == dir_)
+        ).scalar()
+
+
+def extend_stop_times(now=None):
+    """
+    Job nền: nối tiếp gio_den_tram tới now + BUS_SCHEDULE_HORIZON_MIN cho mọi tuyến/hướng
+    (chỉ phần chưa dựng) và xóa dòng đã qua hơn 1 ngày. Trả số dòng mới.
+    """
+    now = now or datetime.now()
+    start_dt, end_dt = _stop_times_window(now)
+    tbl = GioDenTram.__table__
+    with db.engine.begin() as conn:
+        conn.execute(tbl.delete().where(tbl.c.den_luc < now - timedelta(days=1)))
+
+    created = 0
+    stats = stop_stats_by_route()
+    for tuyen in TuyenXe.query.order_by(TuyenXe.maTuyen).all():
+        for d in ("DI", "VE"):
+            if not stats.get(tuyen.maTuyen, {}).get(d, {}).get("stops"):
+                continue
+            covered = _stop_times_covered_until(tuyen.maTuyen, d)
+            from_dt = max(start_dt, covered + timedelta(seconds=1)) if covered else start_dt
+            if from_dt <= end_dt:
+                created += build_stop_times(tuyen, d, from_dt, end_dt)
+    return created
+
+
+def add_trip_stop_times(trips, now=None):
+    """
+    Ghi thêm gio_den_tram cho chuyến vừa sinh [(tuyen_id, huong, giờ xuất bến)] nằm trong vùng đã dựng
+    của tuyến/hướng đó (dòng đã có được bỏ qua). Phần sau vùng đã dựng để `extend_stop_times` nối tiếp.
+    Trả số dòng ghi.
+    """
+    start_dt, end_dt = _stop_times_window(now)
+    spans = {}
+    for tuyen_id, huong, depart_dt in trips:
+        if depart_dt is None:
+            continue
+        key = (int(tuyen_id), normalize_direction(huong))
+        lo, hi = spans.get(key, (depart_dt, depart_dt))
+        spans[key] = (min(lo, depart_dt), max(hi, depart_dt))
+
+    total = 0
+    for (tuyen_id, d), (lo, hi) in sorted(spans.items()):
+        covered = _stop_times_covered_until(tuyen_id, d)
+        if covered is None:
+            continue  # hướng chưa dựng: extend_stop_times dựng cả vùng
+        lo, hi = max(lo, start_dt), min(hi, covered, end_dt)
+        tuyen = db.session.get(TuyenXe, tuyen_id)
+        if tuyen and lo <= hi:
+            total += build_stop_times(tuyen, d, lo, hi)
+    return total
+
+
+def rebuild_stop_times(tuyen, dirs=("DI", "VE"), force=False, now=None):
+    """
+    Dựng lại gio_den_tram từ (now - backfill) cho tuyến. Không `force` thì chỉ dựng lại hướng
+    có offset trạm khác lúc dựng (offsets_hash lệch).
+    """
+    now = now or datetime.now()
+    start_dt, end_dt = _stop_times_window(now)
+    tbl = GioDenTram.__table__
+    total = 0
+    for d in dirs:
+        d = normalize_direction(d)
+        if not force:
+            offsets_data = get_stop_offsets(tuyen, d)
+            current = _offsets_hash(offsets_data.get("offsets") if offsets_data.get("ok") else {})
+            with db.engine.connect() as conn:
+                outdated = conn.execute(
+                    db.select(tbl.c.id).where(
+                        tbl.c.tuyen_id == tuyen.maTuyen, tbl.c.huong == d,
+                        tbl.c.khoi_hanh_luc >= start_dt, tbl.c.offsets_hash != current,
+                    ).limit(1)
+                ).first()
+            if outdated is None:
+                continue
+        covered = _stop_times_covered_until(tuyen.maTuyen, d)
+        total += build_stop_times(tuyen, d, start_dt, max(end_dt, covered or end_dt), replace=True)
+    return total
+
+
+def schedule_stop_times_rebuild(tuyen_id, dirs=("DI", "VE"), force=True):
+    """Dựng lại gio_den_tram ở thread nền (admin sửa tuyến/trạm/chuyến, hoặc offset trạm đổi)."""
+    if not STOP_TIMES_ENABLED:
+        return
+
+    def _job():
+        tuyen = db.session.get(TuyenXe, tuyen_id)
+        if tuyen:
+            rebuild_stop_times(tuyen, dirs=dirs, force=force)
+
+    _STOP_TIMES_REBUILDER.submit(("stop_times", int(tuyen_id), tuple(dirs), bool(force)), _job)
+
+
+def _notify_offsets_changed(cache_key, stale, value):
+    # offset mới khác bản cũ (hoặc process chưa biết bản cũ) -> kiểm tra/dựng lại ở nền
+    if stale is not None and (stale.get("offsets") or {}) == (value.get("offsets") or {}):
+        return
+    tuyen_id, dir_ = cache_key[0], cache_key[1]
+    schedule_stop_times_rebuild(tuyen_id, dirs=(dir_,), force=False)
+
+
+def next_stop_times(stop_id, start_dt, end_dt, limit):
+    """N chuyến tới trạm trong [start_dt, end_dt] từ gio_den_tram (index (tram_id, den_luc))."""
+    return (
+        GioDenTram.query
+        .filter(GioDenTram.tram_id == stop_id, GioDenTram.den_luc >= start_dt, GioDenTram.den_luc <= end_dt)
+        .order_by(GioDenTram.den_luc.asc(), GioDenTram.id.asc())
+        .limit(limit)
+        .all()
+    )
+
+
+# ==================== PHIÊN BẢN DỮ LIỆU TUYẾN & ETAG ====================
+# Mọi flush ghi TuyenXe/TramDung/ChuyenXe qua ORM tăng tuyen_xe.data_version trong cùng transaction,
+# nên ETag "r<id>-v<version>-..." đổi ngay khi admin sửa và giống nhau giữa các worker.
+
+@db.event.listens_for(db.session, "after_flush")
+def _bump_route_data_versions(session, flush_context):
+    route_ids = set()
+    for obj in itertools.chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, TuyenXe):
+            if obj not in session.new and obj not in session.deleted and session.is_modified(obj):
+                route_ids.add(obj.maTuyen)
+        elif isinstance(obj, (TramDung, ChuyenXe)):
+            if obj in session.dirty and not session.is_modified(obj):
+                continue
+            hist = db.inspect(obj).attrs.tuyen_id.history
+            # cả tuyến cũ lẫn tuyến mới khi trạm/chuyến bị chuyển tuyến
+            route_ids.update(v for v in itertools.chain(hist.added, hist.unchanged, hist.deleted) if v is not None)
+    bump_route_data_versions(session.connection(), route_ids)
+
+
+def bump_route_data_versions(conn, route_ids):
+    """
+    Tăng tuyen_xe.data_version cho các tuyến (ETag đổi). Ghi bằng Core update()/delete() trên
+    trạm/chuyến không qua hook after_flush -> phải gọi hàm này trong cùng transaction.
+    """
+    route_ids = sorted({int(r) for r in route_ids if r is not None})
+    if not route_ids:
+        return
+    tbl = TuyenXe.__table__
+    conn.execute(
+        tbl.update()
+        .where(tbl.c.maTuyen.in_(route_ids))
+        .values(data_version=tbl.c.data_version + 1)
+    )
+
+
+def _route_etag(tuyen, kind, *parts):
+    return "-".join([f"r{tuyen.maTuyen}", f"v{tuyen.data_version or 0}", kind, *[str(p) for p in parts]])
+
+
+def _not_modified(etag):
+    """
+    304 nếu If-None-Match khớp (kể cả biến thể -gzip/-br do nén response), ngược lại None.
+    304 mang đúng ETag của bản client đang giữ (ưu tiên bản nén theo Accept-Encoding hiện tại),
+    giống ETag mà `_compress_response` gắn cho response 200.
+    """
+    if not etag:
+        return None
+    inm = request.if_none_match
+    tags = [etag, f"{etag}-gzip", f"{etag}-br"]
+    encoding = _pick_encoding(request.accept_encodings) if COMPRESS_ENABLED else None
+    if encoding:
+        tags.insert(0, tags.pop(tags.index(f"{etag}-{encoding}")))
+    matched = next((tag for tag in tags if inm.contains(tag)), None)
+    if matched is None:
+        return None
+    resp = app.response_class(status=304)
+    resp.set_etag(matched)
+    resp.headers["Cache-Control"] = "no-cache"
+    if COMPRESS_ENABLED:
+        resp.vary.add("Accept-Encoding")
+    return resp
+
+
+def _json_with_etag(payload, etag):
+    """
+    Trả JSON kèm strong ETag; client gửi If-None-Match khớp -> 304 không body.
+    `Cache-Control: no-cache` = được cache nhưng phải hỏi lại server (dữ liệu đổi khi admin sửa).
+    """
+    not_modified = _not_modified(etag)
+    if not_modified is not None:
+        return not_modified
+    resp = jsonify(payload)
+    if etag:
+        resp.set_etag(etag)
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp
+
 
-    out_items = []
-    for s in offsets_data.get("items") or []:
-        offset_s = offsets_data["offsets"].get(s.maTram)
-        dist_m = offsets_data.get("dist_m", {}).get(s.maTram)
+# ==================== NÉN RESPONSE (GZIP/BROTLI) ====================
+_COMPRESSIBLE_MIMETYPES = {"application/json", "text/html", "text/css", "text/javascript", "application/javascript", "text/plain"}
 
-        eta_iso = None
-        eta_hhmm = None
-        eta_in_min = None
 
-        if offset_s is not None:
-            target_depart_s = max(start_s, at_s - int(round(float(offset_s))))
-            k = _ceil_div_int(max(0, target_depart_s - start_s), headway_s)
-            depart_s = start_s + k * headway_s
-            if depart_s <= end_s:
-                eta_dt = base + timedelta(seconds=(depart_s + float(offset_s)))
-                eta_iso = eta_dt.isoformat(timespec="seconds")
-                eta_hhmm = eta_dt.strftime("%H:%M")
-                eta_in_min = int(round((eta_dt - at).total_seconds() / 60.0))
+def _pick_encoding(accept_encoding):
+    if brotli is not None and accept_encoding["br"]:
+        return "br"
+    if accept_encoding["gzip"]:
+        return "gzip"
+    return None
 
-        out_items.append({
-            "stop_id": s.maTram,
-            "order": s.thuTuTrenTuyen,
-            "name": s.tenTram,
-            "address": s.diaChi,
-            "lat": float(s.lat) if s.lat is not None else None,
-            "lng": float(s.lng) if s.lng is not None else None,
-            "offset_s": float(offset_s) if offset_s is not None else None,
-            "distance_m": float(dist_m) if dist_m is not None else None,
-            "eta_iso": eta_iso,
-            "eta_time": eta_hhmm,
-            "eta_in_min": eta_in_min,
-        })
 
-    return {
-        "ok": True,
-        "route_id": tuyen.maTuyen,
-        "route_code": tuyen.maHienThi,
-        "direction": normalize_direction(dir_),
-        "as_of": at.isoformat(timespec="seconds"),
-        "operating_hours": tuyen.thoiGianHoatDong,
-        "headway_min": headway_min,
-        "offset_source": offsets_data.get("source"),
-        "items": out_items,
-    }
+@app.after_request
+def _compress_response(resp):
+    if not COMPRESS_ENABLED:
+        return resp
+    if (
+        resp.status_code != 200
+        or resp.direct_passthrough
+        or resp.is_streamed
+        or "Content-Encoding" in resp.headers
+        or resp.mimetype not in _COMPRESSIBLE_MIMETYPES
+    ):
+        return resp
+    resp.vary.add("Accept-Encoding")
+    encoding = _pick_encoding(request.accept_encodings)
+    if encoding is None:
+        return resp
+    body = resp.get_data()
+    if len(body) < COMPRESS_MIN_BYTES:
+        return resp
+
+    if encoding == "br":
+        data = brotli.compress(body, quality=max(0, min(11, COMPRESS_LEVEL)))
+    else:
+        data = gzip.compress(body, compresslevel=max(1, min(9, COMPRESS_LEVEL)), mtime=0)
+    resp.set_data(data)
+    resp.headers["Content-Encoding"] = encoding
+    # strong ETag theo từng bản nén (byte khác nhau); _not_modified chấp nhận cả 2 dạng
+    etag, weak = resp.get_etag()
+    if etag and not weak:
+        resp.set_etag(f"{etag}-{encoding}")
+    return resp
 
 
 @app.context_processor
@@ -938,52 +4096,46 @@ def routes():
 def route_detail(tuyen_id):
     tuyen = TuyenXe.query.get_or_404(tuyen_id)
 
+    # chỉ lấy chuyến sắp tới (giữ gọn UI) – tính từ lịch headway, không quét bảng chuyen_xe
     now = datetime.now()
-    ensure_upcoming_trips(tuyen, now=now)
-
-    today = now.strftime("%Y-%m-%d")
-    now_min = now.hour * 60 + now.minute
-
-    def _to_min(hhmm):
-        m = re.match(r"^\s*(\d{1,2})\s*:\s*(\d{2})\s*$", str(hhmm or ""))
-        if not m:
-            return None
-        h = int(m.group(1))
-        mi = int(m.group(2))
-        if h < 0 or h > 23 or mi < 0 or mi > 59:
-            return None
-        return h * 60 + mi
-
-    all_today = (
-        ChuyenXe.query
-        .filter(ChuyenXe.tuyen_id == tuyen_id, ChuyenXe.ngayKhoiHanh == today)
-        .order_by(ChuyenXe.gioKhoiHanh.asc(), ChuyenXe.huong.asc(), ChuyenXe.maChuyen.asc())
-        .all()
-    )
-
-    # chỉ lấy chuyến sắp tới (giữ gọn UI) – bus đô thị thường hiển thị upcoming departures
-    trips = []
-    for t in all_today:
-        t_min = _to_min(t.gioKhoiHanh)
-        if t_min is None:
-            continue
-        if t_min >= now_min - 5:
-            trips.append(t)
-        if len(trips) >= 12:
-            break
+    end_of_day = datetime.combine(now.date(), datetime.max.time())
+    trips = list(itertools.islice(upcoming_departures(tuyen, now - timedelta(minutes=5), end_of_day), 12))
 
     return render_template(
         "route_detail.html",
         tuyen=tuyen,
         trips=trips,
+        eta_stream=ETA_STREAM_ENABLED,
+        eta_refresh_sec=ETA_STREAM_TICK_SEC,
     )
 
 
 @app.route("/trips/<int:trip_id>")
 def trip_detail(trip_id):
-    user = current_user()
     trip = ChuyenXe.query.get_or_404(trip_id)
     tuyen = trip.tuyen  # quan hệ backref từ TuyenXe -> ChuyenXe
+    return _render_trip_detail(trip, tuyen, trip_code=f"#{trip.maChuyen}")
+
+
+@app.route("/trips/v/<token>")
+def virtual_trip_detail(token):
+    # Chuyến ảo (lịch headway): không có dòng chuyen_xe, dựng ChuyenXe tạm (không add vào session)
+    resolved = resolve_virtual_trip(token)
+    if not resolved:
+        abort(404)
+    tuyen, dep = resolved
+    if not dep.virtual:
+        return redirect(url_for("trip_detail", trip_id=dep.trip_id, **request.args))
+
+    trip = ChuyenXe(
+        tuyen_id=tuyen.maTuyen, ngayKhoiHanh=dep.date, gioKhoiHanh=dep.time, huong=dep.huong,
+        khoiHanhLuc=dep.depart_dt,
+    )
+    return _render_trip_detail(trip, tuyen, trip_code=dep.time)
+
+
+def _render_trip_detail(trip, tuyen, trip_code):
+    user = current_user()
 
     # nếu URL có ?mode=admin thì hiểu là xem từ trang admin
     is_admin_mode = request.args.get("mode") == "admin"
@@ -996,11 +4148,7 @@ def trip_detail(trip_id):
     danh_sach_tram = _query_stops_by_direction(tuyen, direction).all()
     stops_geo = build_stops_geo(danh_sach_tram, route_code=tuyen.maHienThi)
 
-    trip_dt = None
-    try:
-        trip_dt = datetime.strptime(f"{trip.ngayKhoiHanh} {trip.gioKhoiHanh}", "%Y-%m-%d %H:%M")
-    except Exception:
-        trip_dt = None
+    trip_dt = trip.khoiHanhLuc or parse_trip_departure(trip.ngayKhoiHanh, trip.gioKhoiHanh)
     is_past_trip = bool(trip_dt and trip_dt < datetime.utcnow())
 
     stop_times = []
@@ -1034,6 +4182,7 @@ def trip_detail(trip_id):
     return render_template(
         "trip_detail.html",
         trip=trip,
+        trip_code=trip_code,
         tuyen=tuyen,
         stops=danh_sach_tram,
         stop_times=stop_times,
@@ -1059,81 +4208,66 @@ def stop_detail(stop_id):
 
     now = datetime.now()
 
-    # backfill để không bỏ sót chuyến đã xuất bến nhưng chưa tới trạm
+    # offset của trạm so với điểm xuất bến -> ETA từng chuyến
     offsets_data = get_stop_offsets(tuyen, direction)
     offset_s = None
     if offsets_data.get("ok"):
         offset_s = offsets_data.get("offsets", {}).get(stop.maTram)
 
-    backfill_min = 30
-    try:
-        if offset_s is not None:
-            backfill_min = max(30, min(180, int(math.ceil(float(offset_s) / 60.0)) + 5))
-    except Exception:
-        backfill_min = 30
-
-    ensure_upcoming_trips(
-        tuyen,
-        now=(now - timedelta(minutes=backfill_min)),
-        horizon_min=(backfill_min + BUS_SCHEDULE_HORIZON_MIN),
-    )
-
-    today = now.strftime("%Y-%m-%d")
-
     try:
         limit = int(request.args.get("limit") or 20)
     except Exception:
         limit = 20
     limit = max(5, min(limit, 60))
 
-    upcoming = []
-    trips = (
-        ChuyenXe.query
-        .filter(
-            ChuyenXe.tuyen_id == tuyen.maTuyen,
-            ChuyenXe.ngayKhoiHanh == today,
-            ChuyenXe.huong == direction,
-        )
-        .order_by(ChuyenXe.gioKhoiHanh.asc(), ChuyenXe.maChuyen.asc())
-        .all()
-    )
-
-    for t in trips:
-        try:
-            if not (t.ngayKhoiHanh and t.gioKhoiHanh):
-                continue
-            depart_dt = datetime.strptime(f"{t.ngayKhoiHanh} {t.gioKhoiHanh}", "%Y-%m-%d %H:%M")
-        except Exception:
-            continue
-
-        eta_dt = None
-        if offset_s is not None:
-            try:
-                eta_dt = depart_dt + timedelta(seconds=float(offset_s))
-            except Exception:
-                eta_dt = None
-
-        # Nếu không có offset, fallback lọc theo giờ xuất bến (ít ý nghĩa với trạm giữa tuyến)
-        ref_dt = eta_dt or depart_dt
-        if ref_dt < (now - timedelta(minutes=1)):
-            continue
-
-        eta_in_min = int(round((ref_dt - now).total_seconds() / 60.0))
-        eta_in_min = max(0, eta_in_min)
+    end_of_day = datetime.combine(now.date(), datetime.max.time())
 
-        upcoming.append({
-            "trip_id": t.maChuyen,
-            "date": t.ngayKhoiHanh,
-            "depart_time": t.gioKhoiHanh,
+    def _item(trip_id, virtual, depart_dt, ref_dt, detail_url):
+        return {
+            "trip_id": trip_id,
+            "virtual": virtual,
+            "date": depart_dt.strftime("%Y-%m-%d"),
+            "depart_time": depart_dt.strftime("%H:%M"),
             "direction": direction,
             "eta_time": ref_dt.strftime("%H:%M"),
             "eta_iso": ref_dt.isoformat(timespec="seconds"),
-            "eta_in_min": eta_in_min,
-            "detail_url": url_for("trip_detail", trip_id=t.maChuyen),
-        })
+            "eta_in_min": max(0, int(round((ref_dt - now).total_seconds() / 60.0))),
+            "detail_url": detail_url,
+        }
+
+    upcoming = []
+    if STOP_TIMES_ENABLED and offset_s is not None:
+        # Bảng gio_den_tram dựng sẵn: 1 range scan (tram_id, den_luc) + LIMIT
+        for st in next_stop_times(stop.maTram, now - timedelta(minutes=1), end_of_day, limit):
+            virtual = st.trip_key.startswith("v")
+            detail_url = (
+                url_for("virtual_trip_detail", token=st.trip_key) if virtual
+                else url_for("trip_detail", trip_id=int(st.trip_key))
+            )
+            trip_id = st.trip_key if virtual else int(st.trip_key)
+            upcoming.append(_item(trip_id, virtual, st.khoi_hanh_luc, st.den_luc, detail_url))
+
+    if not upcoming:
+        # Chưa dựng gio_den_tram (job chưa chạy/tắt): tính từ lịch.
+        # Chuyến tới trạm từ giờ tới cuối ngày: xuất bến từ (now - offset) nên tính cả chuyến đã rời bến đầu.
+        lead = timedelta(seconds=float(offset_s or 0)) + timedelta(minutes=1)
+        start_dt = max(now - lead, datetime.combine(now.date(), datetime.min.time()))
+        for dep in upcoming_departures(tuyen, start_dt, end_of_day, dirs=(direction,)):
+            eta_dt = None
+            if offset_s is not None:
+                try:
+                    eta_dt = dep.depart_dt + timedelta(seconds=float(offset_s))
+                except Exception:
+                    eta_dt = None
+
+            # Nếu không có offset, fallback lọc theo giờ xuất bến (ít ý nghĩa với trạm giữa tuyến)
+            ref_dt = eta_dt or dep.depart_dt
+            if ref_dt < (now - timedelta(minutes=1)):
+                continue
 
-    upcoming.sort(key=lambda x: (x.get("eta_iso") or "9999", x.get("trip_id") or 0))
-    upcoming = upcoming[:limit]
+            upcoming.append(_item(dep.trip_id, dep.virtual, dep.depart_dt, ref_dt, departure_detail_url(dep)))
+            if len(upcoming) >= limit:
+                break
 
     stop_geo = {
         "id": stop.maTram,
@@ -1343,6 +4477,7 @@ def admin_routes():
             tuyen.soChuyenMoiNgay = so_chuyen_val
             tuyen.giaVe = gia_ve or None
             db.session.commit()
+            schedule_stop_times_rebuild(tuyen.maTuyen)
             flash("Đã cập nhật tuyến thành công!")
             return redirect(url_for("admin_routes"))
 
@@ -1374,6 +4509,7 @@ def admin_routes():
             flash("Đã thêm tuyến mới thành công!")
 
         db.session.commit()
+        schedule_stop_times_rebuild(tuyen.maTuyen)
         return redirect(url_for("admin_routes"))
 
     danh_sach_tuyen = TuyenXe.query.order_by(TuyenXe.maTuyen).all()
@@ -1506,10 +4642,14 @@ def admin_route_stops(tuyen_id):
                 tram.tenTram = ten_tram
                 tram.diaChi = dia_chi
                 tram.thuTuTrenTuyen = int(thu_tu)
+                if (tram.lat, tram.lng) != (float(lat), float(lng)):
+                    tram.nhom_id = None  # đã dời chỗ: chờ build_stop_groups gom lại
                 tram.lat = float(lat)
                 tram.lng = float(lng)
                 tram.huong = huong
                 db.session.commit()
+                schedule_route_shape_rebuild(tuyen_id)
+                schedule_stop_times_rebuild(tuyen_id)
                 flash("Đã cập nhật trạm dừng.")
             else:
                 flash("Không tìm thấy trạm để cập nhật.")
@@ -1525,6 +4665,8 @@ def admin_route_stops(tuyen_id):
             )
             db.session.add(tram)
             db.session.commit()
+            schedule_route_shape_rebuild(tuyen_id)
+            schedule_stop_times_rebuild(tuyen_id)
             flash("Đã thêm trạm dừng mới.")
 
         return redirect(url_for("admin_route_stops", tuyen_id=tuyen_id))
@@ -1561,8 +4703,11 @@ def admin_delete_stop(tuyen_id, tram_id):
         flash("Trạm không thuộc tuyến này.")
         return redirect(url_for("admin_route_stops", tuyen_id=tuyen_id))
 
+    GioDenTram.query.filter_by(tram_id=tram.maTram).delete()
     db.session.delete(tram)
     db.session.commit()
+    schedule_route_shape_rebuild(tuyen_id)
+    schedule_stop_times_rebuild(tuyen_id)
     flash("Đã xóa trạm dừng.")
 
     return redirect(url_for("admin_route_stops", tuyen_id=tuyen_id))
@@ -1605,6 +4750,7 @@ def admin_route_trips(tuyen_id):
                 db.session.add(trip)
                 try:
                     db.session.commit()
+                    schedule_stop_times_rebuild(tuyen.maTuyen, dirs=(huong,))
                     flash("Đã thêm chuyến mới.")
                 except Exception:
                     db.session.rollback()
@@ -1630,6 +4776,7 @@ def admin_route_trips(tuyen_id):
                     trip.huong = huong
                     try:
                         db.session.commit()
+                        schedule_stop_times_rebuild(tuyen.maTuyen)
                         flash("Đã cập nhật chuyến.")
                     except Exception:
                         db.session.rollback()
@@ -1676,6 +4823,9 @@ def delete_route(tuyen_id):
         flash("Không thể xóa tuyến vì vẫn còn chuyến xe hoặc trạm dừng. Hãy xóa hết trước.")
         return redirect(url_for("admin_routes"))
 
+    HinhDangTuyen.query.filter_by(tuyen_id=tuyen.maTuyen).delete()
+    TongHopChuyenNgay.query.filter_by(tuyen_id=tuyen.maTuyen).delete()
+    GioDenTram.query.filter_by(tuyen_id=tuyen.maTuyen).delete()
     db.session.delete(tuyen)
     db.session.commit()
     flash(f"Đã xóa tuyến {tuyen.maHienThi}.")
@@ -1698,18 +4848,26 @@ def delete_trip(trip_id):
 
     db.session.delete(trip)
     db.session.commit()
+    schedule_stop_times_rebuild(tuyen_id, dirs=(normalize_direction(trip.huong),))
     flash(f"Đã xóa chuyến #{trip.maChuyen}.")
     return redirect(url_for("admin_route_trips", tuyen_id=tuyen_id))
 
-@app.route("/api/osrm/route", methods=["POST"])
+@app.route("/api/osrm/route", methods=["GET", "POST"])
 def api_osrm_route():
     """
-    Input JSON: { "coords": [[lat, lng], [lat, lng], ...] }  (>=2 điểm)
-    Output: { ok, distance_m, duration_s, geometry }
-    geometry: GeoJSON LineString (coordinates = [lng, lat])
+    Input JSON (POST): { "coords": [[lat, lng], [lat, lng], ...] }  (>=2 điểm)
+    Hoặc GET ?coords=lat,lng;lat,lng;... (để browser/CDN cache + If-None-Match)
+    Output: { ok, distance_m, duration_s, geometry, format, points, cached }
+    geometry: GeoJSON LineString (coordinates = [lng, lat]) hoặc chuỗi polyline6 (?format=polyline6)
+    ?simplify=<mét> / ?zoom=<0-20>: rút gọn Douglas-Peucker phía server (cache theo sai số).
+    Kết quả được cache (L1 + bảng cache_duong_di) theo hash tọa độ + profile, kèm ETag.
     """
-    data = request.get_json(silent=True) or {}
-    coords = data.get("coords")
+    if request.method == "GET":
+        raw = (request.args.get("coords") or "").strip()
+        coords = [p.split(",") for p in raw.split(";") if p.strip()] if raw else None
+    else:
+        data = request.get_json(silent=True) or {}
+        coords = data.get("coords")
 
     if not isinstance(coords, list) or len(coords) < 2:
         return jsonify({"ok": False, "error": "coords phải là list và có ít nhất 2 điểm"}), 400
@@ -1729,36 +4887,124 @@ def api_osrm_route():
     except Exception:
         return jsonify({"ok": False, "error": "coords có giá trị không chuyển được sang số"}), 400
 
-    coord_str = ";".join([f"{lng},{lat}" for (lng, lat) in points])
-    url = f"{OSRM_BASE_URL}/route/v1/{OSRM_PROFILE}/{coord_str}"
-    params = {"overview": "full", "geometries": "geojson", "steps": "false"}
+    # kiểm tra format/simplify/zoom trước khi gọi OSRM (zoom lấy vĩ độ từ điểm đầu vào)
+    try:
+        fmt, tolerance = parse_geometry_variant(request.args, points)
+    except ValueError as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
 
     try:
-        r = requests.get(url, params=params, timeout=OSRM_TIMEOUT, headers={"User-Agent": "smartbus-demo"})
-        j = r.json() if r.content else {}
-    except Exception as e:
+        entry, cached = _route_geometry(points)
+    except OsrmUnavailable as e:
+        # không chờ timeout khi OSRM đang chết; client tự vẽ đường thẳng
+        resp = jsonify({"ok": False, "error": "OSRM tạm thời không khả dụng", "detail": str(e)})
+        resp.status_code = 503
+        resp.headers["Retry-After"] = str(OSRM.breaker.retry_after())
+        return resp
+    except OsrmError as e:
+        if e.payload is not None:
+            return jsonify({"ok": False, "error": "OSRM không trả route", "raw": e.payload}), 502
         return jsonify({"ok": False, "error": "Gọi OSRM thất bại", "detail": str(e)}), 502
 
-    if r.status_code != 200 or j.get("code") != "Ok" or not j.get("routes"):
-        return jsonify({"ok": False, "error": "OSRM không trả route", "raw": j}), 502
-
-    route = j["routes"][0]
-    return jsonify({
+    coords_full = list((entry.get("geometry") or {}).get("coordinates") or [])
+    etag = _geometry_etag(entry)
+    variant_etag = _variant_etag(etag, fmt, tolerance)
+    not_modified = _not_modified(variant_etag)
+    if not_modified is not None:
+        return not_modified
+    variant = geometry_variant(etag, coords_full, fmt, tolerance)
+    return _json_with_etag({
         "ok": True,
-        "distance_m": route.get("distance"),
-        "duration_s": route.get("duration"),
-        "geometry": route.get("geometry"),
-    })
+        "distance_m": entry["distance_m"],
+        "duration_s": entry["duration_s"],
+        **variant,
+        "cached": cached,
+    }, variant_etag)
+
+
+@app.route("/api/routes/summary")
+def api_routes_summary():
+    # Tổng hợp mọi tuyến trong 1 request (dashboard /routes), 1 query GROUP BY cho thống kê trạm
+    routes = TuyenXe.query.order_by(TuyenXe.maTuyen).all()
+    stats = stop_stats_by_route([r.maTuyen for r in routes])
+    items = [build_route_summary(r, dir_stats=stats[r.maTuyen]) for r in routes]
+    return jsonify({"ok": True, "count": len(items), "items": items})
 
 
 @app.route("/api/routes/<int:tuyen_id>/summary")
 def api_route_summary(tuyen_id):
     tuyen = TuyenXe.query.get_or_404(tuyen_id)
-    return jsonify(build_route_summary(tuyen))
+    etag = _route_etag(tuyen, "summary")
+    not_modified = _not_modified(etag)
+    if not_modified is not None:
+        return not_modified
+    return _json_with_etag(build_route_summary(tuyen), etag)
+
+@app.route("/api/routes/<int:tuyen_id>/shape")
+def api_route_shape(tuyen_id):
+    """
+    Polyline đã tính sẵn của tuyến theo hướng (?dir=DI|VE), kèm version/ETag.
+    ?format=polyline6, ?simplify=<mét> / ?zoom=<0-20>: như /api/osrm/route.
+    - Chưa có shape: trả đường thẳng nối các trạm (stale=true, version=0), dựng ở nền -> GET không chờ OSRM.
+    - Trạm đã đổi (signature lệch): trả bản đang có, dựng lại ở nền. Shape là đường thẳng: như vậy
+      nhưng tối đa 1 lần / ROUTE_SHAPE_RETRY_SEC. Không xin dựng lại khi trả 304.
+    """
+    tuyen = TuyenXe.query.get_or_404(tuyen_id)
+    dir_ = normalize_direction(request.args.get("dir") or "DI")
+
+    coord_stops = [s for s in _load_stop_rows(tuyen, dir_) if s.lat is not None and s.lng is not None]
+    coord_stops.sort(key=lambda s: (s.thuTuTrenTuyen or 0, s.maTram or 0))
+    signature = _stops_signature(coord_stops)
+    shape = HinhDangTuyen.query.filter_by(tuyen_id=tuyen.maTuyen, huong=dir_).first()
+    if shape is None:
+        if len(coord_stops) < 2:
+            return jsonify({"ok": False, "error": "Tuyến chưa đủ 2 trạm có tọa độ để vẽ."}), 404
+        stale = rebuild = True
+        version, source, distance_m, duration_s, updated_at = 0, "straight", None, None, None
+        coords_full = [[float(s.lng), float(s.lat)] for s in coord_stops]
+    else:
+        moved = shape.signature != signature
+        stale = moved or shape.source == "straight"
+        rebuild = moved or (stale and _straight_shape_retry_due(tuyen.maTuyen, shape.updated_at))
+        version, source, signature = shape.version, shape.source, shape.signature
+        distance_m, duration_s, updated_at = shape.distance_m, shape.duration_s, shape.updated_at
+        coords_full = (json.loads(shape.geometry) or {}).get("coordinates") or []
+
+    etag = f"shape-{tuyen.maTuyen}-{dir_}-{version}-{signature[:12]}"
+    try:
+        fmt, tolerance = parse_geometry_variant(request.args, coords_full)
+    except ValueError as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
+
+    variant_etag = _variant_etag(etag, fmt, tolerance)
+    not_modified = _not_modified(variant_etag)
+    if not_modified is not None:
+        return not_modified
+    if rebuild:
+        schedule_route_shape_rebuild(tuyen.maTuyen)
+    variant = geometry_variant(etag, coords_full, fmt, tolerance)
+    return _json_with_etag({
+        "ok": True,
+        "route_id": tuyen.maTuyen,
+        "route_code": tuyen.maHienThi,
+        "direction": dir_,
+        "version": version,
+        "source": source,
+        "stale": stale,
+        "distance_m": distance_m,
+        "duration_s": duration_s,
+        **variant,
+        "updated_at": updated_at.isoformat(timespec="seconds") if updated_at else None,
+    }, variant_etag)
+
 
 @app.route("/api/routes/<int:tuyen_id>/endpoints")
 def api_route_endpoints(tuyen_id):
     tuyen = TuyenXe.query.get_or_404(tuyen_id)
+    etag = _route_etag(tuyen, "endpoints")
+    not_modified = _not_modified(etag)
+    if not_modified is not None:
+        return not_modified
 
     def pick_endpoints(dir_):
         stops = _query_stops_by_direction(tuyen, dir_).all()
@@ -1777,7 +5023,7 @@ def api_route_endpoints(tuyen_id):
     if not data:
         return jsonify({"ok": False, "error": "Tuyến chưa đủ 2 trạm có tọa độ để vẽ tổng quan."})
 
-    return jsonify({"ok": True, "route_id": tuyen.maTuyen, "route_code": tuyen.maHienThi, **data})
+    return _json_with_etag({"ok": True, "route_id": tuyen.maTuyen, "route_code": tuyen.maHienThi, **data}, etag)
 
 
 @app.route("/api/routes/<int:tuyen_id>/trips")
@@ -1791,39 +5037,22 @@ def api_route_trips(tuyen_id):
         limit = 12
     limit = max(1, min(limit, 50))
 
+    # Tính từ lịch headway (+ chuyến sửa tay trong chuyen_xe), dừng ngay khi đủ `limit`
     now = datetime.now()
-    ensure_upcoming_trips(tuyen, now=now)
-    today = now.strftime("%Y-%m-%d")
-
-    items = []
-    for t in (
-        ChuyenXe.query
-        .filter(ChuyenXe.tuyen_id == tuyen_id, ChuyenXe.ngayKhoiHanh == today)
-        .order_by(ChuyenXe.gioKhoiHanh.asc(), ChuyenXe.huong.asc(), ChuyenXe.maChuyen.asc())
-        .all()
-    ):
-        dt = None
-        try:
-            if t.ngayKhoiHanh and t.gioKhoiHanh:
-                dt = datetime.strptime(f"{t.ngayKhoiHanh} {t.gioKhoiHanh}", "%Y-%m-%d %H:%M")
-        except Exception:
-            dt = None
-
-        is_past = bool(dt and dt < now)
-        if is_past:
-            continue
-
-        items.append({
-            "trip_id": t.maChuyen,
-            "date": t.ngayKhoiHanh,
-            "time": t.gioKhoiHanh,
-            "direction": normalize_direction(getattr(t, "huong", None)),
-            "dt": dt.isoformat() if dt else None,
-            "detail_url": url_for("trip_detail", trip_id=t.maChuyen),
-        })
+    end_of_day = datetime.combine(now.date(), datetime.max.time())
 
-    items.sort(key=lambda x: (0 if x["dt"] else 1, x["dt"] or "9999", x["trip_id"]))
-    items = items[:limit]
+    items = [
+        {
+            "trip_id": dep.trip_id,
+            "virtual": dep.virtual,
+            "date": dep.date,
+            "time": dep.time,
+            "direction": dep.huong,
+            "dt": dep.depart_dt.isoformat(),
+            "detail_url": departure_detail_url(dep),
+        }
+        for dep in itertools.islice(upcoming_departures(tuyen, now, end_of_day), limit)
+    ]
 
     return jsonify({
         "ok": True,
@@ -1858,14 +5087,17 @@ def api_route_stop_offsets(tuyen_id):
             "distance_m": float(dist_m.get(s.maTram)) if dist_m.get(s.maTram) is not None else None,
         })
 
-    return jsonify({
+    # offset đổi cả khi không ai sửa tuyến (fallback -> OSRM), nên ETag kèm nguồn + hash offset
+    etag = _route_etag(tuyen, "offsets", dir_, data.get("source"), int(bool(data.get("stale"))), _offsets_hash(offsets)[:12])
+    return _json_with_etag({
         "ok": True,
         "route_id": tuyen.maTuyen,
         "route_code": tuyen.maHienThi,
         "direction": dir_,
         "source": data.get("source"),
+        "stale": bool(data.get("stale")),
         "items": items,
-    })
+    }, etag)
 
 
 @app.route("/api/routes/<int:tuyen_id>/stop_etas")
@@ -1887,6 +5119,324 @@ def api_route_stop_etas(tuyen_id):
     return jsonify(data)
 
 
+@app.route("/api/routes/<int:tuyen_id>/stop_etas/stream")
+def api_route_stop_etas_stream(tuyen_id):
+    """
+    SSE: ?dir=DI|VE. Sự kiện "snapshot" (toàn bộ trạm) khi kết nối, sau đó "delta" mỗi tick
+    chỉ gồm trạm có eta_in_min/eta_time đổi. Kết nối tự đóng sau ETA_STREAM_MAX_SEC.
+    Tắt (404) khi ETA_STREAM_ENABLED=0 để không chiếm worker sync.
+    """
+    if not ETA_STREAM_ENABLED:
+        return jsonify({"ok": False, "error": "Realtime SSE đang tắt (ETA_STREAM_ENABLED=0)."}), 404
+    tuyen = TuyenXe.query.get_or_404(tuyen_id)
+    dir_ = normalize_direction(request.args.get("dir") or "DI")
+
+    sub = ETA_STREAM.subscribe(tuyen.maTuyen, dir_)
+    if sub is None:
+        return jsonify({"ok": False, "error": "Quá nhiều kết nối realtime, hãy thử lại sau."}), 503
+    ch, q, snapshot = sub
+    keepalive_sec = max(5.0, min(25.0, ETA_STREAM.tick_sec * 2))
+
+    def stream():
+        deadline = time.time() + ETA_STREAM_MAX_SEC
+        try:
+            yield f"retry: {int(ETA_STREAM.tick_sec * 1000)}\n" + snapshot
+            while time.time() < deadline:
+                try:
+                    msg = q.get(timeout=min(keepalive_sec, max(0.1, deadline - time.time())))
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                if msg is None:
+                    break
+                yield msg
+        finally:
+            ETA_STREAM.unsubscribe(ch, q)
+
+    resp = app.response_class(stream(), mimetype="text/event-stream")
+    resp.headers["Cache-Control"] = "no-cache"
+    resp.headers["X-Accel-Buffering"] = "no"  # nginx: không buffer stream
+    return resp
+
+
+def _nearby_stop_groups(lat, lng, radius, limit):
+    items, seen = [], set()
+    for dist, st in STOP_INDEX.nearby(lat, lng, radius):
+        key = ("g", st.group_id) if st.group_id is not None else ("s", st.stop_id)
+        if key in seen:
+            continue
+        seen.add(key)
+        members = STOP_INDEX.group_members(st.group_id) if st.group_id is not None else [st]
+        routes = []
+        for m in sorted(members, key=lambda m: (m.tuyen_id, m.huong)):
+            route_code, route_name = STOP_INDEX.route_info(m.tuyen_id)
+            routes.append({
+                "stop_id": m.stop_id,
+                "route_id": m.tuyen_id,
+                "route_code": route_code,
+                "route_name": route_name,
+                "direction": m.huong,
+            })
+        items.append({
+            "group_id": st.group_id,
+            "name": st.name,
+            "lat": st.lat,
+            "lng": st.lng,
+            "distance_m": round(dist, 1),
+            "routes": routes,
+        })
+        if len(items) >= limit:
+            break
+    return items
+
+
+@app.route("/api/stops/nearby")
+def api_stops_nearby():
+    """
+    Trạm gần vị trí: ?lat=&lng=&radius=(m, mặc định 500)&limit=(mặc định 20)
+    group=1: gộp theo nhóm trạm vật lý, mỗi nhóm 1 dòng kèm danh sách tuyến/hướng dừng ở đó.
+    """
+    try:
+        lat = float(request.args.get("lat"))
+        lng = float(request.args.get("lng"))
+    except (TypeError, ValueError):
+        return jsonify({"ok": False, "error": "Thiếu hoặc sai tham số lat/lng."}), 400
+    if not (-90.0 <= lat <= 90.0 and -180.0 <= lng <= 180.0):
+        return jsonify({"ok": False, "error": "Tọa độ lat/lng không hợp lệ."}), 400
+
+    try:
+        radius = float(request.args.get("radius") or 500)
+        limit = int(request.args.get("limit") or 20)
+    except ValueError:
+        return jsonify({"ok": False, "error": "Tham số radius/limit phải là số."}), 400
+    radius = max(1.0, min(radius, float(NEARBY_MAX_RADIUS_M)))
+    limit = max(1, min(limit, 100))
+
+    if (request.args.get("group") or "").strip() == "1":
+        return jsonify({
+            "ok": True, "lat": lat, "lng": lng, "radius_m": radius,
+            "items": _nearby_stop_groups(lat, lng, radius, limit),
+        })
+
+    items = []
+    for dist, st in STOP_INDEX.nearby(lat, lng, radius, limit=limit):
+        route_code, route_name = STOP_INDEX.route_info(st.tuyen_id)
+        items.append({
+            "stop_id": st.stop_id,
+            "name": st.name,
+            "lat": st.lat,
+            "lng": st.lng,
+            "distance_m": round(dist, 1),
+            "route_id": st.tuyen_id,
+            "route_code": route_code,
+            "route_name": route_name,
+            "direction": st.huong,
+            "order": st.order,
+            "group_id": st.group_id,
+            "detail_url": url_for("stop_detail", stop_id=st.stop_id),
+        })
+
+    return jsonify({"ok": True, "lat": lat, "lng": lng, "radius_m": radius, "items": items})
+
+
+def _plan_endpoint(net, raw, label):
+    """
+    "from"/"to" của /api/plan: mã trạm (số) hoặc "lat,lng".
+    Trả về ({chỉ số trạm: giây đi bộ}, lỗi).
+    """
+    raw = (raw or "").strip()
+    if not raw:
+        return None, f"Thiếu tham số {label}."
+    if "," in raw:
+        try:
+            lat, lng = (float(x) for x in raw.split(",", 1))
+        except ValueError:
+            return None, f"Tham số {label} phải là mã trạm hoặc lat,lng."
+        if not (-90.0 <= lat <= 90.0 and -180.0 <= lng <= 180.0):  # loại cả nan/inf
+            return None, f"Tọa độ {label} không hợp lệ."
+        points = {}
+        for dist, st in STOP_INDEX.nearby(lat, lng, PLAN_ACCESS_RADIUS_M):
+            si = net.stop_index.get(st.stop_id)
+            if si is not None:
+                points[si] = int(round(_walk_seconds(dist)))
+        if not points:
+            return None, f"Không có trạm nào trong {PLAN_ACCESS_RADIUS_M}m quanh {label}."
+        return points, None
+    try:
+        si = net.stop_index.get(int(raw))
+    except ValueError:
+        return None, f"Tham số {label} phải là mã trạm hoặc lat,lng."
+    if si is None:
+        return None, f"Trạm {raw} không có trong lịch chạy hôm đó."
+    return {si: 0}, None
+
+
+@app.route("/api/plan")
+def api_plan():
+    """Tìm hành trình qua nhiều tuyến: ?from=<mã trạm|lat,lng>&to=<...>&at=<YYYY-MM-DDTHH:MM|HH:MM>."""
+    now = datetime.now()
+    at_raw = (request.args.get("at") or "").strip()
+    try:
+        if not at_raw:
+            depart_dt = now
+        elif "T" in at_raw or " " in at_raw:
+            depart_dt = datetime.fromisoformat(at_raw)
+        else:
+            depart_dt = datetime.combine(now.date(), datetime.strptime(at_raw, "%H:%M").time())
+    except ValueError:
+        return jsonify({"ok": False, "error": "Tham số at phải có dạng YYYY-MM-DDTHH:MM hoặc HH:MM."}), 400
+    if depart_dt.tzinfo is not None:
+        depart_dt = depart_dt.astimezone().replace(tzinfo=None)
+
+    try:
+        max_transfers = int(request.args.get("max_transfers") or PLAN_MAX_TRANSFERS)
+    except ValueError:
+        max_transfers = PLAN_MAX_TRANSFERS
+    max_transfers = max(0, min(max_transfers, PLAN_MAX_TRANSFERS))
+
+    net = PLAN_NETWORK.get(depart_dt.date())
+    sources, err = _plan_endpoint(net, request.args.get("from"), "from")
+    if err:
+        return jsonify({"ok": False, "error": err}), 400
+    targets, err = _plan_endpoint(net, request.args.get("to"), "to")
+    if err:
+        return jsonify({"ok": False, "error": err}), 400
+
+    journeys = plan_journeys(net, sources, targets, depart_dt, max_transfers=max_transfers)
+    return jsonify({
+        "ok": True,
+        "at": depart_dt.isoformat(timespec="seconds"),
+        "max_transfers": max_transfers,
+        "journeys": journeys,
+    })
+
+
+@app.route("/api/routes/<int:tuyen_id>/timetable")
+def api_route_timetable(tuyen_id):
+    """
+    Bảng giờ theo trạm: ?dir=DI|VE&date=YYYY-MM-DD
+    - mặc định: K (`k`, mặc định 5) chuyến tới mỗi trạm tính từ `at` (HH:MM; hôm nay = giờ hiện tại)
+    - full=1: mọi chuyến trong ngày (in bảng giờ)
+    """
+    tuyen = TuyenXe.query.get_or_404(tuyen_id)
+    dir_ = normalize_direction(request.args.get("dir") or "DI")
+    now = datetime.now()
+
+    date_raw = (request.args.get("date") or "").strip()
+    try:
+        date = datetime.strptime(date_raw, "%Y-%m-%d").date() if date_raw else now.date()
+    except ValueError:
+        return jsonify({"ok": False, "error": "Tham số date phải có dạng YYYY-MM-DD."}), 400
+
+    full = (request.args.get("full") or "").strip() == "1"
+    try:
+        k = int(request.args.get("k") or 5)
+    except ValueError:
+        k = 5
+    k = max(1, min(k, 50))
+
+    base = datetime.combine(date, datetime.min.time())
+    at_raw = (request.args.get("at") or "").strip()
+    if at_raw:
+        m = re.match(r"^(\d{1,2}):(\d{2})$", at_raw)
+        if not m or int(m.group(1)) > 23 or int(m.group(2)) > 59:
+            return jsonify({"ok": False, "error": "Tham số at phải có dạng HH:MM."}), 400
+        at = base + timedelta(hours=int(m.group(1)), minutes=int(m.group(2)))
+    else:
+        at = now if date == now.date() else base
+
+    table, offsets_data = build_timetable(tuyen, dir_, date)
+    if not offsets_data.get("ok"):
+        return jsonify({"ok": False, "error": offsets_data.get("error") or "Không tính được offset trạm."}), 400
+
+    at_s = (at - base).total_seconds()
+    per_stop = timetable_arrivals(table, at_s=None if full else at_s, k=None if full else k)
+
+    items = []
+    for s, off_s, arrivals in zip(table.stops, table.offsets_s, per_stop):
+        rows = []
+        for j, arr_s in arrivals:
+            eta_dt = base + timedelta(seconds=arr_s)
+            rows.append({
+                "trip_id": table.departures[j].trip_id,
+                "depart_time": table.departures[j].time,
+                "eta_time": eta_dt.strftime("%H:%M"),
+                "eta_iso": eta_dt.isoformat(timespec="seconds"),
+            })
+        items.append({
+            "stop_id": s.maTram,
+            "order": s.thuTuTrenTuyen,
+            "name": s.tenTram,
+            "offset_s": off_s,
+            "arrivals": rows,
+        })
+
+    return jsonify({
+        "ok": True,
+        "route_id": tuyen.maTuyen,
+        "route_code": tuyen.maHienThi,
+        "direction": dir_,
+        "date": date.isoformat(),
+        "as_of": None if full else at.isoformat(timespec="seconds"),
+        "k": None if full else k,
+        "departures": len(table.departures),
+        "offset_source": offsets_data.get("source"),
+        "items": items,
+    })
+
+
+@app.route("/api/etas/batch", methods=["POST"])
+def api_etas_batch():
+    """
+    Bảng giờ nhiều trạm trong 1 request (màn hình tại bến, app mobile).
+    Body JSON: {"stop_ids": [1, 2, ...], "at": "2025-01-01T07:30:00" (tùy chọn), "k": 3}
+    """
+    data = request.get_json(silent=True) or {}
+    raw_ids = data.get("stop_ids")
+    if not isinstance(raw_ids, list) or not raw_ids:
+        return jsonify({"ok": False, "error": "Thiếu stop_ids (danh sách mã trạm)."}), 400
+
+    stop_ids = []
+    for v in raw_ids:
+        try:
+            if isinstance(v, bool):  # true/false JSON là int trong Python
+                raise TypeError
+            sid = int(v)
+        except (TypeError, ValueError):
+            return jsonify({"ok": False, "error": f"Mã trạm không hợp lệ: {v!r}"}), 400
+        if sid not in stop_ids:
+            stop_ids.append(sid)
+    if len(stop_ids) > ETA_BATCH_MAX_STOPS:
+        return jsonify({"ok": False, "error": f"Tối đa {ETA_BATCH_MAX_STOPS} trạm mỗi request."}), 400
+
+    try:
+        k = int(data.get("k") or 3)
+    except (TypeError, ValueError):
+        k = 3
+    k = max(1, min(k, 10))
+
+    at = None
+    at_raw = str(data.get("at") or "").strip()
+    if at_raw:
+        try:
+            at = datetime.fromisoformat(at_raw)
+        except ValueError:
+            return jsonify({"ok": False, "error": "Tham số at phải là ISO datetime."}), 400
+        if at.tzinfo is not None:  # "+07:00"/"Z" -> giờ địa phương naive như lịch chạy
+            at = at.astimezone().replace(tzinfo=None)
+    at = at or datetime.now()
+
+    items, missing = batch_stop_etas(stop_ids, at=at, k=k)
+    return jsonify({
+        "ok": True,
+        "as_of": at.isoformat(timespec="seconds"),
+        "k": k,
+        "count": len(items),
+        "items": items,
+        "missing": missing,
+    })
+
+
 @app.route("/api/cards/validate", methods=["POST"])
 def api_validate_card():
     # Demo soát thẻ tháng/quý/năm khi lên xe.
@@ -1899,7 +5449,7 @@ def api_validate_card():
     if not code:
         return jsonify({"ok": False, "error": "Thiếu mã thẻ (code)."}), 400
 
-    card = TheTu.query.filter(func.upper(TheTu.maSoThe) == code).first()
+    card = card_by_code_query(code).first()
     if not card:
         return jsonify({"ok": False, "error": "Không tìm thấy thẻ."}), 404
 
@@ -1931,14 +5481,42 @@ def api_validate_card():
     })
 
 
+@app.route("/api/admin/cache/stats")
+def api_admin_cache_stats():
+    user = current_user()
+    if not user or user.vai_tro != "ADMIN":
+        return jsonify({"ok": False, "error": "Bạn không có quyền truy cập."}), 403
+
+    return jsonify({
+        "ok": True,
+        "pid": os.getpid(),
+        "stop_offsets": dict(_STOP_OFFSET_CACHE.stats(), coalesced=_STOP_OFFSET_FLIGHT.coalesced),
+        "stop_offsets_refresh": _STOP_OFFSET_REFRESHER.stats(),
+        "cache_writes": _CACHE_WRITER.stats(),
+        "osrm_legs": dict(_OSRM_LEG_CACHE.stats(), **_osrm_leg_counters),
+        "route_geometry": _ROUTE_GEOMETRY_CACHE.stats(),
+        "geometry_variants": _GEOMETRY_VARIANT_CACHE.stats(),
+        "osrm_breaker": OSRM.breaker.stats(),
+        "stop_times_rebuild": _STOP_TIMES_REBUILDER.stats(),
+        "timetable_l1": _TIMETABLE_CACHE.stats(),
+        "stop_index": STOP_INDEX.stats(),
+        "plan_network": PLAN_NETWORK.stats(),
+        "eta_stream": ETA_STREAM.stats(),
+    })
+
+
 @app.route("/api/routes/<int:tuyen_id>/stops_geo")
 def api_route_stops_geo(tuyen_id):
     tuyen = TuyenXe.query.get_or_404(tuyen_id)
 
-    dir_ = (request.args.get("dir") or "DI").strip().upper()
+    dir_ = normalize_direction(request.args.get("dir") or "DI")
+    etag = _route_etag(tuyen, "stops_geo", dir_)
+    not_modified = _not_modified(etag)
+    if not_modified is not None:
+        return not_modified
     stops = _query_stops_by_direction(tuyen, dir_).all()
 
-    return jsonify(build_stops_geo(stops, route_code=tuyen.maHienThi))
+    return _json_with_etag(build_stops_geo(stops, route_code=tuyen.maHienThi), etag)
 # ==================== MAIN ====================
 
 if __name__ == "__main__":
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Dọn chuyến cũ (không có vé) khỏi bảng `chuyen_xe` (1 lượt), dùng khi chạy bằng cron
+thay cho job nền trong app (TRIP_ARCHIVE_INTERVAL_SEC=0).
+
+- summary (mặc định): gộp số chuyến theo tuyến/ngày/hướng vào `tong_hop_chuyen_ngay` rồi xóa.
+- delete: chỉ xóa.
+Chuyến có vé (ve_xe) luôn được giữ nguyên.
+
+Usage:
+  python scripts/archive_trips.py
+  python scripts/archive_trips.py --retention-days 30 --mode delete
+"""
+
+import argparse
+import sys
+from pathlib import Path
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--retention-days", type=int, default=None, help="Giữ nguyên N ngày gần nhất (mặc định TRIP_RETENTION_DAYS)")
+    p.add_argument("--mode", choices=["summary", "delete"], default=None, help="Mặc định TRIP_ARCHIVE_MODE")
+    args = p.parse_args()
+
+    root = Path(__file__).resolve().parents[1]
+    sys.path.insert(0, str(root))
+
+    from app import app, archive_past_trips, try_acquire_lease, release_lease, _TripArchiver  # noqa
+
+    with app.app_context():
+        lease = _TripArchiver.LEASE_NAME
+        if not try_acquire_lease(lease, 3600):
+            print("[SKIP] Worker/node khác đang giữ lease dọn chuyến.")
+            return
+        try:
+            archived = archive_past_trips(retention_days=args.retention_days, mode=args.mode)
+        finally:
+            release_lease(lease)
+        print(f"[OK] archived={archived}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Gom trạm dừng của mọi tuyến/hướng thành nhóm trạm vật lý (bảng `nhom_tram`, cột
+`tram_dung.nhom_id`) và dựng bảng đi bộ chuyển tuyến giữa các nhóm (`chuyen_tiep_nhom_tram`).
+
+Chạy sau khi seed/import trạm hàng loạt hoặc sửa nhiều vị trí trạm; trạm mới/dời chỗ
+chưa có nhóm thì app tự tìm trạm gần theo bán kính cho tới lần chạy kế tiếp.
+
+Usage:
+  python scripts/build_stop_groups.py
+  python scripts/build_stop_groups.py --radius-m 30 --transfer-radius-m 300
+  python scripts/build_stop_groups.py --dry-run
+"""
+
+import argparse
+import sys
+from pathlib import Path
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--radius-m", type=float, default=None, help="Trạm cách nhau <= N mét là 1 nhóm (mặc định STOP_GROUP_RADIUS_M)")
+    p.add_argument("--transfer-radius-m", type=float, default=None, help="Đi bộ giữa 2 nhóm tối đa N mét (mặc định PLAN_TRANSFER_RADIUS_M)")
+    p.add_argument("--dry-run", action="store_true", help="Chỉ in thống kê, không ghi DB")
+    args = p.parse_args()
+
+    root = Path(__file__).resolve().parents[1]
+    sys.path.insert(0, str(root))
+
+    from app import app, build_stop_groups  # noqa
+
+    with app.app_context():
+        stats = build_stop_groups(args.radius_m, args.transfer_radius_m, dry_run=args.dry_run)
+
+    prefix = "[DRY-RUN]" if args.dry_run else "[OK]"
+    print(
+        f"{prefix} stops={stats['stops']} groups={stats['groups']} "
+        f"multi_route={stats['multi_route_groups']} transfers={stats['transfers']} "
+        f"radius={stats['radius_m']}m transfer_radius={stats['transfer_radius_m']}m"
+    )
+
+
+if __name__ == "__main__":
+    main()
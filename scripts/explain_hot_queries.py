@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Kiểm tra các query nóng có dùng index do migration tạo hay không (EXPLAIN).
+
+- SQLite: EXPLAIN QUERY PLAN
+- Postgres: EXPLAIN, tắt seq scan trong transaction để planner không chọn quét
+  bảng chỉ vì DB còn ít dữ liệu (ta cần biết index CÓ dùng được hay không).
+
+Thoát mã 1 nếu có query không dùng index mong đợi (dùng trong CI/deploy).
+
+Usage:
+  python scripts/explain_hot_queries.py
+  python scripts/explain_hot_queries.py --verbose
+"""
+
+import argparse
+import sys
+from datetime import datetime, timedelta
+from pathlib import Path
+from types import SimpleNamespace
+
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import ClauseElement, Executable
+
+
+class Explain(Executable, ClauseElement):
+    inherit_cache = False
+
+    def __init__(self, statement):
+        self.statement = statement
+
+
+@compiles(Explain)
+def _compile_explain(element, compiler, **kw):
+    prefix = "EXPLAIN QUERY PLAN " if compiler.dialect.name == "sqlite" else "EXPLAIN "
+    return prefix + compiler.process(element.statement, **kw)
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--verbose", action="store_true", help="In toàn bộ plan")
+    args = p.parse_args()
+
+    root = Path(__file__).resolve().parents[1]
+    sys.path.insert(0, str(root))
+
+    from app import (  # noqa
+        app, db, ChuyenXe,
+        _query_stops_by_direction, _override_trips_query, card_by_code_query,
+    )
+
+    tuyen = SimpleNamespace(maTuyen=1)
+    now = datetime.now()
+    today = now.strftime("%Y-%m-%d")
+
+    failed = 0
+    with app.app_context():
+        # (tên, query, các index chấp nhận được)
+        checks = [
+            ("stops DI", _query_stops_by_direction(tuyen, "DI"), ["idx_stop_route_dir_order"]),
+            ("stops VE", _query_stops_by_direction(tuyen, "VE"), ["idx_stop_route_dir_order"]),
+            (
+                "trips upcoming VE",
+                _override_trips_query(1, "VE", now + timedelta(hours=6)).filter(ChuyenXe.khoiHanhLuc >= now).limit(12),
+                ["idx_trip_route_dir_departure"],
+            ),
+            (
+                "trips of day",
+                ChuyenXe.query
+                .filter(ChuyenXe.tuyen_id == 1, ChuyenXe.ngayKhoiHanh == today, ChuyenXe.huong == "DI")
+                .order_by(ChuyenXe.gioKhoiHanh.asc()),
+                ["idx_trip_route_day_dir_time", "idx_trip_unique_departure"],
+            ),
+            ("card by code", card_by_code_query("SB-TEST"), ["idx_card_code_upper"]),
+        ]
+
+        dialect = db.engine.dialect.name
+        print(f"[DB] dialect={dialect}")
+        with db.engine.connect() as conn:
+            trans = conn.begin()
+            if dialect == "postgresql":
+                conn.exec_driver_sql("SET LOCAL enable_seqscan = off")
+            for name, query, expected in checks:
+                rows = conn.execute(Explain(query.statement)).fetchall()
+                plan = "\n".join(" ".join(str(c) for c in row) for row in rows)
+                used = [idx for idx in expected if idx in plan]
+                if used:
+                    print(f"[OK] {name}: {used[0]}")
+                else:
+                    failed += 1
+                    print(f"[FAIL] {name}: không dùng {' / '.join(expected)}")
+                if args.verbose or not used:
+                    print("  " + plan.replace("\n", "\n  "))
+            trans.rollback()
+
+    if failed:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
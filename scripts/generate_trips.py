@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Sinh chuyến sắp tới cho mọi tuyến (1 lượt), dùng khi chạy bằng cron
+thay cho job nền trong app (BUS_SCHEDULER_ENABLED=0).
+Chỉ cần khi tắt lịch ảo (BUS_VIRTUAL_TIMETABLE=0).
+
+Dùng chung lease `trip_scheduler` với job nền nên chạy song song cũng không sinh trùng.
+
+Usage:
+  python scripts/generate_trips.py
+  python scripts/generate_trips.py --horizon-min 720
+"""
+
+import argparse
+import sys
+from pathlib import Path
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--horizon-min", type=int, default=None, help="Sinh trước N phút (mặc định BUS_SCHEDULE_HORIZON_MIN)")
+    args = p.parse_args()
+
+    root = Path(__file__).resolve().parents[1]
+    sys.path.insert(0, str(root))
+
+    from app import app, materialize_upcoming_trips, try_acquire_lease, release_lease, _TripScheduler  # noqa
+
+    with app.app_context():
+        lease = _TripScheduler.LEASE_NAME
+        if not try_acquire_lease(lease, 300):
+            print("[SKIP] Worker/node khác đang giữ lease sinh chuyến.")
+            return
+        try:
+            created = materialize_upcoming_trips(horizon_min=args.horizon_min)
+        finally:
+            release_lease(lease)
+        print(f"[OK] created={created}")
+
+
+if __name__ == "__main__":
+    main()
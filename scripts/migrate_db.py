@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Chạy migration (cột/index) còn thiếu và in trạng thái bảng `schema_migrations`.
+
+App tự chạy migration khi khởi động; dùng script này trong bước deploy
+(vd: trước khi start gunicorn) để thấy rõ migration nào đã/chưa chạy.
+
+Usage:
+  python scripts/migrate_db.py
+  python scripts/migrate_db.py --status
+"""
+
+import argparse
+import sys
+from pathlib import Path
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--status", action="store_true", help="Chỉ in trạng thái, không chạy migration")
+    args = p.parse_args()
+
+    root = Path(__file__).resolve().parents[1]
+    sys.path.insert(0, str(root))
+
+    # import app đã tự chạy migration lúc khởi động; gọi lại để chạy phần còn sót (nếu có)
+    from app import app, db, MIGRATIONS, MIGRATION_PENDING_REASONS, applied_migrations, run_migrations  # noqa
+
+    with app.app_context():
+        print(f"[DB] dialect={db.engine.dialect.name}")
+        if not args.status:
+            for version in run_migrations():
+                print(f"[RUN] {version}")
+
+        applied = applied_migrations()
+        pending = 0
+        for version, description, _ in MIGRATIONS:
+            if version in applied:
+                print(f"[OK] {version} ({description}) applied_at={applied[version]}")
+            else:
+                pending += 1
+                reason = MIGRATION_PENDING_REASONS.get(version)
+                print(f"[PENDING] {version} ({description})" + (f": {reason}" if reason else ""))
+
+    if pending:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Dựng lại hình dạng tuyến (bảng `hinh_dang_tuyen`) từ danh sách trạm hiện tại.
+
+App tự dựng lại khi admin sửa trạm; chạy script này sau khi seed/import trạm
+hàng loạt (vd: `seed_stops_from_csv.py`) hoặc khi đổi OSRM server.
+
+Usage:
+  python scripts/rebuild_route_shapes.py --all
+  python scripts/rebuild_route_shapes.py --route-code 01
+  python scripts/rebuild_route_shapes.py --route-code 01 --direction VE
+"""
+
+import argparse
+import sys
+from pathlib import Path
+
+
+def main():
+    p = argparse.ArgumentParser()
+    g = p.add_mutually_exclusive_group(required=True)
+    g.add_argument("--route-code", help="Mã hiển thị tuyến, vd: 01")
+    g.add_argument("--all", action="store_true", help="Dựng lại cho mọi tuyến")
+    p.add_argument("--direction", choices=["DI", "VE"], default=None)
+    args = p.parse_args()
+
+    root = Path(__file__).resolve().parents[1]
+    sys.path.insert(0, str(root))
+
+    from app import app, TuyenXe, build_route_shape  # noqa
+
+    with app.app_context():
+        if args.all:
+            routes = TuyenXe.query.order_by(TuyenXe.maTuyen).all()
+        else:
+            tuyen = TuyenXe.query.filter_by(maHienThi=args.route_code).first()
+            if not tuyen:
+                raise SystemExit(f"[ERROR] Không tìm thấy tuyến maHienThi='{args.route_code}'")
+            routes = [tuyen]
+
+        dirs = [args.direction] if args.direction else ["DI", "VE"]
+        for tuyen in routes:
+            for d in dirs:
+                shape = build_route_shape(tuyen, d)
+                if shape is None:
+                    print(f"[SKIP] route={tuyen.maHienThi} dir={d}: chưa đủ 2 trạm có tọa độ")
+                else:
+                    n = shape.geometry.count("],[") + 1
+                    print(f"[OK] route={tuyen.maHienThi} dir={d} source={shape.source} version={shape.version} points={n}")
+
+
+if __name__ == "__main__":
+    main()
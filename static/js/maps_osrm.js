@@ -4,12 +4,16 @@
 // - `renderStopsMap`: chỉ hiển thị marker trạm (không vẽ tuyến)
 // - `focusStopOnMap`: zoom tới 1 trạm khi người dùng click trong danh sách
 
+// Cần static/js/polyline.js (window.geometryToLatLng) load trước.
+
 (function () {
   const maps = {}; // cache map instances theo mapId
   const mapStops = {}; // cache marker info theo mapId: [{lat,lng,marker}]
 
   const DEFAULT_CENTER = [16.047079, 108.206230]; // Đà Nẵng
   const DEFAULT_ZOOM = 12;
+  // server rút gọn + mã hóa polyline6 (nhẹ hơn GeoJSON nhiều lần); zoom 16 ~ sai số 2m
+  const GEOMETRY_PARAMS = "format=polyline6&zoom=16";
 
   function destroyMap(mapId) {
     if (maps[mapId]) {
@@ -22,11 +26,9 @@
   }
 
   async function callBackendOSRM(latlngs) {
-    const res = await fetch("/api/osrm/route", {
-      method: "POST",
-      headers: { "Content-Type": "application/json" },
-      body: JSON.stringify({ coords: latlngs }),
-    });
+    // GET để browser tự cache + gửi If-None-Match (server trả 304 nếu tuyến không đổi)
+    const coords = latlngs.map(([lat, lng]) => `${lat},${lng}`).join(";");
+    const res = await fetch(`/api/osrm/route?coords=${encodeURIComponent(coords)}&${GEOMETRY_PARAMS}`);
     const data = await res.json();
     if (!res.ok || !data.ok) throw new Error(data.error || "OSRM failed");
     return data; // {distance_m, duration_s, geometry}
@@ -52,17 +54,12 @@
     if (latlngs.length >= 2) L.polyline(latlngs).addTo(map);
   }
 
-  function geoJsonLineToLatLng(geometry) {
-    if (!geometry || geometry.type !== "LineString" || !Array.isArray(geometry.coordinates)) return [];
-    return geometry.coordinates.map(c => [c[1], c[0]]);
-  }
-
   async function drawRouteOSRM(map, latlngs) {
     if (latlngs.length < 2) return;
 
     try {
       const data = await callBackendOSRM(latlngs);
-      const line = geoJsonLineToLatLng(data.geometry);
+      const line = window.geometryToLatLng(data.geometry);
       if (line.length) L.polyline(line).addTo(map);
       return;
     } catch (e) {
@@ -73,7 +70,7 @@
       const seg = [latlngs[i], latlngs[i + 1]];
       try {
         const data = await callBackendOSRM(seg);
-        const line = geoJsonLineToLatLng(data.geometry);
+        const line = window.geometryToLatLng(data.geometry);
         if (line.length) L.polyline(line).addTo(map);
         else drawStraightLine(map, seg);
       } catch (e) {
@@ -83,8 +80,25 @@
     }
   }
 
+  async function drawStoredShape(map, shapeUrl) {
+    // Shape đã tính sẵn ở server (1 GET, có ETag) -> không cần gọi OSRM từ client
+    try {
+      const res = await fetch(`${shapeUrl}${shapeUrl.includes("?") ? "&" : "?"}${GEOMETRY_PARAMS}`);
+      const data = await res.json();
+      if (!res.ok || !data.ok) return false;
+      const line = window.geometryToLatLng(data.geometry);
+      if (!line.length) return false;
+      L.polyline(line).addTo(map);
+      return true;
+    } catch (e) {
+      console.warn("Stored shape failed, fallback OSRM:", e.message);
+      return false;
+    }
+  }
+
   // === HÀM CHÍNH ===
-  window.renderRouteMap = async function (stops, mapId) {
+  // opts.shapeUrl: nếu có, ưu tiên vẽ shape đã lưu (/api/routes/<id>/shape?dir=)
+  window.renderRouteMap = async function (stops, mapId, opts = {}) {
     if (!window.L) {
       console.error("Leaflet chưa được load: L is undefined");
       return;
@@ -126,7 +140,9 @@
     const latlngs = pts.map(p => [p.lat, p.lng]);
     fitBounds(map, latlngs);
 
-    if (latlngs.length >= 2) await drawRouteOSRM(map, latlngs);
+    if (latlngs.length < 2) return;
+    if (opts.shapeUrl && (await drawStoredShape(map, opts.shapeUrl))) return;
+    await drawRouteOSRM(map, latlngs);
   };
 
   // Chỉ hiển thị marker trạm (không vẽ tuyến OSRM)
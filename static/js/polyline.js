@@ -0,0 +1,37 @@
+// static/js/polyline.js
+// Helper dùng chung cho các bản đồ (maps_osrm.js, routes_overview_map.js):
+// giải mã geometry từ API (?format=polyline6 hoặc GeoJSON LineString) -> [[lat, lng], ...]
+
+(function () {
+  // Google encoded polyline (precision 6) -> [[lat, lng], ...]
+  function decodePolyline(str, precision = 6) {
+    const factor = Math.pow(10, precision);
+    const out = [];
+    let index = 0, lat = 0, lng = 0;
+    while (index < str.length) {
+      const deltas = [0, 0];
+      for (let k = 0; k < 2; k++) {
+        let shift = 0, result = 0, b;
+        do {
+          b = str.charCodeAt(index++) - 63;
+          result |= (b & 0x1f) << shift;
+          shift += 5;
+        } while (b >= 0x20);
+        deltas[k] = result & 1 ? ~(result >> 1) : result >> 1;
+      }
+      lat += deltas[0];
+      lng += deltas[1];
+      out.push([lat / factor, lng / factor]);
+    }
+    return out;
+  }
+
+  function geometryToLatLng(geometry) {
+    if (typeof geometry === "string") return decodePolyline(geometry);
+    if (!geometry || geometry.type !== "LineString" || !Array.isArray(geometry.coordinates)) return [];
+    return geometry.coordinates.map((c) => [c[1], c[0]]);
+  }
+
+  window.decodePolyline = decodePolyline;
+  window.geometryToLatLng = geometryToLatLng;
+})();
@@ -3,12 +3,16 @@
 // - đổi hướng DI/VE
 // - reset sạch khi chuyển tuyến/hướng (tránh dính dữ liệu cũ)
 // - chống race condition khi click nhanh
+// - ETA cập nhật realtime qua SSE (/stop_etas/stream) khi server bật ETA_STREAM_ENABLED,
+//   chỉ nhận trạm có ETA đổi; tắt thì chỉ lấy /stop_etas 1 lần khi tải trang
 
 document.addEventListener("DOMContentLoaded", () => {
   const page = document.getElementById("routeDetailPage");
   if (!page) return;
 
   const routeId = page.dataset.routeId;
+  const etaStreamEnabled = page.dataset.etaStream === "1";
+  const etaRefreshMs = Math.max(5, Number(page.dataset.etaRefreshSec) || 15) * 1000;
   const mapId = "route-map";
 
   const btnDi = document.getElementById("btnDi");
@@ -26,6 +30,8 @@ document.addEventListener("DOMContentLoaded", () => {
 
   let currentDir = "DI";
   let requestSeq = 0;
+  let etaSource = null;
+  let etaTimer = null;
 
   function setActiveDir(dir) {
     const isDi = dir === "DI";
@@ -114,10 +120,101 @@ document.addEventListener("DOMContentLoaded", () => {
     kpiDataStatus.textContent = ok ? "Đủ" : "Thiếu";
   }
 
+  // gắn ETA (từ /stop_etas hoặc sự kiện SSE) vào danh sách trạm; true nếu có trạm được cập nhật.
+  // removed: mã trạm không còn ETA (delta SSE) -> xóa ETA cũ
+  function applyEtaItems(stops, items, removed = []) {
+    const etaMap = new Map(items.map((it) => [String(it.stop_id), it]));
+    const removedIds = new Set(removed.map(String));
+    let changed = false;
+    stops.forEach((s) => {
+      const sid = String(s.id ?? s.stop_id ?? "");
+      const it = etaMap.get(sid);
+      if (it) {
+        s.eta_time = it.eta_time;
+        const mins = typeof it.eta_in_min === "number" ? it.eta_in_min : null;
+        s.eta_in_min = mins != null ? Math.max(0, mins) : null;
+        changed = true;
+      } else if (removedIds.has(sid)) {
+        s.eta_time = null;
+        s.eta_in_min = null;
+        changed = true;
+      }
+    });
+    return changed;
+  }
+
+  function stopEtaUpdates() {
+    if (etaSource) {
+      etaSource.close();
+      etaSource = null;
+    }
+    if (etaTimer) {
+      clearInterval(etaTimer);
+      etaTimer = null;
+    }
+  }
+
+  async function fetchEtas(dir, seq, stops) {
+    try {
+      const etaRes = await fetch(`/api/routes/${routeId}/stop_etas?dir=${dir}`);
+      const etaData = await etaRes.json();
+      if (seq === requestSeq && etaRes.ok && etaData?.ok && Array.isArray(etaData.items)) {
+        // /stop_etas trả đủ trạm: trạm vắng mặt = không còn ETA
+        const present = new Set(etaData.items.map((it) => String(it.stop_id)));
+        const missing = stops.map((s) => String(s.id ?? s.stop_id ?? "")).filter((sid) => !present.has(sid));
+        applyEtaItems(stops, etaData.items, missing);
+        renderStops(stops);
+      }
+    } catch (e) {
+      // ignore ETA errors; map/list vẫn hoạt động bình thường
+    }
+  }
+
+  function startEtaPolling(dir, seq, stops) {
+    if (etaTimer || !stops.length) return;
+    etaTimer = setInterval(() => {
+      if (seq !== requestSeq) return;
+      fetchEtas(dir, seq, stops);
+    }, etaRefreshMs);
+  }
+
+  function startEtaUpdates(dir, seq, stops) {
+    stopEtaUpdates();
+    if (!stops.length) return;
+    // SSE tắt: giữ như cũ, chỉ 1 lần /stop_etas khi tải trang (không poll -> không N lần tính ETA / tick)
+    if (!etaStreamEnabled || typeof EventSource === "undefined") return;
+
+    const src = new EventSource(`/api/routes/${routeId}/stop_etas/stream?dir=${dir}`);
+    const onEta = (ev) => {
+      if (seq !== requestSeq) {
+        src.close();
+        return;
+      }
+      let data = null;
+      try {
+        data = JSON.parse(ev.data);
+      } catch (e) {
+        return;
+      }
+      const removed = Array.isArray(data?.removed) ? data.removed : [];
+      if (data?.ok && Array.isArray(data.items) && applyEtaItems(stops, data.items, removed)) renderStops(stops);
+    };
+    src.addEventListener("snapshot", onEta);
+    src.addEventListener("delta", onEta);
+    // SSE bật nhưng server từ chối (503 đủ kết nối) -> trình duyệt không nối lại, chuyển sang gọi định kỳ
+    src.onerror = () => {
+      if (src.readyState !== EventSource.CLOSED || etaSource !== src) return;
+      etaSource = null;
+      if (seq === requestSeq) startEtaPolling(dir, seq, stops);
+    };
+    etaSource = src;
+  }
+
   async function loadStops(dir) {
     currentDir = dir;
     requestSeq += 1;
     const seq = requestSeq;
+    stopEtaUpdates();
 
     setActiveDir(dir);
     showStatus("Đang tải dữ liệu trạm…", "info");
@@ -145,32 +242,18 @@ document.addEventListener("DOMContentLoaded", () => {
       renderStops(stops);
       updateKpis(stops);
 
-      if (typeof window.renderRouteMap === "function") await window.renderRouteMap(stops, mapId);
+      if (typeof window.renderRouteMap === "function") {
+        await window.renderRouteMap(stops, mapId, { shapeUrl: `/api/routes/${routeId}/shape?dir=${dir}` });
+      }
 
       // ETA dự kiến tại từng trạm (theo lịch + OSRM/fallback). Không block map.
-      try {
-        const etaRes = await fetch(`/api/routes/${routeId}/stop_etas?dir=${dir}`);
-        const etaData = await etaRes.json();
-        if (seq === requestSeq && etaRes.ok && etaData?.ok && Array.isArray(etaData.items)) {
-          const etaMap = new Map(etaData.items.map((it) => [String(it.stop_id), it]));
-          stops.forEach((s) => {
-            const it = etaMap.get(String(s.id ?? s.stop_id ?? ""));
-            if (it) {
-              s.eta_time = it.eta_time;
-              const mins = typeof it.eta_in_min === "number" ? it.eta_in_min : null;
-              s.eta_in_min = mins != null ? Math.max(0, mins) : null;
-            }
-          });
-          renderStops(stops);
-        }
-      } catch (e) {
-        // ignore ETA errors; map/list vẫn hoạt động bình thường
-      }
+      await fetchEtas(dir, seq, stops);
+      if (seq === requestSeq) startEtaUpdates(dir, seq, stops);
 
       if (!stops.length) {
         showStatus("Lượt này chưa có trạm hoặc đang trống dữ liệu.", "secondary");
       } else {
-        showStatus("Đã tải xong. Tuyến được vẽ theo OSRM với fallback pairwise khi cần.", "success");
+        showStatus("Đã tải xong. Tuyến được vẽ theo shape đã lưu (OSRM), fallback pairwise khi cần.", "success");
       }
       setLoading(false);
     } catch (err) {
@@ -183,6 +266,7 @@ document.addEventListener("DOMContentLoaded", () => {
     }
   }
 
+  window.addEventListener("beforeunload", stopEtaUpdates);
   btnDi.addEventListener("click", () => loadStops("DI"));
   btnVe.addEventListener("click", () => loadStops("VE"));
 
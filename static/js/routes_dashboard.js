@@ -39,6 +39,8 @@ document.addEventListener("DOMContentLoaded", () => {
 
   let requestSeq = 0;
   let tripsSeq = 0;
+  // summary mọi tuyến lấy 1 lần qua /api/routes/summary (tránh N request khi chọn tuyến)
+  const summaryCache = new Map();
 
   function escapeHtml(str) {
     return String(str ?? "")
@@ -215,6 +217,30 @@ document.addEventListener("DOMContentLoaded", () => {
     if (errorAlert) errorAlert.classList.add("d-none");
   }
 
+  function setRowStatus(routeId, data) {
+    // cập nhật data-status cho filter chip
+    const row = tbody.querySelector(`.route-row[data-route-id="${routeId}"]`);
+    if (row && data?.data_status) {
+      row.setAttribute("data-status", data.data_status === "Đủ" ? "DU" : "THIEU");
+    }
+  }
+
+  async function prefetchSummaries() {
+    try {
+      const res = await fetch("/api/routes/summary");
+      const data = await res.json();
+      if (!res.ok || !data?.ok) throw new Error("API summary lỗi");
+
+      (data.items || []).forEach((item) => {
+        summaryCache.set(String(item.route_id), item);
+        setRowStatus(item.route_id, item);
+      });
+    } catch (e) {
+      // fallback: từng tuyến tự gọi /api/routes/<id>/summary khi được chọn
+      console.error(e);
+    }
+  }
+
   async function loadSummary(routeId) {
     if (!routeId) {
       resetSummary();
@@ -224,6 +250,14 @@ document.addEventListener("DOMContentLoaded", () => {
 
     requestSeq += 1;
     const seq = requestSeq;
+
+    const cached = summaryCache.get(String(routeId));
+    if (cached) {
+      renderSummary(cached);
+      setDetailLink(routeId);
+      return;
+    }
+
     showLoading();
 
     try {
@@ -234,14 +268,10 @@ document.addEventListener("DOMContentLoaded", () => {
 
       if (!res.ok) throw new Error("API summary lỗi");
 
+      summaryCache.set(String(routeId), data);
       renderSummary(data);
       setDetailLink(routeId);
-
-       // cập nhật data-status cho filter chip
-      const row = tbody.querySelector(`.route-row[data-route-id="${routeId}"]`);
-      if (row && data?.data_status) {
-        row.setAttribute("data-status", data.data_status === "Đủ" ? "DU" : "THIEU");
-      }
+      setRowStatus(routeId, data);
     } catch (e) {
       if (seq !== requestSeq) return;
       console.error(e);
@@ -342,19 +372,24 @@ document.addEventListener("DOMContentLoaded", () => {
   if (search) search.addEventListener("input", applyFilter);
   // no status chip filter now
 
-  const initial = window.__initialRouteId != null ? String(window.__initialRouteId) : null;
-  if (initial && tbody.querySelector(`.route-row[data-route-id="${initial}"]`)) {
-    selectByRouteId(initial);
-  } else if (sel && sel.value) {
-    selectByRouteId(sel.value);
-  } else {
-    const first = tbody.querySelector(".route-row");
-    if (first) selectByRouteId(first.dataset.routeId);
-    else {
-      resetSummary();
-      if (hasTripsPanel) resetTrips("Chưa tải dữ liệu.");
+  function init() {
+    const initial = window.__initialRouteId != null ? String(window.__initialRouteId) : null;
+    if (initial && tbody.querySelector(`.route-row[data-route-id="${initial}"]`)) {
+      selectByRouteId(initial);
+    } else if (sel && sel.value) {
+      selectByRouteId(sel.value);
+    } else {
+      const first = tbody.querySelector(".route-row");
+      if (first) selectByRouteId(first.dataset.routeId);
+      else {
+        resetSummary();
+        if (hasTripsPanel) resetTrips("Chưa tải dữ liệu.");
+      }
     }
+
+    applyFilter();
   }
 
-  applyFilter();
+  showLoading();
+  prefetchSummaries().finally(init);
 });
@@ -2,6 +2,8 @@
 // Bản đồ tổng quan ở /routes:
 // vẽ tuyến đang chọn dựa trên 2 điểm đầu/cuối (OSRM nếu có, fallback đường thẳng).
 
+// Cần static/js/polyline.js (window.geometryToLatLng) load trước.
+
 (function () {
   const DEFAULT_CENTER = [16.047079, 108.206230];
   const DEFAULT_ZOOM = 12;
@@ -73,20 +75,13 @@
   }
 
   async function fetchOsrmLine(a, b) {
-    const res = await fetch("/api/osrm/route", {
-      method: "POST",
-      headers: { "Content-Type": "application/json" },
-      body: JSON.stringify({ coords: [[a.lat, a.lng], [b.lat, b.lng]] }),
-    });
+    const coords = `${a.lat},${a.lng};${b.lat},${b.lng}`;
+    // bản đồ tổng quan ở zoom ~12: polyline6 rút gọn theo zoom 13 là đủ nét
+    const res = await fetch(`/api/osrm/route?coords=${encodeURIComponent(coords)}&format=polyline6&zoom=13`);
     const data = await res.json();
     return { res, data };
   }
 
-  function geoJsonLineToLatLng(geometry) {
-    if (!geometry || geometry.type !== "LineString" || !Array.isArray(geometry.coordinates)) return [];
-    return geometry.coordinates.map((c) => [c[1], c[0]]);
-  }
-
   function drawStraight(a, b) {
     return L.polyline(
       [
@@ -176,7 +171,7 @@
       if (seq !== requestSeq) return;
 
       if (osrmRes.ok && osrm.ok && osrm.geometry) {
-        const line = geoJsonLineToLatLng(osrm.geometry);
+        const line = window.geometryToLatLng(osrm.geometry);
         routeLayer = L.polyline(line, { color: "#0d6efd", weight: 4, opacity: 0.9 }).addTo(map);
         setStatus("Đang hiển thị đường đi giữa điểm đầu/cuối (OSRM).", "success");
       } else {
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+Cấu hình chung cho tests: DB SQLite tạm, tắt job nền, OSRM trỏ vào cổng đóng (offset dùng fallback Haversine).
+Env phải set trước khi import app (app đọc env + chạy migration lúc import).
+"""
+
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+os.environ.setdefault("DATABASE_URL", "sqlite:///" + os.path.join(tempfile.mkdtemp(), "smartbus_test.db"))
+os.environ.setdefault("BUS_SCHEDULER_ENABLED", "0")
+os.environ.setdefault("STOP_TIMES_ENABLED", "0")
+os.environ.setdefault("TRIP_ARCHIVE_INTERVAL_SEC", "0")
+os.environ.setdefault("OSRM_BASE_URL", "http://127.0.0.1:9")
+os.environ.setdefault("OSRM_TIMEOUT", "0.5")
+os.environ.setdefault("OSRM_RETRIES", "0")
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+
+@pytest.fixture
+def app_ctx():
+    from app import app
+
+    with app.app_context():
+        yield app
+
+
+@pytest.fixture
+def make_route(app_ctx):
+    """Tạo tuyến có trạm 2 hướng (tọa độ giả quanh Đà Nẵng), trả maTuyen."""
+    from app import TramDung, TuyenXe, db
+
+    def _make(code, n_stops=10, window="05:00 - 22:30", headway=15):
+        tuyen = TuyenXe(maHienThi=code, tenTuyen="Tuyến " + code, thoiGianHoatDong=window, tanSuatPhut=headway)
+        db.session.add(tuyen)
+        db.session.flush()
+        for i in range(n_stops):
+            for huong, sign in (("DI", 1), ("VE", -1)):
+                db.session.add(TramDung(
+                    tenTram=f"{code}-{huong}{i}", thuTuTrenTuyen=i + 1, huong=huong, tuyen_id=tuyen.maTuyen,
+                    lat=16.0 + 0.003 * (i if sign > 0 else n_stops - i), lng=108.2 + 0.002 * i,
+                ))
+        db.session.commit()
+        return tuyen.maTuyen
+
+    return _make
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""Dọn chuyến cũ (`archive_past_trips`): giữ chuyến có vé/chuyến mới, gộp tong_hop_chuyen_ngay qua nhiều lượt."""
+
+from datetime import datetime
+
+from app import ChuyenXe, TongHopChuyenNgay, TuyenXe, VeXe, archive_past_trips, db
+
+NOW = datetime(2026, 10, 18, 12, 0)  # retention mặc định 7 ngày -> cắt ở 2026-10-11
+
+
+def add_trips(tuyen_id, ngay, gios, huongs=("DI",)):
+    trips = [
+        ChuyenXe(tuyen_id=tuyen_id, ngayKhoiHanh=ngay, gioKhoiHanh=gio, huong=huong)
+        for gio in gios for huong in huongs
+    ]
+    db.session.add_all(trips)
+    db.session.commit()
+    return trips
+
+
+def summary(tuyen_id, ngay, huong):
+    row = TongHopChuyenNgay.query.filter_by(tuyen_id=tuyen_id, ngay=ngay, huong=huong).one_or_none()
+    return row and (row.so_chuyen, row.gio_dau, row.gio_cuoi)
+
+
+def test_keeps_ticketed_and_recent_trips(make_route):
+    rid = make_route("11")
+    old = add_trips(rid, "2026-10-01", ["06:00", "06:15", "07:30"], huongs=("DI", "VE"))
+    recent = add_trips(rid, "2026-10-17", ["06:00"])
+    ticketed = old[2]  # 06:15 DI
+    db.session.add(VeXe(chuyen_id=ticketed.maChuyen, maSoVe="ARCH-1", soGhe="1"))
+    db.session.commit()
+    ticketed_id, recent_id = ticketed.maChuyen, recent[0].maChuyen
+
+    assert archive_past_trips(now=NOW, batch_size=2) == 5
+    left = {t.maChuyen for t in ChuyenXe.query.filter_by(tuyen_id=rid)}
+    assert left == {ticketed_id, recent_id}
+    assert summary(rid, "2026-10-01", "DI") == (2, "06:00", "07:30")
+    assert summary(rid, "2026-10-01", "VE") == (3, "06:00", "07:30")
+    assert summary(rid, "2026-10-17", "DI") is None
+
+
+def test_summary_accumulates_across_runs(make_route):
+    rid = make_route("12")
+    add_trips(rid, "2026-10-02", ["06:00", "07:00"])
+    assert archive_past_trips(now=NOW) == 2
+    assert archive_past_trips(now=NOW) == 0  # chạy lại không đếm trùng
+    assert summary(rid, "2026-10-02", "DI") == (2, "06:00", "07:00")
+
+    add_trips(rid, "2026-10-02", ["05:00", "22:00"])
+    assert archive_past_trips(now=NOW) == 2
+    assert summary(rid, "2026-10-02", "DI") == (4, "05:00", "22:00")
+
+
+def test_delete_mode_keeps_existing_summary(make_route):
+    rid = make_route("13")
+    add_trips(rid, "2026-10-03", ["06:00"])
+    assert archive_past_trips(now=NOW) == 1
+    add_trips(rid, "2026-10-03", ["05:00"])
+    assert archive_past_trips(mode="delete", now=NOW) == 1
+    assert ChuyenXe.query.filter_by(tuyen_id=rid).count() == 0
+    assert summary(rid, "2026-10-03", "DI") == (1, "06:00", "06:00")
+
+
+def test_archival_bumps_route_data_version(make_route):
+    rid = make_route("14")
+    add_trips(rid, "2026-10-04", ["06:00"])
+    before = db.session.get(TuyenXe, rid).data_version
+    archive_past_trips(now=NOW)
+    db.session.expire_all()
+    assert db.session.get(TuyenXe, rid).data_version > before
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""ETag theo data_version của tuyến + nén gzip: 304 mang đúng ETag (kể cả hậu tố -gzip) của response 200."""
+
+import gzip
+
+import pytest
+
+from app import TramDung, db
+
+
+@pytest.fixture
+def client(app_ctx, make_route):
+    def _client(code):
+        return app_ctx.test_client(), make_route(code, n_stops=12)
+    return _client
+
+
+def test_gzip_etag_suffix_and_304(client):
+    c, rid = client("31")
+    url = f"/api/routes/{rid}/stops_geo?dir=DI"
+    plain = c.get(url, headers={"Accept-Encoding": "identity"})
+    zipped = c.get(url, headers={"Accept-Encoding": "gzip"})
+    assert plain.status_code == zipped.status_code == 200
+    assert zipped.headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(zipped.data) == plain.data
+    assert zipped.headers["ETag"] == plain.headers["ETag"][:-1] + '-gzip"'
+
+    r304 = c.get(url, headers={"Accept-Encoding": "gzip", "If-None-Match": zipped.headers["ETag"]})
+    assert r304.status_code == 304 and r304.data == b""
+    assert r304.headers["ETag"] == zipped.headers["ETag"]
+    assert "Accept-Encoding" in r304.headers.get("Vary", "")
+
+    r304 = c.get(url, headers={"Accept-Encoding": "identity", "If-None-Match": plain.headers["ETag"]})
+    assert r304.status_code == 304 and r304.headers["ETag"] == plain.headers["ETag"]
+
+
+def test_direction_normalized_in_etag(client):
+    c, rid = client("32")
+    et = c.get(f"/api/routes/{rid}/stops_geo?dir=DI").headers["ETag"]
+    assert c.get(f"/api/routes/{rid}/stops_geo?dir=xx").headers["ETag"] == et
+    assert c.get(f"/api/routes/{rid}/stops_geo?dir=VE").headers["ETag"] != et
+
+
+def test_stop_edit_changes_etag(client):
+    c, rid = client("33")
+    url = f"/api/routes/{rid}/stops_geo?dir=DI"
+    et = c.get(url).headers["ETag"]
+    stop = TramDung.query.filter_by(tuyen_id=rid, huong="DI").first()
+    stop.tenTram = "Đổi tên"
+    db.session.commit()
+    r = c.get(url, headers={"If-None-Match": et})
+    assert r.status_code == 200 and r.headers["ETag"] != et
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+So sánh RAPTOR (`raptor`) với tìm kiếm vét cạn trên mạng lưới ngẫu nhiên (không cần DB/OSRM).
+
+Chạy: python -m pytest -q tests/test_planner.py
+"""
+
+import heapq
+import random
+from bisect import bisect_left
+from datetime import date
+
+from app import PlanNetwork, PlanPattern, raptor
+
+
+def random_network(rng, n_stops=14, n_patterns=5):
+    patterns = []
+    for pi in range(n_patterns):
+        stops = rng.sample(range(n_stops), rng.randint(2, 6))
+        offsets, t = [], 0
+        for _ in stops:
+            offsets.append(t)
+            t += rng.randint(60, 400)
+        first = rng.randint(5 * 3600, 6 * 3600)
+        headway = rng.randint(300, 1200)
+        depart_s = [first + i * headway for i in range(rng.randint(3, 12))]
+        patterns.append(PlanPattern(pi, str(pi), "DI", stops, offsets, depart_s, [None] * len(depart_s)))
+
+    stop_patterns = [[] for _ in range(n_stops)]
+    for pi, pat in enumerate(patterns):
+        for pos, si in enumerate(pat.stops):
+            stop_patterns[si].append((pi, pos))
+
+    footpaths = [[] for _ in range(n_stops)]
+    for i in range(n_stops):
+        for j in range(n_stops):
+            if i != j and rng.random() < 0.15:
+                footpaths[i].append((j, rng.randint(60, 600)))
+
+    return PlanNetwork(
+        date(2026, 10, 18), patterns, list(range(n_stops)), [str(i) for i in range(n_stops)],
+        [(0.0, 0.0)] * n_stops, stop_patterns, footpaths,
+    )
+
+
+def brute_force(net, sources, targets, depart_s, max_rides):
+    """Dijkstra trên trạng thái (trạm, số chuyến, vừa đi bộ?): đi bộ không nối tiếp đi bộ."""
+    best = {}
+    heap = [(depart_s + w, si, 0, False) for si, w in sources.items()]
+    heapq.heapify(heap)
+    while heap:
+        t, si, k, walked = heapq.heappop(heap)
+        if (si, k, walked) in best:
+            continue
+        best[(si, k, walked)] = t
+        if not walked:
+            for sj, w in net.footpaths[si]:
+                heapq.heappush(heap, (t + w, sj, k, True))
+        if k < max_rides:
+            for pi, pos in net.stop_patterns[si]:
+                pat = net.patterns[pi]
+                trip = bisect_left(pat.depart_s, t - pat.offsets[pos])
+                if trip >= len(pat.depart_s):
+                    continue
+                for q in range(pos + 1, len(pat.stops)):
+                    heapq.heappush(heap, (pat.depart_s[trip] + pat.offsets[q], pat.stops[q], k + 1, False))
+    arrivals = [t + targets[si] for (si, _, _), t in best.items() if si in targets]
+    return min(arrivals) if arrivals else None
+
+
+def test_raptor_matches_brute_force():
+    rng = random.Random(20261018)
+    mismatches = []
+    for case in range(300):
+        net = random_network(rng)
+        origin, dest = rng.sample(range(len(net.stop_ids)), 2)
+        depart_s = rng.randint(5 * 3600, 7 * 3600)
+        max_rides = rng.randint(1, 3)
+        found = raptor(net, {origin: 0}, {dest: 0}, depart_s, max_rounds=max_rides)
+        got = found[-1][0] if found else None
+        expected = brute_force(net, {origin: 0}, {dest: 0}, depart_s, max_rides)
+        if got != expected:
+            mismatches.append((case, origin, dest, got, expected))
+    assert not mismatches, mismatches[:5]
+
+
+def test_walk_only_journey_is_reported():
+    rng = random.Random(1)
+    net = random_network(rng)
+    net.footpaths[0] = [(1, 120)]
+    found = raptor(net, {0: 0}, {1: 0}, 6 * 3600, max_rounds=2)
+    assert found and found[0][1] == 0 and found[0][0] <= 6 * 3600 + 120
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""Token chuyến ảo v{tuyen}-{DI|VE}-{YYYYMMDD}-{HHMM}: tạo/parse và `resolve_virtual_trip` theo lịch chạy."""
+
+from datetime import datetime
+
+from app import (
+    ChuyenXe, db, parse_virtual_trip_token, resolve_virtual_trip, virtual_trip_token,
+)
+
+
+def test_token_round_trip():
+    depart = datetime(2026, 10, 18, 7, 45)
+    token = virtual_trip_token(3, "ve", depart)
+    assert token == "v3-VE-20261018-0745"
+    assert parse_virtual_trip_token(token) == (3, "VE", depart)
+
+
+def test_parse_rejects_malformed_tokens():
+    for token in ("", None, "garbage", "v3-XX-20261018-0745", "v3-DI-20261318-0745", "v3-DI-20261018-2561"):
+        assert parse_virtual_trip_token(token) is None
+
+
+def test_resolve_scheduled_departure(make_route):
+    rid = make_route("21", window="05:00 - 22:30", headway=15)
+    token = virtual_trip_token(rid, "DI", datetime(2026, 10, 18, 7, 45))
+    tuyen, dep = resolve_virtual_trip(token)
+    assert tuyen.maTuyen == rid
+    assert dep.virtual and dep.trip_id == token
+    assert dep.depart_dt == datetime(2026, 10, 18, 7, 45) and dep.huong == "DI"
+
+
+def test_resolve_rejects_off_schedule(make_route):
+    rid = make_route("22", window="05:00 - 22:30", headway=15)
+    assert resolve_virtual_trip(virtual_trip_token(rid, "DI", datetime(2026, 10, 18, 7, 46))) is None
+    assert resolve_virtual_trip(virtual_trip_token(rid, "DI", datetime(2026, 10, 18, 23, 0))) is None
+    assert resolve_virtual_trip(virtual_trip_token(rid + 1000, "DI", datetime(2026, 10, 18, 7, 45))) is None
+
+
+def test_resolve_prefers_real_trip(make_route):
+    rid = make_route("23", window="05:00 - 22:30", headway=15)
+    trip = ChuyenXe(tuyen_id=rid, ngayKhoiHanh="2026-10-18", gioKhoiHanh="08:00", huong="DI")
+    db.session.add(trip)
+    db.session.commit()
+    _, dep = resolve_virtual_trip(virtual_trip_token(rid, "DI", datetime(2026, 10, 18, 8, 0)))
+    assert not dep.virtual and dep.trip_id == trip.maChuyen